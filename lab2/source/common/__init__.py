@@ -0,0 +1,2 @@
+# Modules shared by the tasks. Each task directory has a common.py that
+# makes this package importable from its scripts.
@@ -0,0 +1,231 @@
+import bisect
+import json
+import secrets
+import time
+from collections import deque
+
+# How many changes a directory remembers for delta syncs; a client further
+# behind than that pages through it again.
+HISTORY = 4096
+# A page or delta stops at about this many bytes of entries, so that it fits
+# the clients' 1024-byte reads in either encoding.
+PAGE_BYTES = 768
+# Clients that list with a cursor or version are pushed every change for
+# WATCH_TTL seconds after, and listing again renews that. Caches count as
+# fresh for half of it, so a lost push is noticed within WATCH_TTL / 2.
+WATCH_TTL = 60
+MAX_WATCHERS = 10_000
+# JSON cost of one {"id": ..., "name": ...} entry besides the id and name.
+# Names are measured JSON-escaped, which is never shorter than their utf-8.
+ENTRY_BYTES = 24
+
+
+class Directory:
+    # id -> name, listed a page at a time in id order. Every change bumps
+    # the version and is remembered, so a client holding an older version
+    # can be sent just the adds and removes since then. Versions start at a
+    # random point so that one from before a restart is never mistaken for
+    # a current one.
+    def __init__(self, kind: str):
+        self.kind = kind  # "rooms" or "users", the key pages are sent under.
+        self.entries: dict[str, str] = {}
+        self.keys: list[str] = []  # Sorted, for cursors.
+        self.version = secrets.randbits(32) << 16
+        self.changes: deque = deque(maxlen=HISTORY)  # (version, id, name or None)
+        # address -> lease expiry, in expiry order since renewing moves an
+        # address to the end.
+        self.watchers: dict = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def put(self, key: str, name: str) -> bool:
+        # Returns whether anything changed.
+        if self.entries.get(key) == name:
+            return False
+        if key not in self.entries:
+            bisect.insort(self.keys, key)
+        self.entries[key] = name
+        self.record(key, name)
+        return True
+
+    def remove(self, key: str) -> bool:
+        if key not in self.entries:
+            return False
+        del self.entries[key]
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        self.record(key, None)
+        return True
+
+    def record(self, key: str, name):
+        self.version += 1
+        self.changes.append((self.version, key, name))
+
+    def page(self, cursor: str) -> tuple[list, str]:
+        # Entries after cursor and the cursor of the next page, "" after the
+        # last one.
+        page, size = [], 0
+        for index in range(bisect.bisect_right(self.keys, cursor), len(self.keys)):
+            key = self.keys[index]
+            name = self.entries[key]
+            cost = ENTRY_BYTES + len(key) + len(json.dumps(name))
+            if page and size + cost > PAGE_BYTES:
+                return page, page[-1]["id"]
+            page.append({"id": key, "name": name})
+            size += cost
+        return page, ""
+
+    def since(self, version: int):
+        # (added, removed) since version, or None when that version is not
+        # one we can build a delta from, or the delta would not fit a page.
+        if not self.version - len(self.changes) <= version <= self.version:
+            return None
+
+        latest = {}
+        for changed, key, name in reversed(self.changes):
+            if changed <= version:
+                break
+            latest.setdefault(key, name)
+
+        added, removed, size = [], [], 0
+        for key, name in latest.items():
+            if name is None:
+                removed.append(key)
+                size += len(key) + 4
+            else:
+                added.append({"id": key, "name": name})
+                size += ENTRY_BYTES + len(key) + len(json.dumps(name))
+            if size > PAGE_BYTES:
+                return None
+        return added, removed
+
+    def reply(self, message: dict) -> dict:
+        # The answer to a list request: a delta when the client sent a
+        # version we can serve one from, otherwise the page at its cursor
+        # (the first page when it sent neither).
+        since = message.get("since")
+        if isinstance(since, int):
+            delta = self.since(since)
+            if delta is not None:
+                added, removed = delta
+                return {
+                    "success": True,
+                    "added": added,
+                    "removed": removed,
+                    "version": self.version,
+                }
+
+        cursor = message.get("cursor")
+        page, cursor = self.page(cursor if isinstance(cursor, str) else "")
+        return {"success": True, self.kind: page, "cursor": cursor, "version": self.version}
+
+    def watch(self, address):
+        self.watchers.pop(address, None)
+        self.watchers[address] = time.monotonic() + WATCH_TTL
+        if len(self.watchers) > MAX_WATCHERS:
+            del self.watchers[next(iter(self.watchers))]
+
+    def watching(self) -> list:
+        now = time.monotonic()
+        while self.watchers:
+            address = next(iter(self.watchers))
+            if self.watchers[address] > now:
+                break
+            del self.watchers[address]
+        return list(self.watchers)
+
+    def event(self, key: str) -> dict:
+        # The latest change to key, as pushed to watchers; a removal has no
+        # "name".
+        event = {"directory": self.kind, "id": key, "version": self.version}
+        if key in self.entries:
+            event["name"] = self.entries[key]
+        return event
+
+
+class DirectoryCache:
+    # A client's copy of a server Directory. Pushed events are applied when
+    # they follow on from our version; a gap marks the copy stale, and so
+    # does age, and a stale copy is brought up to date with a delta.
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.entries: dict[str, str] = {}
+        self.version: int | None = None
+        self.synced_at: float | None = None
+        self.stale = True
+        self.pushed = 0  # Newest version seen in a push.
+
+    def fresh(self) -> bool:
+        return (
+            not self.stale
+            and self.synced_at is not None
+            and time.monotonic() - self.synced_at < WATCH_TTL / 2
+        )
+
+    def apply(self, event: dict):
+        version = event["version"]
+        self.pushed = max(self.pushed, version)
+        if self.version is None or version != self.version + 1:
+            if self.version is None or version > self.version:
+                self.stale = True
+            return
+        if "name" in event:
+            self.entries[event["id"]] = event["name"]
+        else:
+            self.entries.pop(event["id"], None)
+        self.version = version
+
+    def sync(self, exchange, body: dict) -> bool:
+        # Brings the copy up to date: just the changes since our version
+        # when the server still has them, otherwise every page again.
+        # exchange(request) sends a request and returns the reply.
+        request = dict(body)
+        # Only pushes from here on count against the version we end up with.
+        self.pushed = 0
+        if self.version is None:
+            request["cursor"] = ""
+        else:
+            request["since"] = self.version
+
+        entries, version = {}, None
+        while True:
+            response = exchange(request)
+            if not response.get("success"):
+                return False
+
+            if "added" in response:
+                for entry in response["added"]:
+                    self.entries[entry["id"]] = entry["name"]
+                for key in response["removed"]:
+                    self.entries.pop(key, None)
+                self.synced(response["version"])
+                return True
+
+            # Changes made while we page arrive with the next delta, so
+            # the version to keep is the one we started from.
+            if version is None:
+                version = response["version"]
+            for entry in response[self.kind]:
+                entries[entry["id"]] = entry["name"]
+            if not response["cursor"]:
+                break
+            request = {**body, "cursor": response["cursor"]}
+
+        self.entries = entries
+        self.synced(version)
+        return True
+
+    def synced(self, version: int):
+        self.version = version
+        self.synced_at = time.monotonic()
+        # A push newer than what we synced to was missed along the way.
+        self.stale = self.pushed > version
+
+    def refresh(self, exchange, body: dict) -> bool:
+        return self.fresh() or self.sync(exchange, body)
@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import selectors
+import subprocess
+import sys
+import time
+
+# Shared by the load scripts of every task (task1/bench_server.py and the
+# loadgen.py of task2 and task3): starting a server, driving an open-loop
+# send schedule, measuring the server process and writing results as one
+# JSON object per line. Run on its own (python ../common/loadstat.py from a
+# task directory) it compares two result files.
+
+# After the send schedule ends, replies still in flight are read for this
+# long before anything missing counts as lost.
+SETTLE = 0.5
+# Throughput may drop and latency may grow by this fraction before compare
+# calls it a regression.
+TOLERANCE = 0.10
+
+
+def start_server(code: str, cwd: str) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+    )
+    time.sleep(0.5)
+    return process
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    process.wait()
+
+
+def percentile(samples: list[float], p: float) -> float:
+    # samples must be sorted.
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def revision(cwd: str) -> str | None:
+    # The commit under test, so results from different versions can be told
+    # apart.
+    try:
+        output = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            timeout=5,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.stdout.strip() or None
+
+
+class ProcessStats:
+    # CPU time and memory of a server and its worker processes, from /proc.
+    # Elsewhere every figure is None.
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.cpu = self.wall = 0.0
+
+    def tree(self) -> list[int]:
+        pids, index = [self.pid], 0
+        while index < len(pids):
+            try:
+                for tid in os.listdir(f"/proc/{pids[index]}/task"):
+                    with open(f"/proc/{pids[index]}/task/{tid}/children") as f:
+                        pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+            index += 1
+        return pids
+
+    def cpu_seconds(self) -> float | None:
+        total, found = 0, False
+        for pid in self.tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # The command name may hold spaces, so count from after it.
+                    fields = f.read().rpartition(")")[2].split()
+            except OSError:
+                continue
+            total += int(fields[11]) + int(fields[12])  # utime, stime
+            found = True
+        return total / self.tick if found else None
+
+    def memory_mb(self) -> tuple[float | None, float | None]:
+        # (current, peak) resident set, summed over the processes.
+        rss = peak = 0
+        found = False
+        for pid in self.tree():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1])
+                            found = True
+                        elif line.startswith("VmHWM:"):
+                            peak += int(line.split()[1])
+            except OSError:
+                continue
+        if not found:
+            return None, None
+        return round(rss / 1024, 1), round(peak / 1024, 1)
+
+    def start(self):
+        self.cpu = self.cpu_seconds()
+        self.wall = time.perf_counter()
+
+    def stop(self) -> dict:
+        cpu = self.cpu_seconds()
+        elapsed = time.perf_counter() - self.wall
+        rss, peak = self.memory_mb()
+        used = None if cpu is None or self.cpu is None else cpu - self.cpu
+        return {
+            "server_cpu_s": None if used is None else round(used, 3),
+            "server_cpu_pct": None if used is None else round(100 * used / elapsed, 1),
+            "server_rss_mb": rss,
+            "server_peak_rss_mb": peak,
+        }
+
+
+def drive(sockets: list, send, receive, rate: float, duration: float) -> tuple:
+    # Open loop: send(n) is called for the n-th message at a fixed offered
+    # rate however fast the server answers, so queueing shows up as latency
+    # and drops rather than as a slower schedule. receive(index, data) is
+    # called for every datagram on sockets[index] and returns the latencies
+    # it completes. Returns (messages sent, latencies, seconds sending).
+    selector = selectors.DefaultSelector()
+    for index, sock in enumerate(sockets):
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, index)
+
+    def read(timeout: float):
+        for key, _ in selector.select(timeout):
+            try:
+                while True:
+                    latencies.extend(receive(key.data, key.fileobj.recv(65535)))
+            except (BlockingIOError, InterruptedError):
+                pass
+            except ConnectionRefusedError:
+                # An ICMP error for an earlier datagram.
+                pass
+
+    latencies, sent = [], 0
+    interval = 1 / rate
+    start = next_send = time.perf_counter()
+    while (now := time.perf_counter()) - start < duration:
+        while next_send <= now:
+            send(sent)
+            sent += 1
+            next_send += interval
+        read(max(0.0, next_send - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+
+    deadline = time.perf_counter() + SETTLE
+    while (left := deadline - time.perf_counter()) > 0:
+        read(left)
+    selector.close()
+    return sent, latencies, elapsed
+
+
+def result(
+    task: str,
+    scenario: str,
+    params: dict,
+    elapsed: float,
+    expected: int,
+    delivered: int,
+    latencies: list[float],
+    stats: dict,
+    units: str = "messages",
+) -> dict:
+    latencies.sort()
+    return {
+        "task": task,
+        "scenario": scenario,
+        "revision": revision(os.path.dirname(os.path.abspath(__file__))),
+        "time": int(time.time()),
+        **params,
+        "units": units,
+        "expected": expected,
+        "delivered": delivered,
+        "per_sec": round(delivered / elapsed, 1) if elapsed else 0.0,
+        "loss_pct": round(100 * (1 - delivered / expected), 3) if expected else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "p999_ms": round(percentile(latencies, 0.999) * 1000, 3),
+        **stats,
+    }
+
+
+def emit(record: dict, out: str | None):
+    line = json.dumps(record)
+    print(line)
+    if out:
+        with open(out, "a") as f:
+            f.write(line + "\n")
+
+
+def key(record: dict) -> tuple:
+    # Records match across runs when everything but the measurements does.
+    skip = {"revision", "time", "sent", "expected", "delivered", "per_sec", "loss_pct", "mb_per_sec"}
+    return tuple(
+        sorted(
+            (name, value)
+            for name, value in record.items()
+            if name not in skip and not name.startswith(("p50", "p99", "server_"))
+        )
+    )
+
+
+def compare(baseline: str, current: str, tolerance: float = TOLERANCE) -> int:
+    # Prints each scenario found in both files and returns how many got
+    # worse by more than tolerance.
+    def load(path: str) -> dict:
+        with open(path) as f:
+            # The last run of a scenario wins.
+            return {key(record): record for record in map(json.loads, filter(str.strip, f))}
+
+    before, after = load(baseline), load(current)
+    regressions = 0
+    print("%-10s%-12s%12s%12s%12s%12s  %s" % ("task", "scenario", "per_sec", "was", "p99_ms", "was", ""))
+    for scenario, new in after.items():
+        old = before.get(scenario)
+        if old is None:
+            continue
+        worse = (
+            new["per_sec"] < old["per_sec"] * (1 - tolerance)
+            or new["p99_ms"] > old["p99_ms"] * (1 + tolerance)
+            or new["loss_pct"] > old["loss_pct"] + 100 * tolerance
+        )
+        regressions += worse
+        print(
+            "%-10s%-12s%12.1f%12.1f%12.3f%12.3f  %s"
+            % (
+                new["task"],
+                new["scenario"],
+                new["per_sec"],
+                old["per_sec"],
+                new["p99_ms"],
+                old["p99_ms"],
+                "REGRESSION" if worse else "",
+            )
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two load test result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    sys.exit(1 if compare(args.baseline, args.current, args.tolerance) else 0)
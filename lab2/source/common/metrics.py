@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+
+# Counters kept on the servers' hot path: plain integer adds and one bucket
+# per sample, so they can stay on under load. Read them with a "stats"
+# request or have them appended to a file every few seconds.
+
+# Histograms count samples in power-of-two buckets: bucket n holds values
+# below 2**n, so 25 buckets reach 2**24 us (about 17 s) or 16M recipients.
+BUCKETS = 25
+# Request types counted separately; anything past that is counted as "other"
+# so that junk requests cannot grow the table.
+MAX_KINDS = 64
+DUMP_INTERVAL = 10
+# Log lines printed per second before the rest are only counted.
+LOG_RATE = 10
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+
+    def add(self, value: int):
+        self.counts[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> int:
+        # The upper bound of the bucket holding the q-th sample.
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 1 << index
+        return 0
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 1) if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "p999": self.quantile(0.999),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.requests: dict[str, Histogram] = {}  # request type -> latency in us
+        self.fanout = Histogram()  # Recipients per fanned-out message.
+        self.datagrams_in = self.bytes_in = 0
+        self.datagrams_out = self.bytes_out = 0
+        self.errors = 0
+        self.shed: dict[str, int] = {}  # limit -> requests dropped over it
+        self.gauges = {}  # name -> function reading a queue depth or size
+
+    def received(self, size: int):
+        self.datagrams_in += 1
+        self.bytes_in += size
+
+    def sent(self, size: int, count: int = 1):
+        self.datagrams_out += count
+        self.bytes_out += size * count
+
+    def handled(self, kind, seconds: float):
+        histogram = self.requests.get(kind)
+        if histogram is None:
+            if not isinstance(kind, str) or len(self.requests) >= MAX_KINDS:
+                kind = "other"
+            histogram = self.requests.setdefault(kind, Histogram())
+        histogram.add(int(seconds * 1e6))
+
+    def dropped(self, reason: str):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def fanned_out(self, size: int, recipients: int):
+        self.fanout.add(recipients)
+        self.sent(size, recipients)
+
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        # Copies are taken first since a dump thread may read while the
+        # server adds request types.
+        requests = sorted(list(self.requests.items()))
+        gauges = list(self.gauges.items())
+        shed = dict(self.shed)
+        return {
+            "time": round(time.time(), 3),
+            "uptime": round(time.time() - self.started, 3),
+            "datagrams_in": self.datagrams_in,
+            "bytes_in": self.bytes_in,
+            "datagrams_out": self.datagrams_out,
+            "bytes_out": self.bytes_out,
+            "errors": self.errors,
+            "shed": shed,
+            "requests_us": {kind: histogram.summary() for kind, histogram in requests},
+            "fanout": self.fanout.summary(),
+            "queues": {name: read() for name, read in gauges},
+        }
+
+    def dump_every(self, path: str, interval: float = DUMP_INTERVAL):
+        # Appends a snapshot to path every interval seconds, one JSON object
+        # per line, from a thread of its own.
+        def dump():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(path, "a") as f:
+                        f.write(json.dumps(self.snapshot()) + "\n")
+                except (OSError, RuntimeError):
+                    # A full disk or a dict resized mid-read; try next time.
+                    pass
+
+        threading.Thread(target=dump, daemon=True).start()
+
+
+def send_each(sock, data: bytes, destinations) -> int:
+    for address in destinations.addresses:
+        sock.sendto(data, address)
+    return len(destinations)
+
+
+class MeteredSocket:
+    # Counts what a server sends. send_many(sock, data, destinations) is the
+    # batched send used for fan-out.
+    def __init__(self, sock, metrics: Metrics, send_many=send_each):
+        self.sock = sock
+        self.metrics = metrics
+        self.send_many = send_many
+
+    def sendto(self, data: bytes, address):
+        self.metrics.sent(len(data))
+        return self.sock.sendto(data, address)
+
+    def sendto_many(self, data: bytes, destinations) -> int:
+        # Only what actually went out is counted.
+        sent = self.send_many(self.sock, data, destinations)
+        self.metrics.fanned_out(len(data), sent)
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class RateLimitedLog:
+    # Prints at most rate lines a second. The rest are only counted, and
+    # how many were skipped is printed with the next line that gets out.
+    # Arguments are formatted only for lines that are printed.
+    def __init__(self, rate: int = LOG_RATE):
+        self.rate = rate
+        self.window = 0.0
+        self.lines = 0
+        self.skipped = 0
+
+    def __call__(self, text: str, *args):
+        now = time.monotonic()
+        if now - self.window >= 1:
+            self.window = now
+            self.lines = 0
+        if self.lines >= self.rate:
+            self.skipped += 1
+            return
+        self.lines += 1
+        if self.skipped:
+            print(f"({self.skipped} log lines skipped)")
+            self.skipped = 0
+        print(text % args if args else text)
@@ -0,0 +1,97 @@
+import time
+
+# Token buckets that keep one client from crowding out the rest. A server
+# names its limits, say per user and per source address, and each request
+# spends tokens from the bucket of every limit it falls under. Data (chat
+# messages, relayed files) and control requests (joins, listings,
+# heartbeats) should use separate limits, so that a client over its data
+# limit can still leave a room or look something up.
+
+# Buckets that have filled up again are forgotten every PRUNE_INTERVAL
+# seconds; a new bucket starts full anyway.
+PRUNE_INTERVAL = 10
+# Error replies per second to a client whose requests are being shed.
+ERROR_RATE = 1
+
+
+class TokenBuckets:
+    # One bucket per key, refilled at rate tokens a second up to burst.
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets: dict = {}  # key -> [tokens, time of the last refill]
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def refill(self, key) -> list:
+        now = self.clock()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, key, cost: float = 1) -> bool:
+        bucket = self.refill(key)
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+    def prune(self):
+        now = self.clock()
+        full = [
+            key
+            for key, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate >= self.burst
+        ]
+        for key in full:
+            del self.buckets[key]
+
+
+class RateLimits:
+    # limits maps a limit's name to (rate, burst). Requests over a limit
+    # are counted in metrics under the limit's name.
+    def __init__(self, limits: dict, metrics, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = {name: TokenBuckets(rate, burst, clock) for name, (rate, burst) in limits.items()}
+        self.replies = TokenBuckets(ERROR_RATE, ERROR_RATE, clock)
+        self.metrics = metrics
+        self.pruned = clock()
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self.buckets.values())
+
+    def check(self, *keys, cost: float = 1) -> str | None:
+        # keys are (limit name, key) pairs, and a None key is not limited.
+        # Returns None when the request may go ahead, otherwise the name of
+        # the limit it is over. Tokens are spent only once every limit has
+        # enough, so a request turned away costs its sender nothing.
+        if self.clock() - self.pruned >= PRUNE_INTERVAL:
+            self.prune()
+        buckets = []
+        for name, key in keys:
+            if key is None:
+                continue
+            bucket = self.buckets[name].refill(key)
+            if bucket[0] < cost:
+                self.metrics.dropped(name)
+                return name
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket[0] -= cost
+        return None
+
+    def should_reply(self, address) -> bool:
+        # Whether to tell a shed client so; a flood is not answered in kind.
+        return self.replies.take(address)
+
+    def prune(self):
+        self.pruned = self.clock()
+        for buckets in self.buckets.values():
+            buckets.prune()
+        self.replies.prune()
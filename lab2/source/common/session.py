@@ -0,0 +1,91 @@
+import math
+import threading
+import time
+
+# A session ends SESSION_TTL seconds after the last datagram from its user.
+# Clients send a heartbeat every HEARTBEAT seconds so that an idle but live
+# user is never dropped, and the servers check for expired sessions every
+# TICK seconds.
+SESSION_TTL = 60
+HEARTBEAT = SESSION_TTL / 4
+TICK = 1.0
+
+
+class TimingWheel:
+    # A hashed timing wheel: each key sits in the slot of the tick it expires
+    # on. Touching a key moves it from one slot to another, and each tick
+    # only looks at the slot coming due, which holds exactly the keys that
+    # expire then, so neither depends on how many keys there are.
+    def __init__(self, ttl: float = SESSION_TTL, tick: float = TICK, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        # Ticks from a touch to expiry. One is added because the current
+        # tick is already partly over.
+        self.span = math.ceil(ttl / tick) + 1
+        # Twice as many slots as that, so a key touched before the due
+        # ticks have been expired can never land in one of them.
+        self.slots: list[set] = [set() for _ in range(2 * self.span)]
+        self.where: dict = {}  # key -> index of its slot
+        self.now = self.ticks()  # The last tick expired.
+
+    def __contains__(self, key) -> bool:
+        return key in self.where
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def ticks(self) -> int:
+        return int(self.clock() / self.tick)
+
+    def touch(self, key):
+        slot = (self.ticks() + self.span) % len(self.slots)
+        old = self.where.get(key)
+        if old == slot:
+            return
+        if old is not None:
+            self.slots[old].discard(key)
+        self.slots[slot].add(key)
+        self.where[key] = slot
+
+    def discard(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    def timeout(self) -> float:
+        # Seconds until the next tick is due.
+        return max(0.0, (self.now + 1) * self.tick - self.clock())
+
+    def expire(self) -> list:
+        # The keys whose time ran out since the last call.
+        current = self.ticks()
+        if current == self.now:
+            return []
+
+        expired = []
+        # After a pause longer than the wheel, every slot is due once.
+        for tick in range(max(self.now + 1, current - len(self.slots) + 1), current + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                expired.extend(slot)
+                for key in slot:
+                    del self.where[key]
+                slot.clear()
+        self.now = current
+        return expired
+
+
+def keep_alive(send, interval: float = HEARTBEAT):
+    # Calls send() every interval seconds from a daemon thread, for clients
+    # that spend most of their time waiting on input.
+    def beat():
+        while True:
+            time.sleep(interval)
+            try:
+                send()
+            except OSError:
+                # The connection is being replaced; the next beat uses the
+                # new one.
+                pass
+
+    threading.Thread(target=beat, daemon=True).start()
@@ -0,0 +1,111 @@
+import unittest
+
+from common import directory
+from common.directory import Directory, DirectoryCache
+
+
+class DirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Directory("rooms")
+
+    def test_put_and_remove_report_changes(self):
+        self.assertTrue(self.directory.put("a", "one"))
+        self.assertFalse(self.directory.put("a", "one"))
+        self.assertTrue(self.directory.put("a", "uno"))
+        self.assertTrue(self.directory.remove("a"))
+        self.assertFalse(self.directory.remove("a"))
+        self.assertNotIn("a", self.directory)
+
+    def test_pages_cover_every_entry_once(self):
+        for index in range(500):
+            self.directory.put(f"{index:04x}", f"room {index}")
+        seen, cursor = [], ""
+        while True:
+            page, cursor = self.directory.page(cursor)
+            self.assertTrue(page)
+            seen += [entry["id"] for entry in page]
+            if not cursor:
+                break
+        self.assertEqual(seen, sorted(self.directory.entries))
+
+    def test_delta_since_version(self):
+        self.directory.put("a", "one")
+        version = self.directory.version
+        self.directory.put("b", "two")
+        self.directory.put("a", "uno")
+        self.directory.remove("b")
+        added, removed = self.directory.since(version)
+        self.assertEqual(added, [{"id": "a", "name": "uno"}])
+        self.assertEqual(removed, ["b"])
+
+    def test_no_delta_from_unknown_versions(self):
+        self.directory.put("a", "one")
+        self.assertIsNone(self.directory.since(self.directory.version + 1))
+        self.assertIsNone(self.directory.since(0))
+
+    def test_reply_falls_back_to_first_page(self):
+        self.directory.put("a", "one")
+        reply = self.directory.reply({"since": 0})
+        self.assertEqual(reply["rooms"], [{"id": "a", "name": "one"}])
+        self.assertEqual(reply["cursor"], "")
+
+
+class DirectoryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Directory("rooms")
+        self.cache = DirectoryCache("rooms")
+        self.requests = []
+
+    def exchange(self, request: dict) -> dict:
+        self.requests.append(request)
+        return self.directory.reply(request)
+
+    def test_sync_pages_then_deltas(self):
+        for index in range(300):
+            self.directory.put(f"{index:04x}", "x" * 20)
+        self.assertTrue(self.cache.sync(self.exchange, {"request": "list-rooms"}))
+        self.assertEqual(self.cache.entries, self.directory.entries)
+        self.assertGreater(len(self.requests), 1)
+
+        self.directory.put("zzzz", "new")
+        self.directory.remove("0000")
+        self.requests.clear()
+        self.assertTrue(self.cache.sync(self.exchange, {"request": "list-rooms"}))
+        self.assertEqual(self.cache.entries, self.directory.entries)
+        self.assertEqual(len(self.requests), 1)
+        self.assertIn("since", self.requests[0])
+
+    def test_pushes_apply_in_order(self):
+        self.cache.sync(self.exchange, {})
+        self.directory.put("a", "one")
+        self.cache.apply(self.directory.event("a"))
+        self.assertEqual(self.cache.entries, {"a": "one"})
+        self.assertTrue(self.cache.fresh())
+
+        self.directory.remove("a")
+        self.cache.apply(self.directory.event("a"))
+        self.assertEqual(self.cache.entries, {})
+
+    def test_gap_marks_stale(self):
+        self.cache.sync(self.exchange, {})
+        self.directory.put("a", "one")
+        self.directory.put("b", "two")
+        self.cache.apply(self.directory.event("b"))
+        self.assertNotIn("b", self.cache.entries)
+        self.assertFalse(self.cache.fresh())
+        self.assertTrue(self.cache.refresh(self.exchange, {}))
+        self.assertEqual(self.cache.entries, self.directory.entries)
+
+    def test_history_overflow_repages(self):
+        self.cache.sync(self.exchange, {})
+        for index in range(directory.HISTORY + 1):
+            self.directory.put("a", str(index))
+        # Too far behind for a delta, so the answer is the first page.
+        self.assertIsNone(self.directory.since(self.cache.version))
+        self.cache.sync(self.exchange, {})
+        self.assertEqual(self.cache.entries, {"a": str(directory.HISTORY)})
+        self.assertEqual(self.cache.version, self.directory.version)
+
+
+if __name__ == "__main__":
+    unittest.main()
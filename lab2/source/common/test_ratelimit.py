@@ -0,0 +1,81 @@
+import unittest
+
+from common import ratelimit
+from common.ratelimit import RateLimits, TokenBuckets
+from conftest import Clock
+
+
+class Metrics:
+    def __init__(self):
+        self.shed = {}
+
+    def dropped(self, reason: str):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+
+
+class TokenBucketsTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        clock = Clock()
+        buckets = TokenBuckets(10, 5, clock)
+        self.assertEqual([buckets.take("a") for _ in range(6)], [True] * 5 + [False])
+        clock.now += 0.1
+        self.assertTrue(buckets.take("a"))
+        self.assertFalse(buckets.take("a"))
+        # Other keys have buckets of their own.
+        self.assertTrue(buckets.take("b"))
+
+    def test_prune_forgets_full_buckets(self):
+        clock = Clock()
+        buckets = TokenBuckets(10, 5, clock)
+        buckets.take("a", 5)
+        buckets.take("b", 1)
+        clock.now += 0.2
+        buckets.prune()
+        self.assertEqual(list(buckets.buckets), ["a"])
+
+
+class RateLimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics()
+        self.limits = RateLimits({"user": (1, 3), "room": (1, 1)}, self.metrics, self.clock)
+
+    def test_reports_the_limit_exceeded(self):
+        self.assertIsNone(self.limits.check(("user", "u"), ("room", "r")))
+        self.assertEqual(self.limits.check(("user", "u"), ("room", "r")), "room")
+        self.assertEqual(self.metrics.shed, {"room": 1})
+
+    def test_refused_request_spends_nothing(self):
+        self.limits.check(("room", "r"))
+        for _ in range(5):
+            self.assertEqual(self.limits.check(("user", "u"), ("room", "r")), "room")
+        # All three of the user's tokens are still there.
+        for _ in range(3):
+            self.assertIsNone(self.limits.check(("user", "u")))
+        self.assertEqual(self.limits.check(("user", "u")), "user")
+
+    def test_none_key_is_not_limited(self):
+        for _ in range(10):
+            self.assertIsNone(self.limits.check(("room", None)))
+
+    def test_cost(self):
+        self.assertEqual(self.limits.check(("user", "u"), cost=4), "user")
+        self.assertIsNone(self.limits.check(("user", "u"), cost=3))
+
+    def test_replies_are_rate_limited(self):
+        self.assertTrue(self.limits.should_reply("a"))
+        self.assertFalse(self.limits.should_reply("a"))
+        self.assertTrue(self.limits.should_reply("b"))
+        self.clock.now += 1 / ratelimit.ERROR_RATE
+        self.assertTrue(self.limits.should_reply("a"))
+
+    def test_prunes_lazily(self):
+        self.limits.check(("user", "u"))
+        self.assertEqual(len(self.limits), 1)
+        self.clock.now += ratelimit.PRUNE_INTERVAL
+        self.limits.check(("room", "r"))
+        self.assertEqual(len(self.limits), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from conftest import Clock
+from common.session import TimingWheel
+
+
+class TimingWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(ttl=10, tick=1, clock=self.clock)
+
+    def test_expires_after_ttl(self):
+        self.wheel.touch("a")
+        self.clock.now += 10
+        self.assertEqual(self.wheel.expire(), [])
+        self.clock.now += 2
+        self.assertEqual(self.wheel.expire(), ["a"])
+        self.assertNotIn("a", self.wheel)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_touch_postpones_expiry(self):
+        self.wheel.touch("a")
+        self.clock.now += 8
+        self.wheel.touch("a")
+        self.clock.now += 8
+        self.assertEqual(self.wheel.expire(), [])
+        self.clock.now += 4
+        self.assertEqual(self.wheel.expire(), ["a"])
+
+    def test_discard(self):
+        self.wheel.touch("a")
+        self.wheel.discard("a")
+        self.wheel.discard("missing")
+        self.clock.now += 20
+        self.assertEqual(self.wheel.expire(), [])
+
+    def test_pause_longer_than_the_wheel(self):
+        for key in range(5):
+            self.wheel.touch(key)
+            self.clock.now += 3
+        self.clock.now += 1000
+        self.assertEqual(sorted(self.wheel.expire()), list(range(5)))
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timeout_counts_down_to_next_tick(self):
+        self.clock.now += 0.25
+        self.assertAlmostEqual(self.wheel.timeout(), 0.75)
+        self.clock.now += 5
+        self.assertEqual(self.wheel.timeout(), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
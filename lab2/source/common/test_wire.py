@@ -0,0 +1,48 @@
+import json
+import unittest
+
+from common import wire
+
+MESSAGES = [
+    (1, "say", (("id", "id"), ("message", "str"))),
+    (64, None, (("success", "bool"), ("count", "u32"))),
+    (65, None, (("bundle", "frames"),)),
+]
+
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = wire.Codec(MESSAGES)
+
+    def test_round_trip(self):
+        for body in (
+            {"request": "say", "id": "0a1f", "message": "héllo"},
+            {"success": True, "count": 3},
+        ):
+            data = self.codec.dumps(body, binary=True)
+            self.assertTrue(wire.is_binary(data))
+            self.assertEqual(self.codec.loads(data), body)
+
+    def test_falls_back_to_json(self):
+        for body in (
+            {"request": "say", "id": "not hex", "message": "x"},
+            {"request": "say", "id": "0a1f", "message": "x", "extra": 1},
+            {"request": "unknown"},
+        ):
+            data = self.codec.dumps(body, binary=True)
+            self.assertEqual(json.loads(data), body)
+
+    def test_frames_decode_with_the_same_table(self):
+        inner = self.codec.encode({"success": False, "count": 1})
+        data = self.codec.encode({"bundle": [inner, inner]})
+        self.assertEqual(self.codec.decode(data), {"bundle": [{"success": False, "count": 1}] * 2})
+
+    def test_malformed_frames(self):
+        data = self.codec.encode({"request": "say", "id": "0a1f", "message": "x"})
+        for bad in (data[:2], data[:-1], data + b"x", bytes((wire.MAGIC, 9)) + data[2:], data[:2] + b"\x07"):
+            with self.assertRaises(wire.ProtocolError):
+                self.codec.decode(bad)
+
+
+if __name__ == "__main__":
+    unittest.main()
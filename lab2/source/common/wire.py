@@ -0,0 +1,307 @@
+import json
+import struct
+
+# The binary wire format shared by every task. Each task's protocol.py lists
+# its messages and builds a Codec from them; frames in both encodings can
+# share a socket and be told apart by their first byte, as MAGIC can never
+# open a JSON document.
+#
+#   magic:u8 version:u8 opcode:u8 field...
+#
+# ids are the 4-hex-digit ids the servers hand out and go on the wire as
+# u16; strings are u16 length-prefixed utf-8. A message with a value that
+# does not fit its binary field falls back to JSON.
+MAGIC = 0xB1
+VERSION = 1
+
+HEADER = struct.Struct("!BBB")
+U8 = struct.Struct("!B")
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+U64 = struct.Struct("!Q")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _encode_id(value, out: bytearray):
+    number = int(value, 16)
+    if f"{number:04x}" != value:
+        raise ValueError(value)
+    out += U16.pack(number)
+
+
+def _decode_id(data: bytes, offset: int):
+    return f"{U16.unpack_from(data, offset)[0]:04x}", offset + 2
+
+
+def _encode_str(value, out: bytearray):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    encoded = value.encode()
+    out += U16.pack(len(encoded))
+    out += encoded
+
+
+def _decode_str(data: bytes, offset: int):
+    (length,) = U16.unpack_from(data, offset)
+    offset += 2
+    if offset + length > len(data):
+        raise ProtocolError("Truncated string field")
+    return data[offset : offset + length].decode(), offset + length
+
+
+def _encode_bool(value, out: bytearray):
+    if not isinstance(value, bool):
+        raise TypeError(value)
+    out += U8.pack(value)
+
+
+def _decode_bool(data: bytes, offset: int):
+    return bool(U8.unpack_from(data, offset)[0]), offset + 1
+
+
+def _encode_u32(value, out: bytearray):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError(value)
+    out += U32.pack(value)
+
+
+def _decode_u32(data: bytes, offset: int):
+    return U32.unpack_from(data, offset)[0], offset + 4
+
+
+def _encode_u64(value, out: bytearray):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError(value)
+    out += U64.pack(value)
+
+
+def _decode_u64(data: bytes, offset: int):
+    return U64.unpack_from(data, offset)[0], offset + 8
+
+
+def _encode_hex(value, out: bytearray):
+    # Hex strings travel as their raw bytes, half the size.
+    raw = bytes.fromhex(value)
+    out += U16.pack(len(raw))
+    out += raw
+
+
+def _decode_hex(data: bytes, offset: int):
+    (length,) = U16.unpack_from(data, offset)
+    offset += 2
+    if offset + length > len(data):
+        raise ProtocolError("Truncated bytes field")
+    return data[offset : offset + length].hex(), offset + length
+
+
+def _encode_users(value, out: bytearray):
+    # [{"id": ..., "name": ...}, ...] as a u16 count of (id, name) pairs.
+    if not isinstance(value, list):
+        raise TypeError(value)
+    out += U16.pack(len(value))
+    for user in value:
+        if len(user) != 2:
+            raise ValueError(user)
+        _encode_id(user["id"], out)
+        _encode_str(user["name"], out)
+
+
+def _decode_users(data: bytes, offset: int):
+    (count,) = U16.unpack_from(data, offset)
+    offset += 2
+    users = []
+    for _ in range(count):
+        user_id, offset = _decode_id(data, offset)
+        name, offset = _decode_str(data, offset)
+        users.append({"id": user_id, "name": name})
+    return users, offset
+
+
+def _encode_ids(value, out: bytearray):
+    # A list of ids as a u16 count of u16s.
+    if not isinstance(value, list):
+        raise TypeError(value)
+    out += U16.pack(len(value))
+    for item in value:
+        _encode_id(item, out)
+
+
+def _decode_ids(data: bytes, offset: int):
+    (count,) = U16.unpack_from(data, offset)
+    offset += 2
+    ids = []
+    for _ in range(count):
+        item, offset = _decode_id(data, offset)
+        ids.append(item)
+    return ids, offset
+
+
+def _encode_chat(value, out: bytearray):
+    # [{"user": ..., "message": ...}, ...] as a u16 count of (user, message) pairs.
+    if not isinstance(value, list):
+        raise TypeError(value)
+    out += U16.pack(len(value))
+    for item in value:
+        if len(item) != 2:
+            raise ValueError(item)
+        _encode_str(item["user"], out)
+        _encode_str(item["message"], out)
+
+
+def _decode_chat(data: bytes, offset: int):
+    (count,) = U16.unpack_from(data, offset)
+    offset += 2
+    items = []
+    for _ in range(count):
+        user, offset = _decode_str(data, offset)
+        message, offset = _decode_str(data, offset)
+        items.append({"user": user, "message": message})
+    return items, offset
+
+
+def _encode_frames(value, out: bytearray):
+    # Already encoded messages, as a u16 count of u16 length-prefixed frames;
+    # they decode to a list of message dicts.
+    if not isinstance(value, list):
+        raise TypeError(value)
+    out += U16.pack(len(value))
+    for frame in value:
+        if not isinstance(frame, bytes):
+            raise TypeError(frame)
+        out += U16.pack(len(frame))
+        out += frame
+
+
+_ENCODERS = {
+    "id": _encode_id,
+    "str": _encode_str,
+    "bool": _encode_bool,
+    "users": _encode_users,
+    "ids": _encode_ids,
+    "chat": _encode_chat,
+    "hex": _encode_hex,
+    "u32": _encode_u32,
+    "u64": _encode_u64,
+    "frames": _encode_frames,
+}
+_DECODERS = {
+    "id": _decode_id,
+    "str": _decode_str,
+    "bool": _decode_bool,
+    "users": _decode_users,
+    "ids": _decode_ids,
+    "chat": _decode_chat,
+    "hex": _decode_hex,
+    "u32": _decode_u32,
+    "u64": _decode_u64,
+}
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:1] == b"\xb1"
+
+
+class Codec:
+    # Encodes and decodes the messages of one task. Each message is an
+    # (opcode, request, fields) tuple: requests are matched on their
+    # "request" value, replies and pushes (request None) on their keys, and
+    # fields are (name, kind) pairs in wire order.
+    def __init__(self, messages):
+        # "frames" holds whole messages of this same table, so it decodes
+        # through this codec.
+        decoders = {**_DECODERS, "frames": self._decode_frames}
+        # Lookup tables with the field codecs resolved up front.
+        self.by_opcode: dict = {}
+        self.by_request: dict = {}
+        self.by_keys: dict = {}
+        for opcode, request, fields in messages:
+            self.by_opcode[opcode] = (
+                request,
+                tuple((name, decoders[kind]) for name, kind in fields),
+            )
+            encoded = tuple((name, _ENCODERS[kind]) for name, kind in fields)
+            if request is None:
+                keys = frozenset(name for name, _ in fields)
+                self.by_keys.setdefault(keys, []).append((opcode, encoded))
+            else:
+                self.by_request.setdefault(request, []).append((opcode, encoded))
+
+    def encode(self, body: dict):
+        # Returns None when the message has no binary form.
+        request = body.get("request")
+        if request is None:
+            candidates = self.by_keys.get(frozenset(body), ())
+        else:
+            candidates = self.by_request.get(request, ())
+
+        for opcode, fields in candidates:
+            if len(body) != len(fields) + (request is not None):
+                continue
+
+            out = bytearray(HEADER.pack(MAGIC, VERSION, opcode))
+            try:
+                for name, encoder in fields:
+                    encoder(body[name], out)
+            except (KeyError, TypeError, ValueError, struct.error):
+                continue
+            return bytes(out)
+
+        return None
+
+    def decode(self, data: bytes) -> dict:
+        try:
+            magic, version, opcode = HEADER.unpack_from(data)
+        except struct.error:
+            raise ProtocolError("Truncated header")
+
+        if magic != MAGIC:
+            raise ProtocolError("Not a binary frame")
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if opcode not in self.by_opcode:
+            raise ProtocolError(f"Unknown opcode {opcode}")
+
+        request, fields = self.by_opcode[opcode]
+        body = {} if request is None else {"request": request}
+        offset = HEADER.size
+        try:
+            for name, decoder in fields:
+                body[name], offset = decoder(data, offset)
+        except ProtocolError:
+            raise
+        except (struct.error, ValueError):
+            # ValueError covers bad utf-8 and bad JSON inside a frames field.
+            raise ProtocolError("Malformed frame")
+
+        if offset != len(data):
+            raise ProtocolError("Trailing bytes after frame")
+        return body
+
+    def dumps(self, body: dict, binary: bool = False) -> bytes:
+        if binary:
+            data = self.encode(body)
+            if data is not None:
+                return data
+        return json.dumps(body).encode()
+
+    def loads(self, data: bytes) -> dict:
+        if is_binary(data):
+            return self.decode(data)
+        return json.loads(data)
+
+    def _decode_frames(self, data: bytes, offset: int):
+        (count,) = U16.unpack_from(data, offset)
+        offset += 2
+        frames = []
+        for _ in range(count):
+            (length,) = U16.unpack_from(data, offset)
+            offset += 2
+            if offset + length > len(data):
+                raise ProtocolError("Truncated frame field")
+            frames.append(self.loads(data[offset : offset + length]))
+            offset += length
+        return frames, offset
+
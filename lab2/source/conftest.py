@@ -0,0 +1,35 @@
+import os
+import sys
+
+# Each directory here is a set of script-style modules imported by bare name,
+# and the tasks share names like protocol, server and client. Before the
+# tests of one directory are imported, modules loaded from another directory
+# are forgotten and this one goes first on the path, so that each test gets
+# its own task's modules. Tests that need a clock they can move import Clock
+# from here.
+HERE = os.path.dirname(os.path.abspath(__file__))
+_current = [None]
+
+
+def pytest_pycollect_makemodule(module_path, parent):
+    directory = os.path.dirname(os.path.abspath(module_path))
+    if directory == _current[0]:
+        return None
+    _current[0] = directory
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None) or ""
+        if path.startswith(HERE + os.sep) and os.path.dirname(path) not in (HERE, directory):
+            del sys.modules[name]
+    if directory in sys.path:
+        sys.path.remove(directory)
+    sys.path.insert(0, directory)
+    return None
+
+
+class Clock:
+    # A time source that only moves when a test moves it.
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import socket
+from collections import deque
+
+import fanout
+from common.metrics import DUMP_INTERVAL
+from server import ChatServer
+
+# Datagrams drained per readiness callback before yielding to the loop.
+READ_BATCH = 64
+# Kernel receive buffer; bursts from thousands of clients overflow the default.
+RECV_BUFFER = 4 << 20
+# Datagrams waiting for the socket. Past WRITE_QUEUE_HIGH new chat messages
+# are turned away, and past WRITE_QUEUE_MAX datagrams are dropped outright,
+# so a backlog shows up as shed requests rather than as latency.
+WRITE_QUEUE_HIGH = 8192
+WRITE_QUEUE_MAX = 65536
+
+
+# Same handler table and wire format as ChatServer, but replies and fan-out
+# are queued on the datagram transport instead of blocking the receive loop.
+class AsyncChatServer(ChatServer, asyncio.DatagramProtocol):
+    def create_socket(self, ip: str, port: int):
+        # The transport is handed to us in connection_made.
+        return None
+
+    def connection_made(self, transport):
+        self.socket = self.meter(transport)
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.metrics.gauge("write_queue", lambda: len(getattr(transport, "_pending", ())))
+        self.metrics.gauge("write_queue_dropped", lambda: getattr(transport, "dropped", 0))
+        self.tick_sessions()
+
+    def datagram_received(self, data: bytes, addr):
+        self.metrics.received(len(data))
+        self.handle(data, addr)
+        if self.coalescer is not None and self.coalescer.pending and self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.coalescer.timeout() or 0, self.flush_rooms
+            )
+
+    def overloaded(self) -> bool:
+        return len(getattr(self.socket, "_pending", ())) >= WRITE_QUEUE_HIGH
+
+    def tick_sessions(self):
+        self.expire_sessions()
+        asyncio.get_running_loop().call_later(self.sessions.timeout(), self.tick_sessions)
+
+    def flush_rooms(self):
+        self.flush_handle = None
+        self.coalescer.flush()  # type: ignore
+
+    def error_received(self, exc: Exception):
+        # ICMP errors for clients that went away; nothing to recover.
+        pass
+
+
+class BatchedDatagramTransport(asyncio.BaseTransport):
+    # asyncio's own datagram transport runs one loop iteration per datagram.
+    # This one drains up to READ_BATCH datagrams per wakeup and only falls
+    # back to a write queue when the socket buffer is full.
+    def __init__(self, loop, sock: socket.socket, protocol: asyncio.DatagramProtocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._pending: deque = deque()
+        self.dropped = 0  # Datagrams that found the write queue full.
+        self._sock.setblocking(False)
+        self._loop.add_reader(self._sock.fileno(), self._read_ready)
+        self._protocol.connection_made(self)
+
+    def _read_ready(self):
+        recvfrom = self._sock.recvfrom
+        received = self._protocol.datagram_received
+        for _ in range(READ_BATCH):
+            try:
+                data, addr = recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                continue
+            received(data, addr)
+
+    def sendto(self, data: bytes, addr):
+        if not self._pending:
+            try:
+                self._sock.sendto(data, addr)
+                return
+            except (BlockingIOError, InterruptedError):
+                self._loop.add_writer(self._sock.fileno(), self._write_ready)
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                return
+        elif len(self._pending) >= WRITE_QUEUE_MAX:
+            self.dropped += 1
+            return
+        self._pending.append((data, addr))
+
+    def sendto_many(self, data: bytes, destinations: fanout.Destinations) -> int:
+        sent = 0
+        if not self._pending:
+            sent = fanout.send_batch(self._sock, data, destinations)
+        for address in destinations.addresses[sent:]:
+            self.sendto(data, address)
+        return len(destinations)
+
+    def _write_ready(self):
+        while self._pending:
+            data, addr = self._pending[0]
+            try:
+                self._sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+            self._pending.popleft()
+        self._loop.remove_writer(self._sock.fileno())
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        return default
+
+    def is_closing(self) -> bool:
+        return self._sock.fileno() == -1
+
+    def close(self):
+        if self.is_closing():
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        if self._pending:
+            self._loop.remove_writer(self._sock.fileno())
+        self._sock.close()
+        self._protocol.connection_lost(None)
+
+
+async def serve(
+    ip: str = "0.0.0.0",
+    port: int = 2055,
+    stats_file: str | None = None,
+    stats_interval: float = DUMP_INTERVAL,
+):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    sock.bind((ip, port))
+    server = AsyncChatServer(ip, port)
+    if stats_file:
+        server.metrics.dump_every(stats_file, stats_interval)
+    transport = BatchedDatagramTransport(loop, sock, server)
+    try:
+        await asyncio.Future()
+    finally:
+        transport.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat room server on asyncio.")
+    parser.add_argument("--ip", default="0.0.0.0", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=2055, help="Port for clients.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=DUMP_INTERVAL)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.ip, args.port, args.stats_file, args.stats_interval))
@@ -0,0 +1,114 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import coalesce
+import protocol
+from client import Client
+
+# Rate limits off: the one sender pastes far faster than a person types.
+SERVER = (
+    "import coalesce, server; s = server.ChatServer(port={port}); s.limits = None; "
+    "s.coalescer = coalesce.Coalescer({window}) if {window} else None; s.listen()"
+)
+
+
+class CountingSocket:
+    # Counts the datagrams a client sends.
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sent = 0
+
+    def sendto(self, data: bytes, address):
+        self.sent += 1
+        return self.sock.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def drain(sock: socket.socket) -> tuple[int, int]:
+    # (datagrams, messages) waiting on a member's socket.
+    datagrams = messages = 0
+    sock.setblocking(False)
+    while True:
+        try:
+            data, _ = sock.recvfrom(65535)
+        except BlockingIOError:
+            return datagrams, messages
+        datagrams += 1
+        messages += len(protocol.loads(data).get("bundle", [None]))
+
+
+def run(port: int, server_window: float, client_window: float, members: int, bursts: int, lines: int):
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER.format(port=port, window=server_window)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+    )
+    time.sleep(0.5)
+    Client.server_address = ("127.0.0.1", port)
+    try:
+        sender = Client("bot", "b000", binary=True, coalesce=client_window or None)
+        sender.con = CountingSocket(sender.con)
+        room_id = sender.request_to_create_room("busy")
+
+        listeners = []
+        for index in range(members - 1):
+            member = Client(f"m{index}", f"{index + 1:04x}", binary=True)
+            member.con.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            member.subscribe(room_id)
+            listeners.append(member)
+        time.sleep(0.3)
+        for member in listeners:
+            drain(member.con)
+        sender.con.sent = 0
+
+        start = time.perf_counter()
+        for burst in range(bursts):
+            # A bot pasting `lines` lines at once.
+            for line in range(lines):
+                sender.send_to_room(room_id, f"burst {burst} line {line} " + "x" * 40)
+            time.sleep(0.02)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.3)
+
+        datagrams = messages = 0
+        for member in listeners:
+            received = drain(member.con)
+            datagrams += received[0]
+            messages += received[1]
+        return sender.con.sent, datagrams, messages, elapsed
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Datagrams per message with and without coalescing.")
+    parser.add_argument("--port", type=int, default=2081)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--window-ms", type=float, default=coalesce.WINDOW * 1000)
+    args = parser.parse_args()
+
+    window = args.window_ms / 1000
+    expected = args.bursts * args.lines * (args.members - 1)
+    print("%-20s%14s%16s%14s%14s" % ("coalescing", "sent dgrams", "fan-out dgrams", "delivered", "fan-out pps"))
+    for name, server_window, client_window in (
+        ("off", 0, 0),
+        ("client only", 0, window),
+        ("server only", window, 0),
+        ("client + server", window, window),
+    ):
+        sent, datagrams, messages, elapsed = run(
+            args.port, server_window, client_window, args.members, args.bursts, args.lines
+        )
+        print(
+            "%-20s%14d%16d%8d/%-5d%14.0f"
+            % (name, sent, datagrams, messages, expected, datagrams / elapsed)
+        )
@@ -0,0 +1,61 @@
+import argparse
+import json
+import socket
+import time
+
+import fanout
+
+RECEIVERS = 16
+
+
+def per_user_encode(sock: socket.socket, payload: dict, addresses: list):
+    # The original ChatRoom.publish loop.
+    for address in addresses:
+        sock.sendto(json.dumps(payload).encode(), address)
+
+
+def encode_once(sock: socket.socket, payload: dict, addresses: list):
+    data = json.dumps(payload).encode()
+    for address in addresses:
+        sock.sendto(data, address)
+
+
+def batched(sock: socket.socket, payload: dict, destinations: fanout.Destinations):
+    fanout.sendto_many(sock, json.dumps(payload).encode(), destinations)
+
+
+def measure(publish, sock, payload, target, duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < duration:
+        publish(sock, payload, target)
+        count += 1
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Messages/sec versus room size.")
+    parser.add_argument("--duration", type=float, default=1.0)
+    args = parser.parse_args()
+
+    # Members are spread over a few sockets that are never read, so the kernel
+    # drops what does not fit and the sender never blocks on a slow reader.
+    receivers = []
+    for _ in range(RECEIVERS):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receivers.append(receiver)
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = {"user": "bench", "message": "x" * 64}
+
+    print("%-10s%18s%18s%18s" % ("members", "per-user encode", "encode once", "sendmmsg"))
+    for size in (1, 10, 100, 1_000, 5_000, 20_000):
+        addresses = [receivers[i % RECEIVERS].getsockname() for i in range(size)]
+        destinations = fanout.Destinations(addresses)
+        rates = [
+            measure(per_user_encode, sender, payload, addresses, args.duration),
+            measure(encode_once, sender, payload, addresses, args.duration),
+            measure(batched, sender, payload, destinations, args.duration),
+        ]
+        print("%-10d" % size + "".join("%14.1f m/s" % rate for rate in rates))
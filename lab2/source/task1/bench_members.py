@@ -0,0 +1,92 @@
+import argparse
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from members import Members
+from user import User
+
+
+@dataclass
+class OldUser:
+    # User as rooms stored it before the registry: a dataclass with a
+    # __dict__, one per room the user was in.
+    id: Optional[str]
+    name: Optional[str]
+    address: Any
+    binary: bool = False
+
+
+def subscriptions(users: int, per_user: int, room_size: int):
+    # Yields (room id, user id, name, address) for every membership, with
+    # fresh strings each time as a parsed request would have. Each user
+    # joins per_user different rooms.
+    rooms = max(per_user, users * per_user // room_size)
+    room_ids = [f"{index:06x}" for index in range(rooms)]
+    stride = rooms // per_user
+    for user in range(users):
+        for k in range(per_user):
+            host = "10.%d.%d.%d" % (user >> 16 & 255, user >> 8 & 255, user & 255)
+            address = (host, 10000 + user % 50000)
+            yield room_ids[(user + k * stride) % rooms], "u%d" % user, "user%d" % user, address
+
+
+def old_layout(users: int, per_user: int, room_size: int):
+    # ChatRoom.users and ChatServer.user_rooms as they were.
+    rooms: dict[str, dict] = {}
+    user_rooms: dict[str, set] = {}
+    for room_id, user_id, name, address in subscriptions(users, per_user, room_size):
+        rooms.setdefault(room_id, {})[user_id] = OldUser(user_id, name, address)
+        user_rooms.setdefault(user_id, set()).add(room_id)
+    return rooms, user_rooms
+
+
+def new_layout(users: int, per_user: int, room_size: int):
+    # What ChatServer.join_room keeps: the registry and each room's set of
+    # indexes.
+    members = Members()
+    rooms: dict[str, set] = {}
+    for room_id, user_id, name, address in subscriptions(users, per_user, room_size):
+        index, _ = members.join(User(user_id, name, address), room_id)
+        rooms.setdefault(room_id, set()).add(index)
+    return rooms, members
+
+
+def measure(build, users: int, per_user: int, room_size: int) -> tuple[float, float]:
+    # (bytes per subscription, microseconds per subscription)
+    # Timed without tracing, which slows allocation down several times.
+    gc.collect()
+    start = time.perf_counter()
+    kept = build(users, per_user, room_size)
+    elapsed = time.perf_counter() - start
+    del kept
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(users, per_user, room_size)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    count = users * per_user
+    return size / count, elapsed / count * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory per room membership, old layout versus the registry.")
+    parser.add_argument("--subscriptions", type=int, default=1_000_000)
+    parser.add_argument("--room-size", type=int, default=1000)
+    parser.add_argument("--rooms-per-user", type=int, nargs="*", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    print("%-14s%-10s%16s%16s%14s%14s" % ("rooms/user", "users", "old B/sub", "new B/sub", "old us/sub", "new us/sub"))
+    for per_user in args.rooms_per_user:
+        users = args.subscriptions // per_user
+        old_bytes, old_time = measure(old_layout, users, per_user, args.room_size)
+        new_bytes, new_time = measure(new_layout, users, per_user, args.room_size)
+        print(
+            "%-14d%-10d%16.1f%16.1f%14.2f%14.2f"
+            % (per_user, users, old_bytes, new_bytes, old_time, new_time)
+        )
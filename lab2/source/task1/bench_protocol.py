@@ -0,0 +1,56 @@
+import argparse
+import json
+import time
+
+import protocol
+
+MESSAGES = {
+    "send-message": {
+        "user_name": "alice",
+        "id": "3f2a",
+        "request": "send-message",
+        "room_id": "9c41",
+        "message": "hello everyone, how is it going?",
+    },
+    "subscribe": {"name": "alice", "id": "3f2a", "request": "subscribe", "room_id": "9c41"},
+    "chat push": {"user": "alice", "message": "hello everyone, how is it going?"},
+    "room-exists reply": {"success": True, "exists": True},
+}
+
+
+def rate(function, argument, duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < duration:
+        for _ in range(1000):
+            function(argument)
+        count += 1000
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binary versus JSON wire format.")
+    parser.add_argument("--duration", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(
+        "%-20s%8s%8s%14s%14s%14s%14s"
+        % ("message", "json B", "bin B", "json enc/s", "bin enc/s", "json dec/s", "bin dec/s")
+    )
+    for name, body in MESSAGES.items():
+        as_json = protocol.dumps(body)
+        as_binary = protocol.dumps(body, binary=True)
+        assert protocol.loads(as_binary) == body
+
+        print(
+            "%-20s%8d%8d%14.0f%14.0f%14.0f%14.0f"
+            % (
+                name,
+                len(as_json),
+                len(as_binary),
+                rate(lambda b: json.dumps(b).encode(), body, args.duration),
+                rate(protocol.encode, body, args.duration),
+                rate(json.loads, as_json, args.duration),
+                rate(protocol.decode, as_binary, args.duration),
+            )
+        )
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+from chatroom import ChatRoom
+from server import ChatServer
+from user import User
+
+
+class NullSocket:
+    def sendto(self, data: bytes, address):
+        pass
+
+
+class BenchServer(ChatServer):
+    def __init__(self):
+        super().__init__()
+        # The same few senders hit every request many times over.
+        self.limits = None
+
+    def create_socket(self, ip: str, port: int):
+        return NullSocket()
+
+
+def populate(server: ChatServer, rooms: int, members: int):
+    for index in range(rooms):
+        room_id = f"{index:06x}"
+        room = ChatRoom(room_id, room_id, server.socket, server.members)
+        server.rooms[room_id] = room
+        server.directory.put(room_id, room_id)
+        for member in range(members):
+            user_id = f"{index}-{member}"
+            server.join_room(room, User(user_id, user_id, ("127.0.0.1", 9)))
+
+
+def time_request(server: ChatServer, body: dict, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        server.dispatch(body, ("127.0.0.1", 9))
+    return (time.perf_counter() - start) / iterations
+
+
+def run(rooms: int, members: int, iterations: int) -> dict:
+    server = BenchServer()
+    populate(server, rooms, members)
+    # Target the most recently added room, the worst case for a linear scan.
+    room_id = f"{rooms - 1:06x}"
+
+    results = {
+        "room-exists": time_request(
+            server, {"request": "room-exists", "room_id": room_id}, iterations
+        ),
+        "send-message": time_request(
+            server,
+            {
+                "request": "send-message",
+                "user_name": "bench",
+                "id": "bench",
+                "room_id": room_id,
+                "message": "hello",
+            },
+            iterations,
+        ),
+        # The whole table is O(rooms), so it gets fewer iterations.
+        "list-rooms": time_request(
+            server, {"request": "list-rooms"}, max(1, iterations // 100)
+        ),
+        "list-rooms page": time_request(
+            server, {"request": "list-rooms", "cursor": room_id[:3]}, iterations
+        ),
+        "list-rooms delta": time_request(
+            server,
+            {"request": "list-rooms", "since": server.directory.version - 1},
+            iterations,
+        ),
+    }
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        server.dispatch(
+            {"request": "subscribe", "name": "bench", "id": "bench", "room_id": room_id},
+            ("127.0.0.1", 9),
+        )
+        server.dispatch(
+            {"request": "unsubscribe", "name": "bench", "id": "bench", "room_id": room_id},
+            ("127.0.0.1", 9),
+        )
+    results["subscribe+unsubscribe"] = (time.perf_counter() - start) / iterations
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request cost versus room count.")
+    parser.add_argument("--members", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    sizes = [10, 100, 1_000, 10_000, 100_000]
+    results = {size: run(size, args.members, args.iterations) for size in sizes}
+
+    requests = list(results[sizes[0]])
+    print("%-8s" % "rooms" + "".join("%24s" % request for request in requests))
+    for size, timings in results.items():
+        print(
+            "%-8d" % size
+            + "".join("%21.2f us" % (timings[r] * 1e6) for r in requests)
+        )
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+import protocol
+from client import Client
+from common import loadstat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINES = {
+    "blocking": "from server import ChatServer; ChatServer(port={port}).listen()",
+    "asyncio": "import asyncio, async_server; asyncio.run(async_server.serve(port={port}))",
+    "sharded": "import sharded_server; sharded_server.serve(port={port})",
+}
+
+
+def items(data: bytes) -> list:
+    try:
+        response = protocol.loads(data)
+    except ValueError:
+        return []
+    if "bundle" in response:
+        return response["bundle"]
+    return [response]
+
+
+def join(client: Client, room_id: str):
+    # Subscribe has no reply, so wait for our own join notification to make
+    # sure the request was not dropped.
+    joined = f"{client.name} joined the room."
+    client.con.settimeout(0.5)
+    while True:
+        client.subscribe(room_id)
+        try:
+            while True:
+                data, _ = client.con.recvfrom(65535)
+                if any(item.get("message") == joined for item in items(data)):
+                    return
+        except socket.timeout:
+            pass
+
+
+def shed_counts(port: int) -> dict | None:
+    # Requests the server turned away, by reason. Under the sharded engine
+    # only the worker that picks up the request answers.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        try:
+            sock.sendto(json.dumps({"request": "stats"}).encode(), ("127.0.0.1", port))
+            return json.loads(sock.recv(65535)).get("shed")
+        except (OSError, ValueError):
+            return None
+
+
+def run(
+    engine: str,
+    port: int,
+    clients: int,
+    room_size: int,
+    rate: float,
+    duration: float,
+    size: int,
+    binary: bool,
+    flood: float = 0.0,
+) -> dict:
+    server = loadstat.start_server(ENGINES[engine].format(port=port), HERE)
+    Client.server_address = ("127.0.0.1", port)
+    members, rooms = [], []
+    flooder = None
+    try:
+        for index in range(clients):
+            client = Client(f"c{index}", f"{index:04x}", binary)
+            client.con.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            if index % room_size == 0:
+                client.con.settimeout(5)
+                rooms.append(client.request_to_create_room(f"r{len(rooms)}"))
+            else:
+                join(client, rooms[-1])
+            members.append(client)
+
+        # One client spamming the first room, which the others should not
+        # notice beyond that room's own messages.
+        if flood:
+            flooder = Client("flood", f"{clients:04x}", binary)
+            join(flooder, rooms[0])
+
+        # Let the join notifications settle before measuring.
+        time.sleep(0.5)
+        for client in members:
+            client.con.setblocking(False)
+            try:
+                while client.con.recv(65535):
+                    pass
+            except BlockingIOError:
+                pass
+
+        padding = "x" * max(0, size - 32)
+        # Every member of a room gets each message, its sender included.
+        fanout = [min(room_size, clients - start) for start in range(0, clients, room_size)]
+        expected = [0]
+        delivered = [0]
+        flood_due = [0.0]
+
+        def send(n: int):
+            client = members[n % clients]
+            room = (n % clients) // room_size
+            expected[0] += fanout[room]
+            client.send_to_room(rooms[room], f"{time.perf_counter()}|{padding}")
+            # Flood messages carry no timestamp and are not counted.
+            flood_due[0] += flood / rate
+            while flood_due[0] >= 1:
+                flood_due[0] -= 1
+                flooder.send_to_room(rooms[0], padding)
+
+        def receive(index: int, data: bytes) -> list:
+            latencies = []
+            now = time.perf_counter()
+            for item in items(data):
+                stamp, _, _ = str(item.get("message", "")).partition("|")
+                if "user" in item and stamp:
+                    try:
+                        latencies.append(now - float(stamp))
+                    except ValueError:
+                        continue
+            delivered[0] += len(latencies)
+            return latencies
+
+        stats = loadstat.ProcessStats(server.pid)
+        stats.start()
+        sent, latencies, elapsed = loadstat.drive(
+            [client.con for client in members], send, receive, rate, duration
+        )
+        usage = stats.stop()
+        shed = shed_counts(port)
+    finally:
+        for client in members:
+            client.con.close()
+        if flooder is not None:
+            flooder.con.close()
+        loadstat.stop_server(server)
+
+    return loadstat.result(
+        "task1",
+        "rooms",
+        {
+            "engine": engine,
+            "wire": "binary" if binary else "json",
+            "clients": clients,
+            "room_size": room_size,
+            "offered_per_sec": rate,
+            "flood_per_sec": flood,
+            "message_bytes": size,
+            "sent": sent,
+        },
+        elapsed,
+        expected[0],
+        delivered[0],
+        latencies,
+        {**usage, "server_shed": shed},
+        units="deliveries",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ChatServer engines under simulated clients.")
+    parser.add_argument("--engine", choices=[*ENGINES, "all"], default="all")
+    parser.add_argument("--port", type=int, default=2155)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2000.0, help="Messages sent per second.")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--size", type=int, default=64, help="Message length in bytes.")
+    parser.add_argument("--wire", choices=["json", "binary", "both"], default="both")
+    parser.add_argument(
+        "--flood", type=float, default=0.0, help="Messages per second one extra client sends to the first room."
+    )
+    parser.add_argument("--out", help="Also append the results to this file.")
+    args = parser.parse_args()
+
+    engines = list(ENGINES) if args.engine == "all" else [args.engine]
+    wires = [False, True] if args.wire == "both" else [args.wire == "binary"]
+    for engine in engines:
+        for binary in wires:
+            loadstat.emit(
+                run(
+                    engine,
+                    args.port,
+                    args.clients,
+                    args.room_size,
+                    args.rate,
+                    args.duration,
+                    args.size,
+                    binary,
+                    args.flood,
+                ),
+                args.out,
+            )
@@ -1,29 +1,146 @@
+import json
+import os
 import socket
 from user import User
-import json
+
+import fanout
+import protocol
+from coalesce import Coalescer, Outbox
+from history import RoomHistory
+from members import Members
+
+# A subscriber's backfill is at most BACKFILL_MAX messages, sent in datagrams
+# of up to BACKFILL_DATAGRAM bytes.
+BACKFILL_MAX = 256
+BACKFILL_DATAGRAM = 16 << 10
+# A departure notice names at most this many members and counts the rest.
+DEPARTURE_NAMES = 5
 
 
 class ChatRoom:
-    def __init__(self, room_id: str, name: str, server_socket: socket.socket):
+    def __init__(
+        self,
+        room_id: str,
+        name: str,
+        server_socket: socket.socket,
+        members: Members,
+        spill_dir: str | None = None,
+        coalescer: Coalescer | None = None,
+    ):
         self.room_id = room_id
         self.name = name
         self.socket = server_socket
-        self.users: list[User] = []
+        # Indexes of the members in the server's registry, which holds
+        # their names and addresses once for all the rooms they are in.
+        self.members = members
+        self.users: set[int] = set()
+        # Members grouped by wire format, rebuilt lazily after membership changes.
+        self.destinations: dict[bool, fanout.Destinations] | None = None
+        self.history = RoomHistory(
+            os.path.join(spill_dir, f"{room_id}.log") if spill_dir else None
+        )
+        # With a coalescer, messages wait in one outbox per wire format and
+        # reach every member of that format as one bundle.
+        self.coalescer = coalescer
+        self.outboxes: dict[bool, Outbox] = {}
 
-    def add_user(self, user: User):
-        self.users.append(user)
-        self.publish({"user": self.name, "message": f"{user.name} joined the room."})
+    def add_user(self, index: int):
+        # Held messages belong to the members that were there for them.
+        self.flush()
+        self.users.add(index)
+        self.destinations = None
+        name = self.members.names[index]
+        self.publish({"user": self.name, "message": f"{name} joined the room."})
 
-    def remove_user(self, user_id: str):
-        cur_user = self.users[0]
-        for user in self.users:
-            if user.id == user_id:
-                user = cur_user
-                break
+    def remove_user(self, index: int):
+        self.remove_users([index])
 
-        self.users.remove(user)
-        self.publish({"user": self.name, "message": f"{user.name} left the room."})
+    def remove_users(self, indexes: list) -> list:
+        # Drops several members with a single notice for all of them, and
+        # returns the ones that were here. Their entries in the registry
+        # must still be there.
+        users = [index for index in indexes if index in self.users]
+        if not users:
+            return []
+        self.flush()
+        self.users.difference_update(users)
+
+        self.destinations = None
+        names = ", ".join(str(self.members.names[index]) for index in users[:DEPARTURE_NAMES])
+        if len(users) > DEPARTURE_NAMES:
+            names += f" and {len(users) - DEPARTURE_NAMES} others"
+        self.publish({"user": self.name, "message": f"{names} left the room."})
+        return users
+
+    def groups(self) -> dict[bool, fanout.Destinations]:
+        if self.destinations is None:
+            addresses: dict[bool, list] = {}
+            binary, address = self.members.binary, self.members.addresses
+            for index in self.users:
+                addresses.setdefault(bool(binary[index]), []).append(address[index])
+            self.destinations = {
+                binary: fanout.Destinations(group) for binary, group in addresses.items()
+            }
+        return self.destinations
 
     def publish(self, payload: dict):
-        for user in self.users:
-            self.socket.sendto(json.dumps(payload).encode(), user.address)
+        payload = {**payload, "room_id": self.room_id, "seq": self.history.next_seq}
+        groups = self.groups()
+
+        # Encode once per wire format; every member gets the same bytes, and
+        # the binary form is what the history keeps.
+        frames = {binary: protocol.dumps(payload, binary) for binary in groups}
+        if self.coalescer is None:
+            for binary, destinations in groups.items():
+                fanout.sendto_many(self.socket, frames[binary], destinations)
+        else:
+            self.hold(frames)
+        self.history.append(frames.get(True) or protocol.dumps(payload, True))
+
+    def hold(self, frames: dict[bool, bytes]):
+        for binary, frame in frames.items():
+            outbox = self.outboxes.get(binary)
+            if outbox is None:
+                outbox = self.outboxes[binary] = Outbox(binary, self.coalescer.max_size)
+            elif not outbox.fits(frame):
+                self.send_outbox(binary, outbox)
+            outbox.add(frame)
+        self.coalescer.hold(self)
+
+    def flush(self):
+        for binary, outbox in self.outboxes.items():
+            self.send_outbox(binary, outbox)
+
+    def send_outbox(self, binary: bool, outbox: Outbox):
+        data = outbox.take()
+        destinations = self.groups().get(binary)
+        if data is not None and destinations is not None:
+            fanout.sendto_many(self.socket, data, destinations)
+
+    def backfill(self, user: User, history: int | None = None, since: int | None = None):
+        # Sends a subscriber the last `history` messages, or those from seq
+        # `since` on, packed into as few datagrams as fit.
+        if isinstance(since, int):
+            messages = self.history.since(since, BACKFILL_MAX)
+        elif isinstance(history, int) and history > 0:
+            messages = self.history.last(min(history, BACKFILL_MAX))
+        else:
+            return
+
+        batch, size, through = [], 0, 0
+        for seq, frame in messages:
+            # Binary members take the stored frames as they are.
+            item = frame if user.binary else protocol.loads(frame)
+            item_size = 2 + (len(frame) if user.binary else len(json.dumps(item)))
+            if batch and size + item_size > BACKFILL_DATAGRAM:
+                self.send_backfill(user, batch, through)
+                batch, size = [], 0
+            batch.append(item)
+            size += item_size
+            through = seq
+        if batch:
+            self.send_backfill(user, batch, through)
+
+    def send_backfill(self, user: User, batch: list, through: int):
+        body = {"room_id": self.room_id, "history": batch, "through": through}
+        self.socket.sendto(protocol.dumps(body, user.binary), user.address)
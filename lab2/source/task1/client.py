@@ -3,17 +3,72 @@ import json
 from uuid import uuid4
 import threading as th
 
+import protocol
+from coalesce import TimedOutbox
+from common import session
+from common.directory import DirectoryCache
+
+# How many earlier messages a first visit to a room shows.
+HISTORY = 20
+# Backfilled history arrives many messages to a datagram.
+BUFFER_SIZE = 65535
+
 
 class Client:
     server_address = ("0.0.0.0", 2055)
 
-    def __init__(self, name: str, id: str):
+    def __init__(
+        self, name: str, id: str, binary: bool = False, coalesce: float | None = None
+    ):
         self.name = name
         self.id = id
         self.con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.binary = binary and self.negotiate()
+        # Seconds room messages may wait to share a datagram; None sends each
+        # one right away.
+        self.coalesce = coalesce
+        self.outbox: TimedOutbox | None = None
+        self.last_seq: dict[str, int] = {}  # room id -> last message seen
+        # Our copy of the room directory, kept current by server pushes.
+        self.rooms = DirectoryCache("rooms")
 
     def reinit_connection(self):
+        self.outbox = None
+        # Pushes went to the old socket.
+        self.rooms.stale = True
         self.con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.binary:
+            self.binary = self.negotiate()
+
+    def negotiate(self) -> bool:
+        # Servers without binary support ignore "hello", so no reply means JSON.
+        body = {
+            "name": self.name,
+            "id": self.id,
+            "request": "hello",
+            "wire": protocol.VERSION,
+        }
+        self.con.sendto(json.dumps(body).encode(), Client.server_address)
+        self.con.settimeout(1)
+        try:
+            data, _ = self.con.recvfrom(1024)
+            response = protocol.loads(data)
+        except (socket.timeout, ValueError):
+            return False
+        finally:
+            self.con.settimeout(None)
+
+        return response.get("wire") == protocol.VERSION
+
+    def send(self, body: dict):
+        # Anything still held back goes first, to keep requests in order.
+        if self.outbox is not None:
+            self.outbox.flush()
+        self.con.sendto(protocol.dumps(body, self.binary), Client.server_address)
+
+    def heartbeat(self):
+        # Keeps us in our rooms while we are quiet.
+        self.send({"request": "heartbeat", "id": self.id})
 
     def request_to_create_room(self, room_name: str) -> str:
         body = {
@@ -22,10 +77,7 @@ class Client:
             "request": "create-room",
             "room_name": room_name,
         }
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
-
-        data, _ = self.con.recvfrom(1024)
-        response = json.loads(data.decode())
+        response = self.exchange(body)
 
         if response.get("success", None):
             return response.get("room_id")
@@ -39,7 +91,12 @@ class Client:
             "request": "subscribe",
             "room_id": room_id,
         }
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
+        # Back in a room we have seen: catch up on what was missed.
+        if room_id in self.last_seq:
+            body["since"] = self.last_seq[room_id] + 1
+        else:
+            body["history"] = HISTORY
+        self.send(body)
 
     def unsubscribe(self, room_id: str):
         body = {
@@ -48,7 +105,7 @@ class Client:
             "request": "unsubscribe",
             "room_id": room_id,
         }
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
+        self.send(body)
 
     def send_to_room(self, room_id: str, message: str):
         body = {
@@ -58,37 +115,60 @@ class Client:
             "room_id": room_id,
             "message": message,
         }
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
-
-    def list_chat_rooms(self):
-        body = {"name": self.name, "id": self.id, "request": "list-rooms"}
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
+        if self.coalesce is None:
+            self.send(body)
+            return
 
-        data, _ = self.con.recvfrom(1024)
-        response = json.loads(data.decode())
+        if self.outbox is None:
+            self.outbox = TimedOutbox(
+                self.con, Client.server_address, self.binary, self.coalesce
+            )
+        self.outbox.send(protocol.dumps(body, self.binary))
 
-        if response.get("success"):
-            print("%-6s\t%s" % ("ID", "Room Name"))
-            print(response.get("message"))
+    def exchange(self, body: dict) -> dict:
+        # Sends a request and returns its reply, applying directory pushes
+        # that arrive ahead of it.
+        self.send(body)
+        while True:
+            data, _ = self.con.recvfrom(1024)
+            response = protocol.loads(data)
+            if "directory" not in response:
+                return response
+            self.rooms.apply(response)
 
-    def room_exists(self, room_id: str) -> bool:
-        body = {
-            "name": self.name,
-            "id": self.id,
-            "request": "room-exists",
-            "room_id": room_id,
-        }
-        self.con.sendto(json.dumps(body).encode(), Client.server_address)
+    def poll(self):
+        # Applies the directory pushes that arrived while nobody was reading.
+        self.con.setblocking(False)
+        try:
+            while True:
+                try:
+                    data, _ = self.con.recvfrom(BUFFER_SIZE)
+                    response = protocol.loads(data)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except ValueError:
+                    continue
+                if "directory" in response:
+                    self.rooms.apply(response)
+        finally:
+            self.con.setblocking(True)
 
-        data, _ = self.con.recvfrom(1024)
-        response = json.loads(data.decode())
+    def sync_rooms(self) -> bool:
+        # Only a stale copy costs a round trip.
+        self.poll()
+        body = {"name": self.name, "id": self.id, "request": "list-rooms"}
+        return self.rooms.refresh(self.exchange, body)
 
-        if response.get("success"):
-            return response.get("exists")
+    def list_chat_rooms(self):
+        if self.sync_rooms():
+            print("%-6s\t%s" % ("ID", "Room Name"))
+            for room_id, name in sorted(self.rooms.entries.items()):
+                print("%-6s\t%s" % (room_id, name))
 
-        return False
+    def room_exists(self, room_id: str) -> bool:
+        return self.sync_rooms() and room_id in self.rooms.entries
 
-    def log_messages(self, room_id: int, stop_event: th.Event):
+    def log_messages(self, room_id: str, stop_event: th.Event):
         print("Logging messages...")
 
         while True:
@@ -96,17 +176,31 @@ class Client:
                 return
 
             try:
-                data, _ = self.con.recvfrom(1024)
-                response = json.loads(data)
-                print(f"\r[{response['user']}]: {response['message']}\n> ", end="")
+                data, _ = self.con.recvfrom(BUFFER_SIZE)
+                response = protocol.loads(data)
             except OSError:
-                pass
+                continue
+
+            for item in response.get("bundle", [response]):
+                if "directory" in item:
+                    self.rooms.apply(item)
+                    continue
+                if item.get("success") is False:
+                    # The server turned a message of ours away.
+                    print(f"\r{item.get('message')}\n> ", end="")
+                    continue
+                for message in item.get("history", [item]):
+                    print(f"\r[{message['user']}]: {message['message']}\n> ", end="")
+                seq = item.get("through", item.get("seq"))
+                if seq is not None:
+                    self.last_seq[room_id] = seq
 
 
 if __name__ == "__main__":
     name = input("Enter your name: ")
     user_id = str(uuid4()).split("-")[1]
-    client = Client(name, user_id)
+    client = Client(name, user_id, binary=True)
+    session.keep_alive(client.heartbeat)
     joined_room_id = None
     is_chatting = False
     update_thread = None
@@ -129,7 +223,7 @@ if __name__ == "__main__":
                 room_name = input("Enter room name: ")
                 room_id = client.request_to_create_room(room_name)
 
-                if room_id is None:
+                if not room_id:
                     print(
                         "\nUnable to create room at the moment. Please try again later.\n"
                     )
@@ -0,0 +1,494 @@
+import argparse
+import base64
+import bisect
+import errno
+import hashlib
+import json
+import multiprocessing
+import selectors
+import signal
+import socket
+import sys
+import time
+
+from chatroom import ChatRoom
+from common.metrics import DUMP_INTERVAL
+from sharded_server import ROUTED_REQUESTS, PeerChatServer
+from user import User
+
+# Rooms spread over ChatServer nodes that may sit on different hosts. Each
+# room belongs to the node its id hashes to on a ring of the nodes, so adding
+# or removing a node only moves the rooms of the ring arcs that change hands.
+# Nodes serve clients on their own port and reach each other on a peer port:
+# over UDP for forwarded requests and cluster changes, and over TCP for
+# handing rooms over, members and recent history included.
+#
+# A node starts alone or joins through any node already in the cluster, and
+# leaves by handing its rooms to the others when it is stopped. Changes go
+# one at a time; a node that dies without leaving loses its rooms.
+#
+# Handovers run on the same selector as client traffic, so a slow peer holds
+# up only the rooms it is taking. Requests for a room on its way between
+# nodes wait on both sides until it has landed.
+
+# Points each node gets on the ring; more spread rooms more evenly.
+VNODES = 64
+# Seconds a room handover may take before it is given up.
+HANDOFF_TIMEOUT = 5.0
+# Seconds between attempts to join through the seed node.
+JOIN_RETRY = 1.0
+# Requests a room in flight holds before it sheds the rest.
+HELD_MAX = 1024
+
+
+def ring_hash(key: str) -> int:
+    # Has to agree across processes and hosts, unlike hash().
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def parse_node(node: str) -> tuple[str, int]:
+    host, _, port = node.rpartition(":")
+    return host, int(port)
+
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes: int = VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted(
+            (ring_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(vnodes)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str | None:
+        # The first node clockwise from the key's hash.
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[index]
+
+
+class Handover:
+    # Rooms moving over one TCP connection. Going out, node is where they
+    # go and data what is left to send; coming in, received gathers them.
+    def __init__(self, conn: socket.socket, node: str | None = None, data: bytes = b"", room_ids=()):
+        self.conn = conn
+        self.node = node
+        self.data = memoryview(data)
+        self.room_ids = list(room_ids)
+        self.received = bytearray()
+        self.deadline = time.monotonic() + HANDOFF_TIMEOUT
+
+
+class ClusterChatServer(PeerChatServer):
+    # node is "host:port" of this node's peer port as the others reach it.
+    def __init__(
+        self,
+        node: str,
+        ip: str = "0.0.0.0",
+        port: int = 2055,
+        seed: str | None = None,
+    ):
+        self.ip = ip
+        self.ring = HashRing([node])
+        self.epoch = 0  # Bumped by every change to the ring.
+        self.seed = seed
+        self.joined = seed is None
+        self.join_sent = 0.0
+        self.ring_changed = 0.0
+        super().__init__(node, ip, port)
+
+        self.selector: selectors.BaseSelector | None = None
+        self.handovers: dict[socket.socket, Handover] = {}
+        # room_id -> (body, message, address) of requests waiting for the
+        # room to arrive here or to land on its new node.
+        self.held: dict[str, list] = {}
+        self.handoff_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.handoff_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.handoff_socket.bind((ip, parse_node(node)[1]))
+        self.handoff_socket.listen()
+        self.handoff_socket.setblocking(False)
+        self.metrics.gauge("nodes", lambda: len(self.ring.nodes))
+        self.metrics.gauge("handovers", lambda: len(self.handovers))
+
+    def create_peer_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.ip, parse_node(self.index)[1]))
+        return sock
+
+    def owner(self, room_id: str) -> str | None:
+        return self.ring.owner(room_id)
+
+    def peers(self) -> list[str]:
+        return [node for node in self.ring.nodes if node != self.index]
+
+    def send_peer(self, node: str, data: bytes):
+        try:
+            self.peer_socket.sendto(data, parse_node(node))
+        except OSError as e:
+            self.log("Unable to reach node %s: %s", node, e)
+
+    def read_client(self):
+        if self.joined:
+            super().read_client()
+            return
+        # Clients wait until the node is in the ring, so that it has no
+        # rooms of its own to hand over while others hand theirs to it.
+        self.socket.recvfrom(4096)
+
+    def register(self, selector: selectors.BaseSelector):
+        super().register(selector)
+        self.selector = selector
+        selector.register(self.handoff_socket, selectors.EVENT_READ, self.read_handoff)
+
+    def housekeeping(self):
+        super().housekeeping()
+        now = time.monotonic()
+        if not self.joined and now - self.join_sent >= JOIN_RETRY:
+            self.join_sent = now
+            self.send_peer(self.seed, f"join {self.index}\n".encode())
+
+        for handover in list(self.handovers.values()):
+            if now >= handover.deadline:
+                self.finish_handover(handover, TimeoutError("timed out"))
+        if self.held and now - self.ring_changed >= HANDOFF_TIMEOUT:
+            # Rooms that never arrived; their requests get the usual refusal.
+            for room_id in [room_id for room_id in self.held if room_id not in self.rooms]:
+                self.release_held(room_id)
+
+    def route(self, body: dict, message: bytes, address, forwarded: bool = False):
+        request_type = body.get("request")
+        room_id = body.get("room_id")
+        if (
+            isinstance(request_type, str)
+            and request_type in ROUTED_REQUESTS
+            and isinstance(room_id, str)
+            and self.in_flight(room_id)
+        ):
+            held = self.held.setdefault(room_id, [])
+            if len(held) >= HELD_MAX:
+                self.metrics.dropped("handover")
+            else:
+                held.append((body, message, address))
+            return
+        super().route(body, message, address, forwarded)
+
+    def in_flight(self, room_id: str) -> bool:
+        # Leaving this node, or owned here since the last ring change but
+        # not handed over yet.
+        if room_id in self.rooms:
+            return room_id in self.held
+        return (
+            self.owner(room_id) == self.index
+            and time.monotonic() - self.ring_changed < HANDOFF_TIMEOUT
+        )
+
+    def release_held(self, room_id: str, node: str | None = None):
+        # Runs the requests a room held here, or passes them on to node.
+        for body, message, address in self.held.pop(room_id, []):
+            if node is None:
+                self.dispatch(body, address)
+            else:
+                self.forward(node, message, address)
+
+    def handle_peer(self, data: bytes, address):
+        header, _, payload = data.partition(b"\n")
+        kind, *args = header.decode().split()
+
+        if kind == "join":
+            self.add_node(args[0])
+        elif kind == "nodes":
+            self.apply_ring(int(args[0]), json.loads(payload))
+        else:
+            super().handle_peer(data, address)
+
+    def add_node(self, node: str):
+        if node in self.ring.nodes:
+            # A retry whose answer was lost.
+            self.send_peer(node, self.ring_message())
+            return
+        self.change_ring([*self.ring.nodes, node])
+        # The new node gets the directory; its rooms follow from every node
+        # that now hands some over.
+        entries = [
+            {"room_id": room_id, "name": name} for room_id, name in self.directory.entries.items()
+        ]
+        self.hand_off(node, entries)
+
+    def leave(self):
+        # Hands every room to the nodes that remain.
+        others = self.peers()
+        if others:
+            self.change_ring(others)
+        # The handovers run on the selector, which listen no longer drives.
+        while self.handovers:
+            for key, _ in self.selector.select(self.timeout()):
+                key.data()
+            self.housekeeping()
+
+    def change_ring(self, nodes: list[str]):
+        epoch = self.epoch + 1
+        message = self.ring_message(epoch, nodes)
+        for node in set(nodes) | set(self.ring.nodes):
+            if node != self.index:
+                self.send_peer(node, message)
+        self.apply_ring(epoch, nodes)
+
+    def ring_message(self, epoch: int | None = None, nodes: list | None = None) -> bytes:
+        if epoch is None:
+            epoch, nodes = self.epoch, self.ring.nodes
+        return f"nodes {epoch}\n".encode() + json.dumps(nodes).encode()
+
+    def apply_ring(self, epoch: int, nodes: list[str]):
+        if epoch <= self.epoch:
+            return
+        self.epoch = epoch
+        self.ring = HashRing(nodes)
+        self.ring_changed = time.monotonic()
+        self.joined = self.joined or self.index in nodes
+        self.log("Cluster epoch %d: %s", epoch, " ".join(self.ring.nodes))
+        self.rebalance()
+
+    def rebalance(self):
+        # Hands over the rooms that now belong to other nodes.
+        moving: dict[str, list] = {}
+        for room_id in self.rooms:
+            owner = self.owner(room_id)
+            if owner != self.index and room_id not in self.held:
+                moving.setdefault(owner, []).append(room_id)
+
+        for node, room_ids in moving.items():
+            states = [self.room_state(self.rooms[room_id]) for room_id in room_ids]
+            self.hand_off(node, states, room_ids)
+
+    def room_state(self, room: ChatRoom) -> dict:
+        # Held messages go out before the room leaves.
+        room.flush()
+        members = self.members
+        return {
+            "room_id": room.room_id,
+            "name": room.name,
+            "next_seq": room.history.next_seq,
+            "history": [
+                [seq, base64.b64encode(data).decode()]
+                for seq, data in room.history.last(len(room.history))
+            ],
+            "members": [
+                [members.ids[index], members.names[index], *members.addresses[index], members.binary[index]]
+                for index in room.users
+            ],
+        }
+
+    def hand_off(self, node: str, states: list[dict], room_ids=()):
+        # Sends rooms, or bare directory entries, as JSON lines. The rooms
+        # stay here, holding their requests, until the other node has taken
+        # them all.
+        data = b"".join(json.dumps(state).encode() + b"\n" for state in states)
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+        handover = Handover(conn, node, data, room_ids)
+        for room_id in room_ids:
+            self.held.setdefault(room_id, [])
+        self.handovers[conn] = handover
+        self.selector.register(conn, selectors.EVENT_WRITE, lambda: self.send_handover(handover))
+
+        error = conn.connect_ex(parse_node(node))
+        if error not in (0, errno.EINPROGRESS):
+            self.finish_handover(handover, OSError(error, "connect failed"))
+
+    def send_handover(self, handover: Handover):
+        try:
+            sent = handover.conn.send(handover.data)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # A failed connect shows up here too.
+            self.finish_handover(handover, e)
+            return
+        handover.data = handover.data[sent:]
+        if not handover.data:
+            handover.conn.shutdown(socket.SHUT_WR)
+            self.selector.modify(
+                handover.conn, selectors.EVENT_READ, lambda: self.read_handover(handover)
+            )
+
+    def read_handoff(self):
+        try:
+            conn, _ = self.handoff_socket.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        handover = Handover(conn)
+        self.handovers[conn] = handover
+        self.selector.register(conn, selectors.EVENT_READ, lambda: self.read_handover(handover))
+
+    def read_handover(self, handover: Handover):
+        # Both ends read to the end of the stream: the rooms on the way in,
+        # the "ok" on the way out.
+        try:
+            data = handover.conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.finish_handover(handover, e)
+            return
+        if data:
+            handover.received += data
+            return
+
+        if handover.node is not None:
+            error = None if handover.received == b"ok" else OSError("handover refused")
+            self.finish_handover(handover, error)
+            return
+        try:
+            states = [json.loads(line) for line in handover.received.splitlines()]
+        except ValueError as e:
+            self.finish_handover(handover, e)
+            return
+        for state in states:
+            if "members" in state:
+                self.adopt_room(state)
+            elif self.directory.put(state["room_id"], state["name"]):
+                self.notify_watchers(state["room_id"])
+        try:
+            handover.conn.send(b"ok")
+        except OSError:
+            pass
+        self.finish_handover(handover)
+
+    def finish_handover(self, handover: Handover, error: Exception | None = None):
+        del self.handovers[handover.conn]
+        self.selector.unregister(handover.conn)
+        handover.conn.close()
+
+        if handover.node is None:
+            if error is not None:
+                self.log("Incomplete handover: %s", error)
+        elif error is not None:
+            # The rooms stay here and run what they held.
+            self.log("Unable to hand over to %s: %s", handover.node, error)
+            for room_id in handover.room_ids:
+                self.release_held(room_id)
+        else:
+            for room_id in handover.room_ids:
+                self.release_room(self.rooms[room_id])
+                self.release_held(room_id, handover.node)
+
+    def adopt_room(self, state: dict):
+        room = ChatRoom(
+            state["room_id"], state["name"], self.socket, self.members, self.history_dir, self.coalescer
+        )
+        self.rooms[room.room_id] = room
+        if self.directory.put(room.room_id, room.name):
+            self.notify_watchers(room.room_id)
+        room.history.restore(
+            [(seq, base64.b64decode(data)) for seq, data in state["history"]], state["next_seq"]
+        )
+        # Members move without join notices; to them nothing happened.
+        for user_id, name, host, port, binary in state["members"]:
+            address = (host, port)
+            room.users.add(self.add_member(room, User(user_id, name, address, bool(binary))))
+            if binary:
+                self.binary_peers.add(address)
+        self.release_held(room.room_id)
+
+    def release_room(self, room: ChatRoom):
+        del self.rooms[room.room_id]
+        for index in room.users:
+            user_id = self.members.ids[index]
+            if self.members.leave(user_id, room.room_id):
+                self.sessions.discard(user_id)
+
+    def stats(self, body: dict, address):
+        # Each node counts only its own share of the clients and rooms.
+        snapshot = {
+            **self.metrics.snapshot(),
+            "node": self.index,
+            "nodes": self.ring.nodes,
+            "epoch": self.epoch,
+        }
+        self.socket.sendto(json.dumps(snapshot).encode(), address)
+
+
+def run_node(
+    ip: str,
+    host: str,
+    port: int,
+    peer_port: int,
+    seed: str | None,
+    stats_file: str | None = None,
+    stats_interval: float = DUMP_INTERVAL,
+):
+    server = ClusterChatServer(f"{host}:{peer_port}", ip, port, seed)
+    if stats_file:
+        server.metrics.dump_every(stats_file, stats_interval)
+    # Stopping a node hands its rooms to the rest of the cluster.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    try:
+        server.listen()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.leave()
+
+
+def serve_local(nodes: int, port: int = 2055, peer_port: int = 3055):
+    # A cluster of processes on this host for trying it out: node n serves
+    # clients on port + n and peers on peer_port + n, and joins through
+    # node 0.
+    seed = f"127.0.0.1:{peer_port}"
+    processes = []
+    for index in range(nodes):
+        process = multiprocessing.Process(
+            target=run_local_node,
+            args=("127.0.0.1", "127.0.0.1", port + index, peer_port + index, seed if index else None),
+        )
+        process.start()
+        processes.append(process)
+        # Joins go one at a time.
+        time.sleep(0.5)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # One at a time, so each leaving node has live ones to hand to.
+        for process in reversed(processes):
+            process.terminate()
+            process.join()
+
+
+def run_local_node(*args):
+    # Ctrl-C reaches every process; the supervisor stops the nodes in turn.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_node(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server node of a cluster.")
+    parser.add_argument("--ip", default="0.0.0.0", help="Address to listen on.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address other nodes reach this one at.")
+    parser.add_argument("--port", type=int, default=2055, help="Port for clients.")
+    parser.add_argument("--peer-port", type=int, default=3055, help="Port for other nodes.")
+    parser.add_argument("--join", metavar="HOST:PORT", help="Peer port of a node in the cluster.")
+    parser.add_argument("--local", type=int, metavar="N", help="Run N nodes on this host instead.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=DUMP_INTERVAL)
+    args = parser.parse_args()
+
+    if args.local:
+        serve_local(args.local, args.port, args.peer_port)
+    else:
+        run_node(
+            args.ip,
+            args.host,
+            args.port,
+            args.peer_port,
+            args.join,
+            args.stats_file,
+            args.stats_interval,
+        )
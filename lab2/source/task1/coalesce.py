@@ -0,0 +1,111 @@
+import socket
+import threading
+import time
+
+import protocol
+
+# Messages for the same destination are held back for up to WINDOW seconds
+# and sent as one bundle of at most MAX_DATAGRAM bytes, which is what the
+# servers read per recvfrom.
+WINDOW = 0.002
+MAX_DATAGRAM = 1024
+
+
+class Outbox:
+    # Encoded messages in one wire format waiting to go out together.
+    def __init__(self, binary: bool, max_size: int = MAX_DATAGRAM):
+        self.binary = binary
+        self.max_size = max_size
+        self.frames: list[bytes] = []
+        self.size = protocol.BUNDLE_OVERHEAD
+
+    def fits(self, frame: bytes) -> bool:
+        return not self.frames or self.size + len(frame) + 2 <= self.max_size
+
+    def add(self, frame: bytes):
+        self.frames.append(frame)
+        self.size += len(frame) + 2
+
+    def take(self) -> bytes | None:
+        # The datagram to send, or None when empty; a lone message goes out
+        # as it is.
+        if not self.frames:
+            return None
+        if len(self.frames) == 1:
+            data = self.frames[0]
+        else:
+            data = protocol.bundle(self.frames, self.binary)
+        self.frames = []
+        self.size = protocol.BUNDLE_OVERHEAD
+        return data
+
+
+class Coalescer:
+    # Server side: the rooms holding messages back, flushed together once
+    # the first of them has waited `window` seconds. The server's receive
+    # loop asks for timeout() and calls flush() when it runs out.
+    def __init__(self, window: float = WINDOW, max_size: int = MAX_DATAGRAM):
+        self.window = window
+        self.max_size = max_size
+        self.pending: set = set()
+        self.deadline: float | None = None
+
+    def hold(self, room):
+        if not self.pending:
+            self.deadline = time.monotonic() + self.window
+        self.pending.add(room)
+
+    def timeout(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def flush(self):
+        pending, self.pending, self.deadline = self.pending, set(), None
+        for room in pending:
+            room.flush()
+
+
+class TimedOutbox:
+    # Client side: an Outbox for one socket and address with its own timer.
+    def __init__(
+        self,
+        sock: socket.socket,
+        address,
+        binary: bool,
+        window: float = WINDOW,
+        max_size: int = MAX_DATAGRAM,
+    ):
+        self.sock = sock
+        self.address = address
+        self.window = window
+        self.outbox = Outbox(binary, max_size)
+        self.lock = threading.Lock()
+        self.timer: threading.Timer | None = None
+
+    def send(self, frame: bytes):
+        with self.lock:
+            if not self.outbox.fits(frame):
+                self._flush()
+            self.outbox.add(frame)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        data = self.outbox.take()
+        if data is None:
+            return
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError:
+            # The connection was closed under us.
+            pass
@@ -0,0 +1,141 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+
+# Linux caps one sendmmsg call at UIO_MAXIOV messages.
+MAX_BATCH = 1024
+# Below this many recipients the ctypes call costs more than plain sendto.
+MIN_BATCH = 8
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    # No sendmmsg on this platform; fall back to one sendto per destination.
+    _sendmmsg = None
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _sockaddr_in(address) -> bytes:
+    host, port = address
+    return (
+        struct.pack("=H", socket.AF_INET)
+        + struct.pack("!H", port)
+        + socket.inet_aton(host)
+        + bytes(8)
+    )
+
+
+class Destinations:
+    # A fixed list of recipients. The sendmmsg header array is built once and
+    # every message header shares one iovec, so sending a new payload only
+    # repoints that iovec before handing the whole array to the kernel.
+    def __init__(self, addresses: list):
+        self.addresses = addresses
+        self._headers = None
+        self._iov = None
+        self._names = None
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def _build(self) -> bool:
+        if self._headers is not None:
+            return True
+
+        try:
+            names = b"".join(_sockaddr_in(address) for address in self.addresses)
+        except (OSError, TypeError, ValueError):
+            # Not plain IPv4 addresses; use sendto for this list.
+            return False
+
+        self._names = ctypes.create_string_buffer(names, len(names))
+        self._iov = _IOVec()
+        self._headers = (_MMsgHdr * len(self.addresses))()
+
+        base = ctypes.addressof(self._names)
+        iov = ctypes.pointer(self._iov)
+        for index, header in enumerate(self._headers):
+            header.msg_hdr.msg_name = base + index * 16
+            header.msg_hdr.msg_namelen = 16
+            header.msg_hdr.msg_iov = iov
+            header.msg_hdr.msg_iovlen = 1
+        return True
+
+    def sendmmsg(self, sock: socket.socket, data: bytes) -> int:
+        # Returns how many destinations were sent before the socket would block.
+        buffer = ctypes.c_char_p(data)
+        self._iov.iov_base = ctypes.cast(buffer, ctypes.c_void_p).value
+        self._iov.iov_len = len(data)
+
+        fd = sock.fileno()
+        size = ctypes.sizeof(_MMsgHdr)
+        base = ctypes.addressof(self._headers)
+        sent = 0
+        while sent < len(self.addresses):
+            count = min(MAX_BATCH, len(self.addresses) - sent)
+            result = _sendmmsg(fd, base + sent * size, count, 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return sent
+                if error == errno.EINTR:
+                    continue
+                # Drop the destination the kernel refused and carry on.
+                result = 1
+            sent += result
+        return sent
+
+
+def sendto_many(sock, data: bytes, destinations: Destinations) -> int:
+    # Transports can provide their own batched path.
+    if hasattr(sock, "sendto_many"):
+        return sock.sendto_many(data, destinations)
+    return send_batch(sock, data, destinations)
+
+
+def send_batch(sock: socket.socket, data: bytes, destinations: Destinations) -> int:
+    # Returns how many destinations were sent before the socket would block.
+    sent = 0
+    if (
+        _sendmmsg is not None
+        and len(destinations) >= MIN_BATCH
+        and sock.family == socket.AF_INET
+        and destinations._build()
+    ):
+        sent = destinations.sendmmsg(sock, data)
+
+    # sendmmsg never waits, even on a socket with a timeout, so it can stop
+    # part way through. sendto does wait out the timeout, so the rest go one
+    # at a time; on a non-blocking socket the first of them stops here too.
+    sendto = sock.sendto
+    addresses = destinations.addresses
+    for index in range(sent, len(addresses)):
+        try:
+            sendto(data, addresses[index])
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return index
+    return len(addresses)
@@ -0,0 +1,101 @@
+import os
+import struct
+
+# Recent messages of a room, kept as the encoded bytes that were sent so a
+# backfill never re-encodes them. A room holds at most HISTORY_MESSAGES
+# messages and HISTORY_BYTES bytes in memory, and nothing until its first
+# message, so memory grows with the number of rooms in fixed steps.
+HISTORY_MESSAGES = 64
+HISTORY_BYTES = 16 << 10
+
+# Evicted messages can spill to disk, SPILL_BATCH at a time, into a pair of
+# segment files per room: once the current one passes SPILL_SEGMENT bytes it
+# replaces the previous one and a new one is started.
+SPILL_BATCH = 16
+SPILL_SEGMENT = 256 << 10
+_RECORD = struct.Struct("!QH")  # seq, length
+
+
+class RoomHistory:
+    def __init__(self, spill_path: str | None = None):
+        self.spill_path = spill_path
+        self.slots: list | None = None
+        self.first_seq = 1  # Oldest message still in memory.
+        self.next_seq = 1
+        self.size = 0
+        self.spilled: list = []  # Evicted (seq, data) not yet written out.
+
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+
+    def append(self, data: bytes) -> int:
+        if self.slots is None:
+            self.slots = [None] * HISTORY_MESSAGES
+        while len(self) == HISTORY_MESSAGES or (len(self) and self.size + len(data) > HISTORY_BYTES):
+            self.evict()
+
+        seq = self.next_seq
+        self.slots[seq % HISTORY_MESSAGES] = data
+        self.size += len(data)
+        self.next_seq += 1
+        return seq
+
+    def restore(self, messages: list, next_seq: int):
+        # Carries on a history handed over by another server: messages are
+        # its newest (seq, data) in order, next_seq the seq it would give
+        # next.
+        self.first_seq = self.next_seq = messages[0][0] if messages else next_seq
+        for _, data in messages:
+            self.append(data)
+
+    def evict(self):
+        index = self.first_seq % HISTORY_MESSAGES
+        data = self.slots[index]
+        self.slots[index] = None
+        self.size -= len(data)
+        if self.spill_path is not None:
+            self.spilled.append((self.first_seq, data))
+            if len(self.spilled) == SPILL_BATCH:
+                self.spill()
+        self.first_seq += 1
+
+    def spill(self):
+        with open(self.spill_path, "ab") as f:
+            for seq, data in self.spilled:
+                f.write(_RECORD.pack(seq, len(data)))
+                f.write(data)
+            full = f.tell() >= SPILL_SEGMENT
+        self.spilled.clear()
+        if full:
+            os.replace(self.spill_path, self.spill_path + ".old")
+
+    def read_spilled(self, since: int):
+        for path in (self.spill_path + ".old", self.spill_path):
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            offset = 0
+            while offset + _RECORD.size <= len(data):
+                seq, length = _RECORD.unpack_from(data, offset)
+                offset += _RECORD.size
+                if seq >= since:
+                    yield seq, data[offset : offset + length]
+                offset += length
+        for seq, data in self.spilled:
+            if seq >= since:
+                yield seq, data
+
+    def since(self, seq: int, limit: int) -> list:
+        # Up to the newest limit messages from seq on, as (seq, data).
+        seq = max(seq, self.next_seq - limit)
+        messages = []
+        if self.spill_path is not None and seq < self.first_seq:
+            messages.extend(self.read_spilled(seq))
+        for current in range(max(seq, self.first_seq), self.next_seq):
+            messages.append((current, self.slots[current % HISTORY_MESSAGES]))
+        return messages
+
+    def last(self, count: int) -> list:
+        return self.since(self.next_seq - count, count)
@@ -0,0 +1,122 @@
+import sys
+
+from user import User
+
+
+class Members:
+    # Every user in any room, stored once however many rooms they are in.
+    # A user is a small integer index into parallel lists, rooms keep sets
+    # of those indexes, and an index is reused once its user is in no room.
+    def __init__(self):
+        self.index: dict[str, int] = {}  # user id -> index
+        self.ids: list = []
+        self.names: list = []
+        self.addresses: list = []
+        self.binary = bytearray()
+        # The rooms of each user: one room id while they are in one room,
+        # which is most users, and a set only past that.
+        self.rooms: list = []
+        self.free: list[int] = []
+        self.subscriptions = 0
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, user_id) -> int | None:
+        return self.index.get(user_id)
+
+    def user(self, index: int) -> User:
+        return User(
+            self.ids[index], self.names[index], self.addresses[index], bool(self.binary[index])
+        )
+
+    def rooms_of(self, user_id) -> tuple | set:
+        index = self.index.get(user_id)
+        rooms = None if index is None else self.rooms[index]
+        if rooms is None:
+            return ()
+        return (rooms,) if isinstance(rooms, str) else rooms
+
+    def join(self, user: User, room_id: str) -> tuple[int, bool]:
+        # Returns the user's index and whether they now listen somewhere
+        # else, which leaves the destinations of their other rooms stale.
+        user_id = user.id or ""
+        address = intern_address(user.address)
+        index = self.index.get(user_id)
+        if index is None:
+            if self.free:
+                index = self.free.pop()
+                self.ids[index] = user_id
+                self.names[index] = user.name
+                self.addresses[index] = address
+                self.binary[index] = user.binary
+            else:
+                index = len(self.ids)
+                self.ids.append(user_id)
+                self.names.append(user.name)
+                self.addresses.append(address)
+                self.binary.append(user.binary)
+                self.rooms.append(None)
+            self.index[user_id] = index
+            moved = False
+        else:
+            moved = self.addresses[index] != address or self.binary[index] != user.binary
+            self.names[index] = user.name
+            self.addresses[index] = address
+            self.binary[index] = user.binary
+
+        rooms = self.rooms[index]
+        if rooms is None:
+            self.rooms[index] = room_id
+        elif isinstance(rooms, str):
+            if rooms == room_id:
+                return index, moved
+            self.rooms[index] = {rooms, room_id}
+        elif room_id in rooms:
+            return index, moved
+        else:
+            rooms.add(room_id)
+        self.subscriptions += 1
+        return index, moved
+
+    def leave(self, user_id, room_id: str) -> bool:
+        # Returns whether the user is now in no room at all.
+        index = self.index.get(user_id)
+        if index is None:
+            return False
+        rooms = self.rooms[index]
+        if isinstance(rooms, str):
+            if rooms != room_id:
+                return False
+            self.release(user_id, index)
+            return True
+        if room_id not in rooms:
+            return False
+        rooms.discard(room_id)
+        self.subscriptions -= 1
+        if len(rooms) == 1:
+            self.rooms[index] = next(iter(rooms))
+        return False
+
+    def drop(self, user_id):
+        index = self.index.get(user_id)
+        if index is not None:
+            self.release(user_id, index)
+
+    def release(self, user_id, index: int):
+        rooms = self.rooms[index]
+        self.subscriptions -= 1 if isinstance(rooms, str) else len(rooms)
+        del self.index[user_id]
+        self.ids[index] = self.names[index] = self.addresses[index] = None
+        self.rooms[index] = None
+        self.free.append(index)
+
+
+def intern_address(address):
+    # Clients behind one host share a single copy of its name.
+    if isinstance(address, tuple) and address and isinstance(address[0], str):
+        return (sys.intern(address[0]),) + address[1:]
+    return address
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import socket
+from collections import deque
+from uuid import uuid4
+
+import protocol
+from client import HISTORY, Client
+from common import session
+
+# Messages a room holds for a reader that has fallen behind; past this the
+# oldest are dropped, so a room nobody reads cannot grow without bound.
+QUEUE_SIZE = 1024
+# Seconds to wait for the reply to a request.
+REPLY_TIMEOUT = 2.0
+# Hundreds of rooms can deliver a burst at once, more than the default
+# socket buffer holds.
+RECV_BUFFER = 4 << 20
+# Requests that wait for their reply. The server names a request it turns
+# away, and only these have a reply waiting for the notice.
+AWAITED = {"hello", "create-room", "room-exists"}
+
+
+class Room:
+    # The messages of one room, read with `async for`. Iteration ends once
+    # the room is left or the client is closed.
+    def __init__(self, room_id: str, last_seq: int | None = None):
+        self.room_id = room_id
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        self.last_seq = last_seq
+        self.dropped = 0
+        self.rejected = 0  # Our messages, joins and leaves the server turned away.
+        self.closed = False
+
+    def put(self, message: dict | None):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    def deliver(self, message: dict):
+        seq = message.get("seq")
+        if isinstance(seq, int):
+            # Backfill can overlap what already arrived.
+            if self.last_seq is not None and seq <= self.last_seq:
+                return
+            self.last_seq = seq
+        self.put(message)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.put(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        if self.closed and self.queue.empty():
+            raise StopAsyncIteration
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+class RoomClient(asyncio.DatagramProtocol):
+    # A client in any number of rooms on one socket and no threads. Room
+    # messages name their room and go to that Room's queue; anything else
+    # answers the oldest request still waiting.
+    def __init__(self, name: str, id: str, server_address):
+        self.name = name
+        self.id = id
+        self.server_address = server_address
+        self.binary = False
+        self.transport: asyncio.DatagramTransport | None = None
+        self.rooms: dict[str, Room] = {}
+        self.last_seq: dict[str, int] = {}  # room id -> last message seen, for rooms left
+        # The server answers in order and replies carry no request id, so
+        # a reply that comes after its request timed out is taken for the
+        # next one's.
+        self.replies: deque[asyncio.Future] = deque()
+        self.heartbeats: asyncio.Task | None = None
+
+    @classmethod
+    async def connect(
+        cls, name: str, id: str, server_address=None, binary: bool = True
+    ) -> "RoomClient":
+        loop = asyncio.get_running_loop()
+        _, client = await loop.create_datagram_endpoint(
+            lambda: cls(name, id, server_address or Client.server_address),
+            local_addr=("0.0.0.0", 0),
+        )
+        if binary:
+            client.binary = await client.negotiate()
+        client.heartbeats = loop.create_task(client.keep_alive())
+        return client
+
+    async def __aenter__(self) -> "RoomClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+
+    def connection_lost(self, exc):
+        for room in self.rooms.values():
+            room.close()
+        while self.replies:
+            future = self.replies.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError("Client closed"))
+
+    def error_received(self, exc: Exception):
+        # An ICMP error for an earlier datagram; requests time out on their own.
+        pass
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            response = protocol.loads(data)
+        except ValueError:
+            return
+        for item in response.get("bundle", [response]):
+            self.dispatch(item)
+
+    def dispatch(self, item: dict):
+        dropped = item.get("dropped")
+        if dropped is not None and dropped not in AWAITED:
+            room = self.rooms.get(item.get("room_id"))
+            if room is not None:
+                room.rejected += 1
+        elif "history" in item:
+            room = self.rooms.get(item.get("room_id"))
+            if room is not None:
+                for message in item["history"]:
+                    room.deliver(message)
+        elif "seq" in item:
+            room = self.rooms.get(item.get("room_id"))
+            if room is not None:
+                room.deliver(item)
+        elif "directory" not in item:
+            room_id = item.get("room_id")
+            if item.get("success") and isinstance(room_id, str):
+                # A room we created and are in. Its join notice can be read
+                # before the request that made it wakes up.
+                self.rooms.setdefault(room_id, Room(room_id))
+            while self.replies:
+                future = self.replies.popleft()
+                if not future.done():
+                    future.set_result(item)
+                    break
+
+    def send(self, body: dict):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(protocol.dumps(body, self.binary), self.server_address)
+
+    async def request(self, body: dict, encoded: bytes | None = None) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append(future)
+        if encoded is None:
+            self.send(body)
+        elif self.transport is not None:
+            self.transport.sendto(encoded, self.server_address)
+        try:
+            return await asyncio.wait_for(future, REPLY_TIMEOUT)
+        finally:
+            if future in self.replies:
+                self.replies.remove(future)
+
+    async def negotiate(self) -> bool:
+        # Always asked in JSON; servers without binary support do not answer.
+        body = {"name": self.name, "id": self.id, "request": "hello", "wire": protocol.VERSION}
+        try:
+            response = await self.request(body, json.dumps(body).encode())
+        except asyncio.TimeoutError:
+            return False
+        return response.get("wire") == protocol.VERSION
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(session.HEARTBEAT)
+            self.send({"request": "heartbeat", "id": self.id})
+
+    async def create_room(self, room_name: str) -> Room | None:
+        # The server puts the creator in the new room.
+        body = {
+            "user_name": self.name,
+            "user_id": self.id,
+            "request": "create-room",
+            "room_name": room_name,
+        }
+        response = await self.request(body)
+        return self.rooms.get(response.get("room_id"))
+
+    async def room_exists(self, room_id: str) -> bool:
+        body = {"name": self.name, "id": self.id, "request": "room-exists", "room_id": room_id}
+        response = await self.request(body)
+        return bool(response.get("exists"))
+
+    def join(self, room_id: str, history: int = HISTORY) -> Room:
+        room = self.rooms.get(room_id)
+        if room is not None:
+            return room
+        last_seq = self.last_seq.pop(room_id, None)
+        room = self.rooms[room_id] = Room(room_id, last_seq)
+        body = {"name": self.name, "id": self.id, "request": "subscribe", "room_id": room_id}
+        # Back in a room we have seen: catch up on what was missed.
+        if last_seq is not None:
+            body["since"] = last_seq + 1
+        else:
+            body["history"] = history
+        self.send(body)
+        return room
+
+    def leave(self, room_id: str):
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return
+        self.send({"name": self.name, "id": self.id, "request": "unsubscribe", "room_id": room_id})
+        if room.last_seq is not None:
+            self.last_seq[room_id] = room.last_seq
+        room.close()
+
+    def say(self, room_id: str, message: str):
+        body = {
+            "user_name": self.name,
+            "id": self.id,
+            "request": "send-message",
+            "room_id": room_id,
+            "message": message,
+        }
+        self.send(body)
+
+    def close(self):
+        for room_id in list(self.rooms):
+            self.leave(room_id)
+        if self.heartbeats is not None:
+            self.heartbeats.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def follow(room_ids: list[str], create: int, name: str):
+    # Prints every message of every room it is in.
+    async with await RoomClient.connect(name, str(uuid4()).split("-")[1]) as client:
+        rooms = [client.join(room_id) for room_id in room_ids]
+        for index in range(create):
+            room = await client.create_room(f"{name}-{index}")
+            if room is not None:
+                print(f"Created room {room.room_id}")
+                rooms.append(room)
+
+        async def show(room: Room):
+            async for message in room:
+                print(f"[{room.room_id}] [{message['user']}]: {message['message']}")
+
+        await asyncio.gather(*(show(room) for room in rooms))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow many chat rooms from one socket.")
+    parser.add_argument("rooms", nargs="*", help="Ids of rooms to join.")
+    parser.add_argument("--create", type=int, default=0, help="Rooms to create as well.")
+    parser.add_argument("--name", default="bot")
+    args = parser.parse_args()
+    try:
+        asyncio.run(follow(args.rooms, args.create, args.name))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,77 @@
+from common import wire
+
+# task1's messages. The codec, and the layout of a frame, are in
+# common/wire.py, shared by every task.
+MESSAGES = [
+    # Requests, matched on their "request" value.
+    (1, "create-room", (("user_name", "str"), ("user_id", "id"), ("room_name", "str"))),
+    (2, "subscribe", (("name", "str"), ("id", "id"), ("room_id", "id"))),
+    (3, "unsubscribe", (("name", "str"), ("id", "id"), ("room_id", "id"))),
+    (
+        4,
+        "send-message",
+        (("user_name", "str"), ("id", "id"), ("room_id", "id"), ("message", "str")),
+    ),
+    (5, "list-rooms", (("name", "str"), ("id", "id"))),
+    (6, "room-exists", (("name", "str"), ("id", "id"), ("room_id", "id"))),
+    # Subscribing with a backfill of the last "history" messages, or of
+    # everything from seq "since" on.
+    (7, "subscribe", (("name", "str"), ("id", "id"), ("room_id", "id"), ("history", "u32"))),
+    (8, "subscribe", (("name", "str"), ("id", "id"), ("room_id", "id"), ("since", "u64"))),
+    # Paging through the directory from "cursor", or asking for the changes
+    # since "version"; see directory.py.
+    (9, "list-rooms", (("name", "str"), ("id", "id"), ("cursor", "str"))),
+    (10, "list-rooms", (("name", "str"), ("id", "id"), ("since", "u64"))),
+    # Keeps a session alive; see session.py.
+    (11, "heartbeat", (("id", "id"),)),
+    # Replies and pushes, matched on their keys.
+    (64, None, (("success", "bool"), ("message", "str"), ("room_id", "id"))),
+    (65, None, (("success", "bool"), ("message", "str"))),
+    (66, None, (("success", "bool"), ("exists", "bool"))),
+    (67, None, (("user", "str"), ("message", "str"))),
+    (68, None, (("user", "str"), ("message", "str"), ("seq", "u64"))),
+    (69, None, (("room_id", "id"), ("history", "frames"), ("through", "u64"))),
+    # Several messages coalesced into one datagram, in either direction.
+    (70, None, (("bundle", "frames"),)),
+    (
+        71,
+        None,
+        (("success", "bool"), ("rooms", "users"), ("cursor", "str"), ("version", "u64")),
+    ),
+    (
+        72,
+        None,
+        (("success", "bool"), ("added", "users"), ("removed", "ids"), ("version", "u64")),
+    ),
+    # Directory changes pushed to clients that list with a cursor or version.
+    (
+        73,
+        None,
+        (("directory", "str"), ("id", "id"), ("name", "str"), ("version", "u64")),
+    ),
+    (74, None, (("directory", "str"), ("id", "id"), ("version", "u64"))),
+    # A room message naming its room, so one socket can be in many rooms.
+    (75, None, (("user", "str"), ("message", "str"), ("room_id", "id"), ("seq", "u64"))),
+]
+
+ProtocolError = wire.ProtocolError
+VERSION = wire.VERSION
+is_binary = wire.is_binary
+
+_codec = wire.Codec(MESSAGES)
+encode = _codec.encode
+decode = _codec.decode
+dumps = _codec.dumps
+loads = _codec.loads
+
+
+# Upper bound on the bytes a bundle adds around its frames, plus two per frame.
+BUNDLE_OVERHEAD = 14
+
+
+def bundle(frames: list[bytes], binary: bool) -> bytes:
+    # Joins already encoded messages without decoding them again; a JSON
+    # bundle must be given JSON frames.
+    if binary:
+        return encode({"bundle": frames})
+    return b'{"bundle": [' + b", ".join(frames) + b"]}"
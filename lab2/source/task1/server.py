@@ -1,130 +1,407 @@
+import argparse
 import socket
 import json
+import time
 from uuid import uuid4
 
+import fanout
+import protocol
 from chatroom import ChatRoom
+from coalesce import Coalescer
+from common.directory import Directory
+from common.metrics import DUMP_INTERVAL, Metrics, MeteredSocket, RateLimitedLog
+from common.ratelimit import RateLimits
+from common.session import TimingWheel
+from members import Members
 from user import User
 
+# Requests per second and burst for each limit. Chat messages are data and
+# spend from the sender's address, user and room buckets; every other
+# request is control and spends only from its address's control bucket, so
+# a member over the data limits can still leave or list rooms. Joining,
+# leaving and creating rooms spend from a per-user bucket of their own,
+# large enough for one client to follow hundreds of rooms from one socket.
+LIMITS = {
+    "address": (100, 200),
+    "user": (20, 40),
+    "room": (200, 400),
+    "control": (50, 100),
+    "membership": (500, 2000),
+}
+DATA_REQUESTS = {"send-message"}
+MEMBERSHIP_REQUESTS = {"subscribe", "unsubscribe", "create-room"}
+
 
 def generate_unique_id() -> str:
     return str(uuid4()).split("-")[1]
 
 
+def unbundle(body) -> list:
+    # The requests in a datagram; a client may coalesce several into one
+    # bundle. Anything that is not a request comes back as None, for
+    # dispatch to refuse.
+    if not isinstance(body, dict):
+        return [None]
+    bundle = body.get("bundle", [body])
+    if not isinstance(bundle, list):
+        return [None]
+    return [item if isinstance(item, dict) else None for item in bundle]
+
+
 class ChatServer:
     def __init__(self, ip: str = "0.0.0.0", port: int = 2055):
         print("Initializing server")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((ip, port))
+        self.metrics = Metrics()
+        self.log = RateLimitedLog()
+        self.socket = self.meter(self.create_socket(ip, port))
         print(f"Server Listening on {ip}:{port}")
 
-        self.rooms: list[ChatRoom] = []
+        self.rooms: dict[str, ChatRoom] = {}
+        # room_id -> name of every room, for paged and delta listings.
+        self.directory = Directory("rooms")
+        # Where rooms spill history evicted from memory; None keeps only
+        # what fits in memory.
+        self.history_dir: str | None = None
+        # Set to coalesce room fan-out into bundles; None sends every message
+        # on its own.
+        self.coalescer: Coalescer | None = None
+        # Everyone in a room, stored once, with the rooms they are in so a
+        # user can be dropped from every room without scanning them all.
+        self.members = Members()
+        # Addresses that negotiated the binary wire format with "hello".
+        self.binary_peers: set = set()
+        # Members that go quiet for longer than the session TTL are dropped
+        # from their rooms.
+        self.sessions = TimingWheel()
+        # Set to None to take every request however fast it comes.
+        self.limits: RateLimits | None = RateLimits(LIMITS, self.metrics)
+        self.handlers = {
+            "hello": self.hello,
+            "create-room": self.create_room,
+            "send-message": self.send_message,
+            "list-rooms": self.list_rooms,
+            "room-exists": self.room_exists,
+            "subscribe": self.subscribe_user,
+            "unsubscribe": self.unsubscribe_user,
+            "stats": self.stats,
+            "heartbeat": self.heartbeat,
+        }
+        self.metrics.gauge("rooms", lambda: len(self.rooms))
+        self.metrics.gauge("members", lambda: len(self.members))
+        self.metrics.gauge("subscriptions", lambda: self.members.subscriptions)
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.metrics.gauge(
+            "rate_buckets", lambda: 0 if self.limits is None else len(self.limits)
+        )
+        self.metrics.gauge("watchers", lambda: len(self.directory.watchers))
+        self.metrics.gauge(
+            "held_rooms", lambda: 0 if self.coalescer is None else len(self.coalescer.pending)
+        )
+
+    def create_socket(self, ip: str, port: int):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((ip, port))
+        return sock
+
+    def meter(self, sock):
+        # Everything sent, rooms' fan-out included, goes through here.
+        if sock is None:
+            return None
+        return MeteredSocket(sock, self.metrics, fanout.sendto_many)
 
     def listen(self):
         print("Listening to receive messages")
         while True:
-            message, address = self.socket.recvfrom(1024)
-            message = message.decode()
-            body = json.loads(message)
-            print(f"Received from {address=} {body=}")
+            self.socket.settimeout(self.timeout())
+            try:
+                message, address = self.socket.recvfrom(1024)
+            except (socket.timeout, BlockingIOError):
+                self.housekeeping()
+                continue
+            self.metrics.received(len(message))
+            self.log("Received from address=%r message=%r", address, message)
+            self.handle(message, address)
+            self.housekeeping()
 
-            request_type = body.get("request")
+        self.socket.close()
 
-            if not request_type:
-                self.socket.sendto(
-                    json.dumps({"success": False, "message": "Invalid request"})
-                )
-                continue
+    def timeout(self) -> float:
+        # Until held messages or the next session tick are due.
+        timeout = self.sessions.timeout()
+        if self.coalescer is not None:
+            held = self.coalescer.timeout()
+            if held is not None:
+                timeout = min(timeout, held)
+        return timeout
 
-            if request_type == "create-room":
-                self.create_room(body, address)
-            elif request_type == "send-message":
-                self.send_message(body)
-            elif request_type == "list-rooms":
-                self.socket.sendto(
-                    json.dumps(
-                        {
-                            "success": True,
-                            "message": "\n".join(
-                                [
-                                    "%-6s\t%s" % (room.room_id, room.name)
-                                    for room in self.rooms
-                                ]
-                            ),
-                        }
-                    ).encode(),
-                    address,
-                )
-            elif request_type == "room-exists":
-                self.socket.sendto(
-                    json.dumps(
-                        {
-                            "success": True,
-                            "exists": any(
-                                room.room_id == body.get("room_id")
-                                for room in self.rooms
-                            ),
-                        }
-                    ).encode(),
-                    address,
+    def housekeeping(self):
+        if self.coalescer is not None and self.coalescer.timeout() == 0:
+            self.coalescer.flush()
+        self.expire_sessions()
+
+    def expire_sessions(self):
+        # Each room hears about all its expired members at once.
+        expired = self.sessions.expire()
+        if not expired:
+            return
+        departures: dict[str, list] = {}
+        for user_id in expired:
+            index = self.members.get(user_id)
+            for room_id in self.members.rooms_of(user_id):
+                departures.setdefault(room_id, []).append(index)
+        for room_id, indexes in departures.items():
+            self.rooms[room_id].remove_users(indexes)
+        for user_id in expired:
+            index = self.members.get(user_id)
+            if index is not None:
+                self.binary_peers.discard(self.members.addresses[index])
+                self.members.drop(user_id)
+
+    def handle(self, message: bytes, address):
+        try:
+            body = protocol.loads(message)
+        except protocol.ProtocolError as e:
+            self.metrics.errors += 1
+            # Always answered in JSON so an incompatible client can fall back.
+            self.socket.sendto(
+                json.dumps({"success": False, "message": str(e)}).encode(), address
+            )
+            return
+        except json.JSONDecodeError:
+            self.metrics.errors += 1
+            self.log("Invalid JSON received.")
+            return
+
+        for item in unbundle(body):
+            self.dispatch(item, address)
+
+    def dispatch(self, body: dict | None, address):
+        request_type = None if body is None else body.get("request")
+
+        if not request_type or not isinstance(request_type, str):
+            self.metrics.errors += 1
+            self.send({"success": False, "message": "Invalid request"}, address)
+            return
+
+        # Any request from a member keeps their session alive.
+        user_id = body.get("id") or body.get("user_id")
+        if isinstance(user_id, str) and user_id in self.members:
+            self.sessions.touch(user_id)
+
+        handler = self.handlers.get(request_type)
+        if handler is not None:
+            if not self.admit(body, request_type, address):
+                return
+            start = time.perf_counter()
+            handler(body, address)
+            self.metrics.handled(request_type, time.perf_counter() - start)
+
+    def admit(self, body: dict, request_type: str, address) -> bool:
+        # Sheds requests over their limits, and chat messages while replies
+        # are backing up, telling the client at most once a second.
+        room_id = body.get("room_id")
+        # These fields key the rate limits, so anything but a string is
+        # refused before it gets there.
+        for field in ("id", "user_id", "room_id"):
+            if not isinstance(body.get(field, ""), str):
+                self.metrics.errors += 1
+                self.send({"success": False, "message": f"Invalid {field}"}, address)
+                return False
+        if request_type in DATA_REQUESTS:
+            over = None
+            if self.limits is not None:
+                over = self.limits.check(
+                    ("address", address), ("user", body.get("id")), ("room", room_id)
                 )
-            elif request_type == "subscribe":
-                self.subscribe_user(body, address)
-            elif request_type == "unsubscribe":
-                self.unsubscribe_user(body)
+            if over is None and self.overloaded():
+                over = "overload"
+                self.metrics.dropped(over)
+        elif self.limits is None:
+            return True
+        elif request_type in MEMBERSHIP_REQUESTS:
+            user_id = body.get("id", body.get("user_id"))
+            over = self.limits.check(("membership", address if user_id is None else user_id))
+        else:
+            over = self.limits.check(("control", address))
+        if over is None:
+            return True
+
+        if self.limits is not None and self.limits.should_reply(address):
+            if over == "overload":
+                message = "Dropped: the server is overloaded, try again later."
             else:
-                pass
+                message = f"Dropped: over the {over} rate limit, slow down."
+            # "dropped" names the request, so that a client can tell this
+            # from the reply to a request of its own still waiting.
+            reply = {"success": False, "message": message, "dropped": request_type}
+            if isinstance(room_id, str):
+                # Lets a client in several rooms tell which one it was.
+                reply["room_id"] = room_id
+            self.send(reply, address)
+        return False
 
-        self.socket.close()
+    def overloaded(self) -> bool:
+        # Sends block here rather than queue up, so there is nothing to shed.
+        return False
+
+    def send(self, body: dict, address):
+        self.socket.sendto(protocol.dumps(body, address in self.binary_peers), address)
+
+    def hello(self, body: dict, address):
+        wire = body.get("wire")
+        wire = min(wire, protocol.VERSION) if isinstance(wire, int) else 0
+        if wire:
+            self.binary_peers.add(address)
+        else:
+            self.binary_peers.discard(address)
+        self.socket.sendto(json.dumps({"success": True, "wire": wire}).encode(), address)
+
+    def heartbeat(self, body: dict, address):
+        # dispatch has already renewed the session; there is no reply.
+        pass
+
+    def stats(self, body: dict, address):
+        # Always JSON; the snapshot has no binary form.
+        self.socket.sendto(json.dumps(self.metrics.snapshot()).encode(), address)
 
     def create_room(self, body: dict, address):
         user = User(
             id=body.get("user_id"),
             name=body.get("user_name"),
             address=address,
+            binary=address in self.binary_peers,
         )
-        room_id = generate_unique_id()
-        self.socket.sendto(
-            json.dumps(
-                {
-                    "success": True,
-                    "message": "Room created successfully",
-                    "room_id": room_id,
-                }
-            ).encode(),
+        room_id = self.new_room_id()
+        self.send(
+            {
+                "success": True,
+                "message": "Room created successfully",
+                "room_id": room_id,
+            },
             address,
         )
         room_name: str = body.get("room_name") or generate_unique_id()
-        room = ChatRoom(room_id, room_name, self.socket)
-        self.rooms.append(room)
-        room.add_user(user)
+        room = ChatRoom(
+            room_id, room_name, self.socket, self.members, self.history_dir, self.coalescer
+        )
+        self.rooms[room_id] = room
+        if self.directory.put(room_id, room_name):
+            self.notify_watchers(room_id)
+        self.join_room(room, user)
+        return room
+
+    def new_room_id(self) -> str:
+        room_id = generate_unique_id()
+        while room_id in self.rooms:
+            room_id = generate_unique_id()
+        return room_id
+
+    def join_room(self, room: ChatRoom, user: User):
+        room.add_user(self.add_member(room, user))
+
+    def add_member(self, room: ChatRoom, user: User) -> int:
+        # Records user as a member of room and returns their index; the
+        # room itself is left to the caller.
+        index, moved = self.members.join(user, room.room_id)
+        if moved:
+            # Every room of theirs has to send to the new address.
+            for room_id in self.members.rooms_of(user.id or ""):
+                self.rooms[room_id].destinations = None
+        self.sessions.touch(user.id or "")
+        return index
+
+    def leave_room(self, room: ChatRoom, user_id: str):
+        index = self.members.get(user_id)
+        if index is None:
+            return
+        room.remove_user(index)
+        if self.members.leave(user_id, room.room_id):
+            self.sessions.discard(user_id)
+
+    def is_member(self, user_id: str, room_id: str) -> bool:
+        return room_id in self.members.rooms_of(user_id)
 
-    def send_message(self, body: dict):
+    def remove_user_from_all_rooms(self, user_id: str):
+        self.sessions.discard(user_id)
+        index = self.members.get(user_id)
+        if index is None:
+            return
+        for room_id in self.members.rooms_of(user_id):
+            self.rooms[room_id].remove_user(index)
+        self.members.drop(user_id)
+
+    def list_rooms(self, body: dict, address):
+        if "cursor" in body or "since" in body:
+            self.directory.watch(address)
+            self.send(self.directory.reply(body), address)
+            return
+
+        # Clients that do not page get the whole table as one string.
+        self.send(
+            {
+                "success": True,
+                "message": "\n".join(
+                    [
+                        "%-6s\t%s" % (room_id, name)
+                        for room_id, name in self.directory.entries.items()
+                    ]
+                ),
+            },
+            address,
+        )
+
+    def notify_watchers(self, room_id: str):
+        # Pushes a directory change to the clients keeping a copy, encoded
+        # once per wire format.
+        event = self.directory.event(room_id)
+        frames: dict[bool, bytes] = {}
+        for address in self.directory.watching():
+            binary = address in self.binary_peers
+            if binary not in frames:
+                frames[binary] = protocol.dumps(event, binary)
+            self.socket.sendto(frames[binary], address)
+
+    def room_exists(self, body: dict, address):
+        self.send(
+            {"success": True, "exists": body.get("room_id") in self.rooms}, address
+        )
+
+    def send_message(self, body: dict, address):
         user_name = body["user_name"] or ""
         room_id = body["room_id"] or ""
         message = body["message"] or ""
 
-        for room in self.rooms:
-            if room.room_id == room_id:
-                room.publish({"user": user_name, "message": message})
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room.publish({"user": user_name, "message": message})
 
     def subscribe_user(self, payload, address):
-        user = User(payload["id"], payload["name"], address)
+        user = User(
+            payload["id"], payload["name"], address, address in self.binary_peers
+        )
 
-        for room in self.rooms:
-            if room.room_id == payload["room_id"]:
-                room.add_user(user)
-                break
+        room = self.rooms.get(payload["room_id"])
+        if room is not None:
+            # History first, so it reads in order before the join notice.
+            room.backfill(user, payload.get("history"), payload.get("since"))
+            self.join_room(room, user)
 
-    def unsubscribe_user(self, payload: dict):
+    def unsubscribe_user(self, payload: dict, address):
         user_id = payload.get("id") or ""
         room_id = payload.get("room_id") or ""
 
-        for room in self.rooms:
-            if room.room_id == room_id:
-                room.remove_user(user_id)
-                break
+        room = self.rooms.get(room_id)
+        if room is not None:
+            self.leave_room(room, user_id)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat room server.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=DUMP_INTERVAL)
+    args = parser.parse_args()
+
     server = ChatServer()
+    if args.stats_file:
+        server.metrics.dump_every(args.stats_file, args.stats_interval)
     server.listen()
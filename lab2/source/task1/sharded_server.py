@@ -0,0 +1,264 @@
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import zlib
+from abc import ABC, abstractmethod
+
+import protocol
+from common.metrics import DUMP_INTERVAL
+from server import ChatServer, unbundle
+
+# Requests that act on one room and must run on the worker that owns it.
+ROUTED_REQUESTS = {"send-message", "subscribe", "unsubscribe"}
+# Requests every worker needs to see, as the user may be in rooms on any of
+# them.
+BROADCAST_REQUESTS = {"heartbeat"}
+
+
+def room_owner(room_id: str, workers: int) -> int:
+    # crc32 rather than hash(): it has to agree across processes.
+    return zlib.crc32(room_id.encode()) % workers
+
+
+# A server holding some of the rooms, with peers holding the rest. Requests
+# for a room held elsewhere are forwarded to its owner, which replies to the
+# client directly. Subclasses say who owns a room and how to reach the peers.
+class PeerChatServer(ChatServer, ABC):
+    def __init__(self, index, ip: str = "0.0.0.0", port: int = 2055):
+        self.index = index  # This server's id among its peers.
+        super().__init__(ip, port)
+        # self.directory holds every room in the cluster, kept in sync with
+        # "room-created" announcements so list-rooms and room-exists are local.
+
+        self.peer_socket = self.create_peer_socket()
+
+    @abstractmethod
+    def create_peer_socket(self) -> socket.socket: ...
+
+    @abstractmethod
+    def owner(self, room_id: str): ...
+
+    @abstractmethod
+    def peers(self) -> list: ...
+
+    @abstractmethod
+    def send_peer(self, peer, data: bytes): ...
+
+    def listen(self):
+        selector = selectors.DefaultSelector()
+        self.register(selector)
+        while True:
+            for key, _ in selector.select(self.timeout()):
+                key.data()
+            self.housekeeping()
+
+    def register(self, selector: selectors.BaseSelector):
+        selector.register(self.socket, selectors.EVENT_READ, self.read_client)
+        selector.register(self.peer_socket, selectors.EVENT_READ, self.read_peer)
+
+    def read_client(self):
+        data, address = self.socket.recvfrom(4096)
+        self.metrics.received(len(data))
+        self.handle(data, address)
+
+    def read_peer(self):
+        try:
+            data, address = self.peer_socket.recvfrom(65535)
+        except ConnectionRefusedError:
+            # An earlier datagram found a peer gone; send_peer logs those.
+            return
+        self.handle_peer(data, address)
+
+    def handle(self, message: bytes, address, forwarded: bool = False):
+        # forwarded: it came from a peer, so it is never passed on again.
+        try:
+            body = protocol.loads(message)
+        except ValueError:
+            # Let ChatServer produce the error reply.
+            super().handle(message, address)
+            return
+
+        if isinstance(body, dict) and "bundle" not in body:
+            self.route(body, message, address, forwarded)
+            return
+        # The bundled requests may belong to rooms on different peers.
+        binary = address in self.binary_peers
+        for item in unbundle(body):
+            if item is None:
+                self.dispatch(item, address)
+            else:
+                self.route(item, protocol.dumps(item, binary), address, forwarded)
+
+    def route(self, body: dict, message: bytes, address, forwarded: bool = False):
+        request_type = body.get("request")
+        room_id = body.get("room_id") or ""
+        if not isinstance(request_type, str) or not isinstance(room_id, str):
+            # Malformed, so dispatch refuses it here.
+            self.dispatch(body, address)
+            return
+
+        if request_type in BROADCAST_REQUESTS and not forwarded:
+            for peer in self.peers():
+                self.forward(peer, message, address)
+        elif request_type in ROUTED_REQUESTS:
+            owner = self.owner(room_id)
+            if owner != self.index:
+                self.forward(owner, message, address)
+                return
+
+        self.dispatch(body, address)
+
+    def forward(self, owner, message: bytes, address):
+        binary = int(address in self.binary_peers)
+        header = f"forward {address[0]} {address[1]} {binary}\n".encode()
+        self.send_peer(owner, header + message)
+
+    def handle_peer(self, data: bytes, _):
+        header, _, payload = data.partition(b"\n")
+        kind, *args = header.decode().split()
+
+        if kind == "forward":
+            address = (args[0], int(args[1]))
+            # The wire format was negotiated with the peer that forwarded.
+            if args[2] == "1":
+                self.binary_peers.add(address)
+            else:
+                self.binary_peers.discard(address)
+            self.handle(payload, address, forwarded=True)
+        elif kind == "room-created":
+            room = json.loads(payload)
+            if self.directory.put(room["room_id"], room["name"]):
+                self.notify_watchers(room["room_id"])
+
+    def new_room_id(self) -> str:
+        # Keep rooms created here on this server so create-room never forwards.
+        while True:
+            room_id = super().new_room_id()
+            if self.owner(room_id) == self.index:
+                return room_id
+
+    def create_room(self, body: dict, address):
+        room = super().create_room(body, address)
+
+        announcement = b"room-created\n" + json.dumps(
+            {"room_id": room.room_id, "name": room.name}
+        ).encode()
+        for peer in self.peers():
+            self.send_peer(peer, announcement)
+
+        return room
+
+    def room_exists(self, body: dict, address):
+        self.send(
+            {"success": True, "exists": body.get("room_id") in self.directory}, address
+        )
+
+
+# One of N processes sharing the public port through SO_REUSEPORT. The kernel
+# spreads clients across workers, while each room lives on exactly one worker;
+# peers talk over unix datagram sockets and the owner replies from the shared
+# port.
+class ShardedChatServer(PeerChatServer):
+    def __init__(
+        self,
+        index: int,
+        workers: int,
+        run_dir: str,
+        ip: str = "0.0.0.0",
+        port: int = 2055,
+    ):
+        self.workers = workers
+        self.run_dir = run_dir
+        super().__init__(index, ip, port)
+
+    def create_socket(self, ip: str, port: int):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((ip, port))
+        return sock
+
+    def create_peer_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.peer_path(self.index))
+        return sock
+
+    def peer_path(self, index: int) -> str:
+        return os.path.join(self.run_dir, f"worker-{index}.sock")
+
+    def owner(self, room_id: str) -> int:
+        return room_owner(room_id, self.workers)
+
+    def peers(self) -> list[int]:
+        return [index for index in range(self.workers) if index != self.index]
+
+    def send_peer(self, index: int, data: bytes):
+        try:
+            self.peer_socket.sendto(data, self.peer_path(index))
+        except OSError as e:
+            self.log("Unable to reach worker %d: %s", index, e)
+
+    def stats(self, body: dict, address):
+        # Each worker counts only its own share of the clients.
+        snapshot = {**self.metrics.snapshot(), "worker": self.index, "workers": self.workers}
+        self.socket.sendto(json.dumps(snapshot).encode(), address)
+
+
+def run_worker(
+    index: int,
+    workers: int,
+    run_dir: str,
+    ip: str,
+    port: int,
+    stats_file: str | None,
+    stats_interval: float = DUMP_INTERVAL,
+):
+    server = ShardedChatServer(index, workers, run_dir, ip, port)
+    if stats_file:
+        server.metrics.dump_every(f"{stats_file}.{index}", stats_interval)
+    server.listen()
+
+
+def serve(
+    workers: int = os.cpu_count() or 1,
+    ip: str = "0.0.0.0",
+    port: int = 2055,
+    stats_file: str | None = None,
+    stats_interval: float = DUMP_INTERVAL,
+):
+    # With stats_file, worker n appends its snapshots to stats_file.n.
+    with tempfile.TemporaryDirectory(prefix="chat-workers-") as run_dir:
+        processes = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(index, workers, run_dir, ip, port, stats_file, stats_interval),
+            )
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        # Stop the workers too when the supervisor is asked to terminate.
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat room server sharded over SO_REUSEPORT workers.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--ip", default="0.0.0.0", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=2055, help="Port for clients.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=DUMP_INTERVAL)
+    args = parser.parse_args()
+
+    serve(args.workers, args.ip, args.port, args.stats_file, args.stats_interval)
@@ -0,0 +1,134 @@
+import json
+import selectors
+import socket
+import unittest
+
+from cluster import ClusterChatServer, HashRing
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class HashRingTest(unittest.TestCase):
+    keys = [f"room-{index}" for index in range(2000)]
+
+    def owners(self, ring: HashRing) -> dict:
+        return {key: ring.owner(key) for key in self.keys}
+
+    def test_empty_ring_owns_nothing(self):
+        self.assertIsNone(HashRing().owner("room"))
+
+    def test_owner_agrees_across_rings(self):
+        nodes = ["a:1", "b:1", "c:1"]
+        self.assertEqual(self.owners(HashRing(nodes)), self.owners(HashRing(reversed(nodes))))
+
+    def test_rooms_spread_over_nodes(self):
+        nodes = ["a:1", "b:1", "c:1", "d:1"]
+        owners = list(self.owners(HashRing(nodes)).values())
+        for node in nodes:
+            self.assertGreater(owners.count(node), len(self.keys) / 8)
+
+    def test_only_the_new_node_takes_rooms(self):
+        before = self.owners(HashRing(["a:1", "b:1", "c:1"]))
+        after = self.owners(HashRing(["a:1", "b:1", "c:1", "d:1"]))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == "d:1" for key in moved))
+
+    def test_only_the_leaving_nodes_rooms_move(self):
+        before = self.owners(HashRing(["a:1", "b:1", "c:1"]))
+        after = self.owners(HashRing(["a:1", "c:1"]))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(before[key] == "b:1" for key in moved))
+
+
+class HandoverTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = []
+        for _ in range(2):
+            server = ClusterChatServer(f"127.0.0.1:{free_port()}", "127.0.0.1", 0)
+            server.register(selectors.DefaultSelector())
+            self.nodes.append(server)
+        self.a, self.b = self.nodes
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        for server in self.nodes:
+            for conn in list(server.handovers):
+                conn.close()
+            server.selector.close()
+            server.socket.close()
+            server.peer_socket.close()
+            server.handoff_socket.close()
+        self.client.close()
+
+    def request(self, server: ClusterChatServer, body: dict):
+        server.handle(json.dumps(body).encode(), self.client.getsockname())
+
+    def receive(self) -> dict:
+        return json.loads(self.client.recv(65535))
+
+    def message(self, room_id: str) -> dict:
+        return {"request": "send-message", "id": "u1", "user_name": "ann", "room_id": room_id, "message": "hi"}
+
+    def run_until(self, done):
+        for _ in range(1000):
+            if done():
+                return
+            for server in self.nodes:
+                for key, _ in server.selector.select(0.01):
+                    key.data()
+        self.fail("cluster did not settle")
+
+    def room_for_b(self) -> str:
+        # A creates the room; B owns it once both are in the ring.
+        ring = HashRing([self.a.index, self.b.index])
+        while True:
+            self.request(self.a, {"request": "create-room", "user_id": "u1", "user_name": "ann"})
+            room_id = self.receive()["room_id"]
+            if ring.owner(room_id) == self.b.index:
+                return room_id
+
+    def test_adopt_and_release_a_room(self):
+        room_id = self.room_for_b()
+        self.request(self.a, self.message(room_id))
+        room = self.a.rooms[room_id]
+        state = self.a.room_state(room)
+
+        self.b.adopt_room(state)
+        adopted = self.b.rooms[room_id]
+        self.assertEqual(adopted.name, room.name)
+        self.assertEqual(adopted.history.next_seq, room.history.next_seq)
+        self.assertEqual(adopted.history.last(10), room.history.last(10))
+        self.assertEqual([self.b.members.ids[index] for index in adopted.users], ["u1"])
+        self.assertIn(room_id, self.b.directory)
+
+        self.a.release_room(room)
+        self.assertNotIn(room_id, self.a.rooms)
+        self.assertNotIn(room_id, self.a.members.rooms_of("u1"))
+        self.assertIn(room_id, self.a.directory)
+
+    def test_requests_wait_for_a_room_in_flight(self):
+        room_id = self.room_for_b()
+        seq = self.a.rooms[room_id].history.next_seq
+        nodes = [self.a.index, self.b.index]
+        self.b.apply_ring(1, nodes)
+        self.a.apply_ring(1, nodes)
+        self.assertIn(room_id, self.a.held)
+
+        self.request(self.a, self.message(room_id))
+        self.request(self.b, self.message(room_id))
+        self.assertEqual(len(self.a.held[room_id]), 1)
+        self.assertEqual(len(self.b.held[room_id]), 1)
+
+        self.run_until(lambda: not self.a.handovers and not self.b.handovers and not self.a.held)
+        self.assertNotIn(room_id, self.a.rooms)
+        self.assertIn(room_id, self.b.rooms)
+        # One from each node: B ran its own and the one A forwarded.
+        self.run_until(lambda: self.b.rooms[room_id].history.next_seq == seq + 2)
+        self.assertEqual(self.b.held, {})
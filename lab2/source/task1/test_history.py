@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+import history
+from history import RoomHistory
+
+
+def messages(count: int, size: int = 10) -> list[bytes]:
+    return [str(index).encode().ljust(size, b".") for index in range(count)]
+
+
+class RoomHistoryTest(unittest.TestCase):
+    def test_sequence_numbers(self):
+        room = RoomHistory()
+        self.assertEqual([room.append(data) for data in messages(3)], [1, 2, 3])
+        self.assertEqual(room.last(2), [(2, messages(3)[1]), (3, messages(3)[2])])
+        self.assertEqual(room.since(3, 10), [(3, messages(3)[2])])
+        self.assertEqual(room.since(4, 10), [])
+
+    def test_bounded_by_count(self):
+        room = RoomHistory()
+        sent = messages(history.HISTORY_MESSAGES + 10)
+        for data in sent:
+            room.append(data)
+        self.assertEqual(len(room), history.HISTORY_MESSAGES)
+        self.assertEqual(room.since(1, 1000)[0], (11, sent[10]))
+
+    def test_bounded_by_bytes(self):
+        room = RoomHistory()
+        size = history.HISTORY_BYTES // 4
+        for data in messages(10, size):
+            room.append(data)
+        self.assertLessEqual(room.size, history.HISTORY_BYTES)
+        self.assertEqual(len(room), 4)
+
+    def test_spilled_messages_are_read_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            room = RoomHistory(os.path.join(directory, "room"))
+            sent = messages(history.HISTORY_MESSAGES + 3 * history.SPILL_BATCH)
+            for data in sent:
+                room.append(data)
+            backfill = room.since(1, 1000)
+            self.assertEqual(backfill, list(enumerate(sent, 1)))
+
+    def test_restore(self):
+        room = RoomHistory()
+        room.restore([(40, b"a"), (41, b"b")], 42)
+        self.assertEqual(room.last(5), [(40, b"a"), (41, b"b")])
+        self.assertEqual(room.append(b"c"), 42)
+
+        empty = RoomHistory()
+        empty.restore([], 7)
+        self.assertEqual(empty.append(b"x"), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
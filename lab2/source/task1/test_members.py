@@ -0,0 +1,67 @@
+import unittest
+
+from members import Members
+from user import User
+
+
+def user(index: int, port: int = 5000, binary: bool = False) -> User:
+    return User(f"u{index}", f"name{index}", ("127.0.0.1", port + index), binary)
+
+
+class MembersTest(unittest.TestCase):
+    def setUp(self):
+        self.members = Members()
+
+    def test_one_entry_per_user(self):
+        first, moved = self.members.join(user(1), "r1")
+        again, _ = self.members.join(user(1), "r2")
+        self.assertEqual(first, again)
+        self.assertFalse(moved)
+        self.assertEqual(len(self.members), 1)
+        self.assertEqual(self.members.subscriptions, 2)
+        self.assertEqual(set(self.members.rooms_of("u1")), {"r1", "r2"})
+        self.assertEqual(self.members.user(first), user(1))
+
+    def test_joining_twice_counts_once(self):
+        self.members.join(user(1), "r1")
+        self.members.join(user(1), "r1")
+        self.assertEqual(self.members.subscriptions, 1)
+        self.assertEqual(self.members.rooms_of("u1"), ("r1",))
+
+    def test_new_address_is_a_move(self):
+        self.members.join(user(1), "r1")
+        _, moved = self.members.join(user(1, port=6000), "r2")
+        self.assertTrue(moved)
+        _, moved = self.members.join(user(1, port=6000, binary=True), "r2")
+        self.assertTrue(moved)
+
+    def test_leave(self):
+        self.members.join(user(1), "r1")
+        self.members.join(user(1), "r2")
+        self.assertFalse(self.members.leave("u1", "r3"))
+        self.assertFalse(self.members.leave("u1", "r1"))
+        self.assertEqual(self.members.rooms_of("u1"), ("r2",))
+        self.assertTrue(self.members.leave("u1", "r2"))
+        self.assertNotIn("u1", self.members)
+        self.assertEqual(self.members.subscriptions, 0)
+        self.assertFalse(self.members.leave("u1", "r2"))
+
+    def test_indexes_are_reused(self):
+        first, _ = self.members.join(user(1), "r1")
+        self.members.join(user(2), "r1")
+        self.members.drop("u1")
+        self.assertEqual(self.members.rooms_of("u1"), ())
+        third, _ = self.members.join(user(3), "r1")
+        self.assertEqual(third, first)
+        self.assertEqual(self.members.user(third), user(3))
+        self.assertEqual(self.members.subscriptions, 2)
+
+    def test_hosts_are_shared(self):
+        # Built at run time, so the two hosts start out as separate strings.
+        a, _ = self.members.join(User("a", "a", ("".join(["10.0.0.", "1"]), 1)), "r")
+        b, _ = self.members.join(User("b", "b", ("".join(["10.0.0.", "1"]), 2)), "r")
+        self.assertIs(self.members.addresses[a][0], self.members.addresses[b][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
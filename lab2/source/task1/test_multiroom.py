@@ -0,0 +1,57 @@
+import asyncio
+import unittest
+
+from multiroom import Room, RoomClient
+
+
+class DispatchTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = RoomClient("alice", "a001", ("127.0.0.1", 9))
+        self.room = self.client.rooms["r1"] = Room("r1")
+
+    async def test_room_messages_are_queued_in_order(self):
+        for seq in (1, 2, 2, 1, 3):
+            self.client.dispatch({"user": "bob", "message": str(seq), "room_id": "r1", "seq": seq})
+        self.assertEqual(
+            [self.room.queue.get_nowait()["seq"] for _ in range(self.room.queue.qsize())], [1, 2, 3]
+        )
+
+    async def test_shed_message_notice_is_not_a_room_message(self):
+        future = asyncio.get_running_loop().create_future()
+        self.client.replies.append(future)
+        self.client.dispatch(
+            {"success": False, "message": "Dropped", "dropped": "send-message", "room_id": "r1"}
+        )
+        self.assertTrue(self.room.queue.empty())
+        self.assertEqual(self.room.rejected, 1)
+        self.assertFalse(future.done())
+
+    async def test_shed_request_notice_answers_the_request(self):
+        future = asyncio.get_running_loop().create_future()
+        self.client.replies.append(future)
+        notice = {"success": False, "message": "Dropped", "dropped": "create-room"}
+        self.client.dispatch(notice)
+        self.assertEqual(future.result(), notice)
+
+    async def test_created_room_is_registered(self):
+        future = asyncio.get_running_loop().create_future()
+        self.client.replies.append(future)
+        self.client.dispatch({"success": True, "message": "Created", "room_id": "r2"})
+        self.assertIn("r2", self.client.rooms)
+        self.assertTrue(future.done())
+
+    async def test_full_queue_drops_oldest(self):
+        room = Room("r3")
+        for seq in range(1, 2000):
+            room.deliver({"seq": seq})
+        self.assertEqual(room.queue.get_nowait()["seq"], 2000 - room.queue.maxsize)
+        self.assertGreater(room.dropped, 0)
+
+    async def test_iteration_ends_when_closed(self):
+        self.room.deliver({"seq": 1})
+        self.room.close()
+        self.assertEqual([message async for message in self.room], [{"seq": 1}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import socket
+import unittest
+from unittest import mock
+
+import fanout
+from common.metrics import Metrics, MeteredSocket
+from server import ChatServer
+
+
+class AdmitTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer("127.0.0.1", 0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.socket.close()
+        self.client.close()
+
+    def request(self, body: dict) -> dict:
+        self.server.handle(json.dumps(body).encode(), self.client.getsockname())
+        return json.loads(self.client.recv(65535))
+
+    def test_fields_that_cannot_key_a_limit(self):
+        for body in (
+            {"request": "send-message", "id": [1], "room_id": "x", "message": "m"},
+            {"request": "send-message", "id": "u", "room_id": {"a": 1}, "message": "m"},
+            {"request": "subscribe", "user_id": [1], "room_id": "x"},
+            {"request": "list-rooms", "id": [1]},
+        ):
+            reply = self.request(body)
+            self.assertFalse(reply["success"])
+            self.assertTrue(reply["message"].startswith("Invalid"))
+        self.assertEqual(len(self.server.limits), 0)
+
+        reply = self.request({"request": "create-room", "user_id": "u", "user_name": "u"})
+        self.assertTrue(reply["success"])
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer("127.0.0.1", 0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.socket.close()
+        self.client.close()
+
+    def replies(self, body, count: int) -> list:
+        self.server.handle(json.dumps(body).encode(), self.client.getsockname())
+        return [json.loads(self.client.recv(65535)) for _ in range(count)]
+
+    def test_malformed_datagrams(self):
+        for body in ([1], "x", {"bundle": "x"}, {"bundle": [1]}, {"request": ["subscribe"]}):
+            [reply] = self.replies(body, 1)
+            self.assertEqual(reply, {"success": False, "message": "Invalid request"})
+
+    def test_valid_items_of_a_bundle_still_run(self):
+        create = {"request": "create-room", "user_id": "u", "user_name": "u"}
+        invalid, created = self.replies({"bundle": [None, create]}, 2)
+        self.assertFalse(invalid["success"])
+        self.assertTrue(created["success"])
+        self.assertIn(created["room_id"], self.server.rooms)
+
+
+class FullSocket:
+    # Takes room datagrams, then times out like a socket whose buffer is full.
+    family = socket.AF_INET
+
+    def __init__(self, room: int):
+        self.room = room
+        self.sent = []
+
+    def sendto(self, data: bytes, address):
+        if len(self.sent) >= self.room:
+            raise socket.timeout
+        self.sent.append(address)
+
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.destinations = fanout.Destinations(
+            [("127.0.0.1", port) for port in range(1000, 1000 + 2 * fanout.MIN_BATCH)]
+        )
+
+    def send(self, sock, batched: int) -> int:
+        metered = MeteredSocket(sock, self.metrics, fanout.sendto_many)
+        with mock.patch.object(fanout.Destinations, "sendmmsg", return_value=batched):
+            return metered.sendto_many(b"hi", self.destinations)
+
+    def test_rest_of_a_partial_batch_sent_one_at_a_time(self):
+        sock = FullSocket(len(self.destinations))
+        self.assertEqual(self.send(sock, 3), len(self.destinations))
+        self.assertEqual(sock.sent, self.destinations.addresses[3:])
+        self.assertEqual(self.metrics.datagrams_out, len(self.destinations))
+
+    def test_only_what_was_sent_is_counted(self):
+        sock = FullSocket(2)
+        self.assertEqual(self.send(sock, 3), 5)
+        self.assertEqual(self.metrics.datagrams_out, 5)
+        self.assertEqual(self.metrics.bytes_out, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import json
+import socket
+import tempfile
+import unittest
+
+from sharded_server import ShardedChatServer
+
+
+class RouteTest(unittest.TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.TemporaryDirectory()
+        self.server = ShardedChatServer(0, 2, self.run_dir.name, "127.0.0.1", 0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.server.socket.close()
+        self.server.peer_socket.close()
+        self.client.close()
+        self.run_dir.cleanup()
+
+    def request(self, body) -> dict:
+        self.server.handle(json.dumps(body).encode(), self.client.getsockname())
+        return json.loads(self.client.recv(65535))
+
+    def test_malformed_requests_are_refused_not_routed(self):
+        for body in (
+            {"bundle": [1]},
+            {"bundle": [{"request": {"a": 1}, "room_id": "x"}]},
+            {"request": "subscribe", "user_id": "u", "room_id": [1]},
+            {"bundle": [{"request": "send-message", "id": "u", "room_id": 5, "message": "m"}]},
+        ):
+            reply = self.request(body)
+            self.assertFalse(reply["success"])
+            self.assertTrue(reply["message"].startswith("Invalid"))
+
+
+if __name__ == "__main__":
+    unittest.main()
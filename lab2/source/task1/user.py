@@ -2,8 +2,9 @@ from typing import Any, Optional
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     id: Optional[str]
     name: Optional[str]
     address: Any
+    binary: bool = False
@@ -0,0 +1,95 @@
+import argparse
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import protocol
+import server as server_module
+from server import Server
+
+
+def fill(queue_dir: str, pending: int, length: int):
+    queue = server_module.offline.OfflineQueue(queue_dir)
+    text = "x" * length
+    start = time.perf_counter()
+    for i in range(pending):
+        queue.put("bbbb", "alice", f"{i} {text}")
+    elapsed = time.perf_counter() - start
+    queue.close()
+    return elapsed
+
+
+def drain(queue_dir: str, binary: bool, pending: int):
+    # Starts a server on the queue (replaying its log), registers the
+    # recipient and waits for every queued message.
+    start = time.perf_counter()
+    server = Server(0, queue_dir)
+    replay = time.perf_counter() - start
+    threading.Thread(target=server.handle_client, daemon=True).start()
+    address = ("127.0.0.1", server.sock.getsockname()[1])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    body = {"name": "bob", "id": "bbbb", "request": "register"}
+    if binary:
+        body["wire"] = protocol.VERSION
+
+    start = time.perf_counter()
+    sock.sendto(json.dumps(body).encode(), address)
+    sock.recvfrom(1024)
+    received = datagrams = 0
+    try:
+        while received < pending:
+            data, _ = sock.recvfrom(65535)
+            batch = protocol.loads(data)
+            received += len(batch["queued"])
+            datagrams += 1
+            ack = {"request": "queue-ack", "id": "bbbb", "through": batch["through"]}
+            sock.sendto(protocol.dumps(ack, binary), address)
+    except socket.timeout:
+        pass
+    elapsed = time.perf_counter() - start
+
+    # Let the last ack land before the queue is checked.
+    time.sleep(0.1)
+    left = len(server.message_queue.pending("bbbb"))
+    sock.close()
+    server.sock.close()
+    server.message_queue.close()
+    return replay, elapsed, received, datagrams, left
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drain time for a user with queued messages.")
+    parser.add_argument("--pending", type=int, default=10_000)
+    parser.add_argument("--length", type=int, default=40, help="Message length in bytes.")
+    args = parser.parse_args()
+
+    print(
+        "%-10s%-16s%12s%12s%12s%12s%8s"
+        % ("wire", "datagram", "replay ms", "drain ms", "received", "datagrams", "left")
+    )
+    for binary in (False, True):
+        for datagram in (0, server_module.DRAIN_DATAGRAM):
+            queue_dir = tempfile.mkdtemp()
+            try:
+                fill(queue_dir, args.pending, args.length)
+                server_module.DRAIN_DATAGRAM = datagram
+                replay, elapsed, received, datagrams, left = drain(queue_dir, binary, args.pending)
+            finally:
+                shutil.rmtree(queue_dir)
+            print(
+                "%-10s%-16s%12.1f%12.1f%12d%12d%8d"
+                % (
+                    "binary" if binary else "json",
+                    "one per message" if datagram == 0 else f"{datagram} bytes",
+                    replay * 1000,
+                    elapsed * 1000,
+                    received,
+                    datagrams,
+                    left,
+                )
+            )
@@ -3,36 +3,89 @@ import json
 from uuid import uuid4
 import threading as th
 
+import protocol
+from common import session
+from common.directory import DirectoryCache
+
+# Queued messages arrive several to a datagram.
+BUFFER_SIZE = 65535
+
 
 class User:
     server_address = ("0.0.0.0", 2055)
 
-    def __init__(self, name: str, id: str):
+    def __init__(self, name: str, id: str, binary: bool = False):
         self.name = name
         self.id = id
+        self.binary = binary
+        # Our copy of the user directory, kept current by server pushes.
+        self.users = DirectoryCache("users")
         self.con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.register()
 
     def reinit_connection(self):
         self.con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.register()
+        # Pushes went to the old socket.
+        self.users.stale = True
 
     def register(self):
         body = {"name": self.name, "id": self.id, "request": "register"}
+        if self.binary:
+            body["wire"] = protocol.VERSION
         self.con.sendto(json.dumps(body).encode(), User.server_address)
         data, _ = self.con.recvfrom(1024)  # Acknowledge from server (optional)
 
-    def request_for_user_list(self):
-        body = {"name": self.name, "id": self.id, "request": "list-users"}
-        self.con.sendto(json.dumps(body).encode(), User.server_address)
+        # Servers without binary support acknowledge without a "wire" field.
+        if self.binary:
+            self.binary = protocol.loads(data).get("wire") == protocol.VERSION
+
+    def send(self, body: dict):
+        self.con.sendto(protocol.dumps(body, self.binary), User.server_address)
 
-        data, _ = self.con.recvfrom(1024)
-        response = json.loads(data.decode())
+    def heartbeat(self):
+        # Keeps us registered while we are quiet.
+        self.send({"request": "heartbeat", "id": self.id})
 
-        if response.get("success"):
+    def exchange(self, body: dict) -> dict:
+        # Sends a request and returns its reply; queued messages and pushes
+        # may still be arriving ahead of it.
+        self.send(body)
+        while True:
+            data, _ = self.con.recvfrom(BUFFER_SIZE)
+            response = protocol.loads(data)
+            if "directory" not in response and (
+                "version" in response or response.get("success") is False
+            ):
+                return response
+            self.show(response)
+
+    def poll(self):
+        # Handles whatever arrived while nobody was reading.
+        self.con.setblocking(False)
+        try:
+            while True:
+                try:
+                    data, _ = self.con.recvfrom(BUFFER_SIZE)
+                    self.show(protocol.loads(data))
+                except (BlockingIOError, InterruptedError):
+                    return
+                except ValueError:
+                    continue
+        finally:
+            self.con.setblocking(True)
+
+    def sync_users(self) -> bool:
+        # Only a stale copy costs a round trip.
+        self.poll()
+        body = {"name": self.name, "id": self.id, "request": "list-users"}
+        return self.users.refresh(self.exchange, body)
+
+    def request_for_user_list(self):
+        if self.sync_users():
             print("%-6s\t%s" % ("ID", "User Name"))
-            for user in response.get("message", []):
-                print(f"{user['id']}\t{user['name']}")
+            for user_id, name in sorted(self.users.entries.items()):
+                print(f"{user_id}\t{name}")
 
     def send_private_message(self, target_user_id: str, message: str):
         body = {
@@ -42,7 +95,19 @@ class User:
             "target_user_id": target_user_id,
             "message": message,
         }
-        self.con.sendto(json.dumps(body).encode(), User.server_address)
+        self.send(body)
+
+    def show(self, response: dict):
+        if "directory" in response:
+            self.users.apply(response)
+        elif "queued" in response:
+            for item in response["queued"]:
+                print(f"\r[{item['user']}]: {item['message']}\n> ", end="")
+            self.send({"request": "queue-ack", "id": self.id, "through": response["through"]})
+        elif "user" in response:
+            print(f"\r[{response['user']}]: {response['message']}\n> ", end="")
+        else:
+            print(f"\r{response.get('message')}\n> ", end="")
 
     def log_messages(self, stop_event: th.Event):
         print("Logging messages...")
@@ -52,9 +117,8 @@ class User:
                 return
 
             try:
-                data, _ = self.con.recvfrom(1024)
-                response = json.loads(data.decode())
-                print(f"\r[{response['user']}]: {response['message']}\n> ", end="")
+                data, _ = self.con.recvfrom(BUFFER_SIZE)
+                self.show(protocol.loads(data))
             except OSError:
                 pass
 
@@ -62,7 +126,8 @@ class User:
 if __name__ == "__main__":
     name = input("Enter your name: ")
     user_id = str(uuid4()).split("-")[1]
-    user = User(name, user_id)
+    user = User(name, user_id, binary=True)
+    session.keep_alive(user.heartbeat)
     joined_user_id = None
     is_chatting = False
     update_thread = None
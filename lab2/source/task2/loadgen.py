@@ -0,0 +1,103 @@
+import argparse
+import os
+import socket
+import tempfile
+import time
+
+import protocol
+from client import User
+from common import loadstat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = "from server import Server; Server({port}, {queue_dir!r}).handle_client()"
+
+
+def run(
+    port: int,
+    users: int,
+    rate: float,
+    duration: float,
+    size: int,
+    binary: bool,
+) -> dict:
+    with tempfile.TemporaryDirectory() as queue_dir:
+        server = loadstat.start_server(SERVER.format(port=port, queue_dir=queue_dir), HERE)
+        User.server_address = ("127.0.0.1", port)
+        clients = []
+        try:
+            for index in range(users):
+                user = User(f"u{index}", f"{index:04x}", binary)
+                user.con.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                clients.append(user)
+
+            padding = "x" * max(0, size - 32)
+            delivered = [0]
+
+            def send(n: int):
+                # Users talk in pairs, 0 with 1, 2 with 3 and so on.
+                index = n % users
+                target = clients[index ^ 1 if index ^ 1 < users else 0]
+                clients[index].send_private_message(
+                    target.id, f"{index}|{time.perf_counter()}|{padding}"
+                )
+
+            def receive(index: int, data: bytes) -> list:
+                now = time.perf_counter()
+                try:
+                    response = protocol.loads(data)
+                except ValueError:
+                    return []
+                sender, _, rest = str(response.get("message", "")).partition("|")
+                # Senders get their own message back; only the copy the
+                # other user receives counts.
+                if "user" not in response or not rest or sender == str(index):
+                    return []
+                delivered[0] += 1
+                return [now - float(rest.partition("|")[0])]
+
+            stats = loadstat.ProcessStats(server.pid)
+            stats.start()
+            sent, latencies, elapsed = loadstat.drive(
+                [user.con for user in clients], send, receive, rate, duration
+            )
+            usage = stats.stop()
+        finally:
+            for user in clients:
+                user.con.close()
+            loadstat.stop_server(server)
+
+    return loadstat.result(
+        "task2",
+        "private",
+        {
+            "wire": "binary" if binary else "json",
+            "users": users,
+            "offered_per_sec": rate,
+            "message_bytes": size,
+            "sent": sent,
+        },
+        elapsed,
+        sent,
+        delivered[0],
+        latencies,
+        usage,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the private message server with simulated users.")
+    parser.add_argument("--port", type=int, default=2455)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=2000.0, help="Messages sent per second.")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--size", type=int, default=64, help="Message length in bytes.")
+    parser.add_argument("--wire", choices=["json", "binary", "both"], default="both")
+    parser.add_argument("--out", help="Also append the results to this file.")
+    args = parser.parse_args()
+
+    wires = [False, True] if args.wire == "both" else [args.wire == "binary"]
+    for binary in wires:
+        loadstat.emit(
+            run(args.port, args.users, args.rate, args.duration, args.size, binary),
+            args.out,
+        )
@@ -0,0 +1,153 @@
+import json
+import os
+import time
+from collections import deque
+
+# Private messages for users who are not online, kept in memory and in an
+# append-only log so that they survive a restart. The log is a directory of
+# numbered segment files of JSON lines:
+#
+#   {"op": "seq", "next": n}                          first line of a segment
+#   {"op": "put", "seq": n, "to": id, "at": t, "user": name, "message": text}
+#   {"op": "ack", "to": id, "through": n}             delivered up to seq n
+#
+# A segment is deleted once it is the oldest and none of its messages are
+# still queued, so an ack never outlives the messages it refers to.
+SEGMENT_SIZE = 4 << 20
+# Per-user bounds; the oldest messages are evicted first.
+MAX_AGE = 7 * 24 * 3600
+MAX_PENDING = 20_000
+MAX_PENDING_BYTES = 4 << 20
+# Users with a queue at once; messages to anyone else are refused.
+MAX_QUEUES = 10_000
+
+
+class OfflineQueue:
+    def __init__(self, directory: str, clock=time.time):
+        self.directory = directory
+        self.clock = clock
+        self.queues = {}  # user_id -> deque of (seq, at, user, message, segment)
+        self.sizes = {}  # user_id -> bytes of queued messages
+        self.live = {}  # segment -> messages from it still queued
+        self.segments = []  # segment numbers, oldest first
+        self.next_seq = 1
+        self.log = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.replay()
+        self.roll()
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.log")
+
+    def replay(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        for name in names:
+            segment = int(name[:-4])
+            self.segments.append(segment)
+            self.live[segment] = 0
+            with open(self.path(segment), "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line torn by a crash mid-write.
+                        continue
+                    op = record.get("op")
+                    if op == "seq":
+                        self.next_seq = max(self.next_seq, record["next"])
+                    elif op == "put":
+                        self.next_seq = max(self.next_seq, record["seq"] + 1)
+                        self.append(
+                            record["to"],
+                            (record["seq"], record["at"], record["user"], record["message"], segment),
+                        )
+                    elif op == "ack":
+                        self.remove(record["to"], record["through"])
+        for user_id in list(self.queues):
+            self.expire(user_id)
+
+    def roll(self):
+        # Starts a new segment, expiring old messages on the way.
+        if self.log is not None:
+            self.log.close()
+        for user_id in list(self.queues):
+            self.expire(user_id)
+        self.compact()
+
+        segment = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(segment)
+        self.live[segment] = 0
+        self.log = open(self.path(segment), "ab")
+        self.write({"op": "seq", "next": self.next_seq})
+
+    def write(self, record: dict):
+        self.log.write(json.dumps(record).encode() + b"\n")
+        self.log.flush()
+        if self.log.tell() >= SEGMENT_SIZE:
+            self.roll()
+
+    def compact(self):
+        while len(self.segments) > 1 and self.live[self.segments[0]] == 0:
+            segment = self.segments.pop(0)
+            del self.live[segment]
+            try:
+                os.remove(self.path(segment))
+            except FileNotFoundError:
+                pass
+
+    def put(self, user_id: str, user: str, message: str):
+        # Returns False when the message was refused.
+        if user_id not in self.queues and len(self.queues) >= MAX_QUEUES:
+            return False
+        seq = self.next_seq
+        self.next_seq += 1
+        at = self.clock()
+        segment = self.segments[-1]
+        # The entry belongs to the segment its record lands in, even if the
+        # write rolls over to a new one.
+        self.write({"op": "put", "seq": seq, "to": user_id, "at": at, "user": user, "message": message})
+        self.append(user_id, (seq, at, user, message, segment))
+        self.expire(user_id)
+        return True
+
+    def append(self, user_id: str, entry: tuple):
+        queue = self.queues.setdefault(user_id, deque())
+        queue.append(entry)
+        self.sizes[user_id] = self.sizes.get(user_id, 0) + len(entry[3])
+        self.live[entry[4]] += 1
+        while len(queue) > MAX_PENDING or self.sizes[user_id] > MAX_PENDING_BYTES:
+            self.pop(user_id)
+
+    def pop(self, user_id: str):
+        queue = self.queues[user_id]
+        entry = queue.popleft()
+        self.sizes[user_id] -= len(entry[3])
+        self.live[entry[4]] -= 1
+        if not queue:
+            del self.queues[user_id]
+            del self.sizes[user_id]
+
+    def expire(self, user_id: str):
+        cutoff = self.clock() - MAX_AGE
+        while user_id in self.queues and self.queues[user_id][0][1] < cutoff:
+            self.pop(user_id)
+
+    def remove(self, user_id: str, through: int):
+        while user_id in self.queues and self.queues[user_id][0][0] <= through:
+            self.pop(user_id)
+
+    def pending(self, user_id: str) -> list:
+        # Queued (seq, user, message) for user_id, oldest first.
+        self.expire(user_id)
+        return [(seq, user, message) for seq, _, user, message, _ in self.queues.get(user_id, ())]
+
+    def ack(self, user_id: str, through: int):
+        if user_id not in self.queues or self.queues[user_id][0][0] > through:
+            return
+        self.remove(user_id, through)
+        self.write({"op": "ack", "to": user_id, "through": through})
+        self.compact()
+
+    def close(self):
+        self.log.close()
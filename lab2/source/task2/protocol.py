@@ -0,0 +1,58 @@
+from common import wire
+
+# task2's messages. The codec, and the layout of a frame, are in
+# common/wire.py, shared by every task.
+MESSAGES = [
+    # Requests, matched on their "request" value.
+    (1, "register", (("name", "str"), ("id", "id"))),
+    (2, "list-users", (("name", "str"), ("id", "id"))),
+    (
+        3,
+        "send-private-message",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("message", "str"),
+        ),
+    ),
+    (4, "queue-ack", (("id", "id"), ("through", "u64"))),
+    # Paging through the directory from "cursor", or asking for the changes
+    # since "version"; see directory.py.
+    (5, "list-users", (("name", "str"), ("id", "id"), ("cursor", "str"))),
+    (6, "list-users", (("name", "str"), ("id", "id"), ("since", "u64"))),
+    # Keeps a session alive; see session.py.
+    (7, "heartbeat", (("id", "id"),)),
+    # Replies and pushes, matched on their keys.
+    (64, None, (("success", "bool"), ("message", "str"))),
+    (65, None, (("success", "bool"), ("message", "users"))),
+    (66, None, (("user", "str"), ("message", "str"))),
+    (67, None, (("queued", "chat"), ("through", "u64"))),
+    (
+        68,
+        None,
+        (("success", "bool"), ("users", "users"), ("cursor", "str"), ("version", "u64")),
+    ),
+    (
+        69,
+        None,
+        (("success", "bool"), ("added", "users"), ("removed", "ids"), ("version", "u64")),
+    ),
+    # Directory changes pushed to clients that list with a cursor or version.
+    (
+        70,
+        None,
+        (("directory", "str"), ("id", "id"), ("name", "str"), ("version", "u64")),
+    ),
+    (71, None, (("directory", "str"), ("id", "id"), ("version", "u64"))),
+]
+
+ProtocolError = wire.ProtocolError
+VERSION = wire.VERSION
+is_binary = wire.is_binary
+
+_codec = wire.Codec(MESSAGES)
+encode = _codec.encode
+decode = _codec.decode
+dumps = _codec.dumps
+loads = _codec.loads
@@ -1,36 +1,117 @@
+import argparse
 import socket
 import json
+import time
+from collections import deque
+
+import offline
+import protocol
+from common.directory import Directory
+from common.metrics import Metrics, MeteredSocket, RateLimitedLog
+from common.session import TimingWheel
+
+# Queued messages go out in datagrams of up to DRAIN_DATAGRAM bytes, at most
+# DRAIN_WINDOW of them unacknowledged at a time.
+DRAIN_DATAGRAM = 16 << 10
+DRAIN_WINDOW = 4
 
 
 class Server:
-    def __init__(self, port):
+    def __init__(self, port, queue_dir="offline-queue"):
         self.server_address = ("0.0.0.0", port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.metrics = Metrics()
+        self.log = RateLimitedLog()
+        self.sock = MeteredSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), self.metrics)
         self.sock.bind(self.server_address)
         self.users = {}  # Store connected users: {user_id: (name, address)}
         self.rooms = {}  # Store rooms information.
-        self.message_queue = {}  # Store messages for each user.
+        self.message_queue = offline.OfflineQueue(queue_dir)  # Messages for offline users.
+        self.draining = {}  # user_id -> batches of queued messages still to send
+        self.binary_peers = set()  # Addresses that negotiated the binary format.
+        self.directory = Directory("users")  # For paged and pushed listings.
+        # Users that go quiet for longer than the session TTL are dropped;
+        # messages for them are queued from then on.
+        self.sessions = TimingWheel()
+        self.metrics.gauge("users", lambda: len(self.users))
+        self.metrics.gauge("watchers", lambda: len(self.directory.watchers))
+        self.metrics.gauge("draining", lambda: len(self.draining))
+        self.metrics.gauge(
+            "offline_messages", lambda: sum(map(len, self.message_queue.queues.values()))
+        )
+
+    def send(self, body: dict, addr):
+        self.sock.sendto(protocol.dumps(body, addr in self.binary_peers), addr)
 
     def handle_client(self):
         while True:
-            data, addr = self.sock.recvfrom(1024)
+            self.sock.settimeout(self.sessions.timeout())
             try:
-                message = json.loads(data.decode())
+                data, addr = self.sock.recvfrom(1024)
+            except (socket.timeout, BlockingIOError):
+                # A timeout of zero, with a tick already due, makes the
+                # socket non-blocking for this call.
+                self.expire_sessions()
+                continue
+            self.metrics.received(len(data))
+            start = time.perf_counter()
+            request = None
+            try:
+                message = protocol.loads(data)
                 request = message.get("request")
 
+                # Any request from a user keeps their session alive.
+                user_id = message.get("id")
+                if isinstance(user_id, str) and user_id in self.users:
+                    self.sessions.touch(user_id)
+
                 if request == "register":
                     user_id = message["id"]
                     name = message["name"]
                     self.users[user_id] = (name, addr)
-                    self.sock.sendto(json.dumps({"status": "success"}).encode(), addr)
+                    self.sessions.touch(user_id)
+                    if self.directory.put(user_id, name):
+                        self.notify_watchers(user_id)
+
+                    wire = message.get("wire")
+                    wire = min(wire, protocol.VERSION) if isinstance(wire, int) else 0
+                    if wire:
+                        self.binary_peers.add(addr)
+                    else:
+                        self.binary_peers.discard(addr)
+                    self.sock.sendto(
+                        json.dumps({"status": "success", "wire": wire}).encode(), addr
+                    )
+                    self.drain(user_id)
+
+                elif request == "queue-ack":
+                    user_id = message["id"]
+                    self.message_queue.ack(user_id, message["through"])
+                    batches = self.draining.get(user_id)
+                    if batches:
+                        self.send(batches.popleft(), self.users[user_id][1])
+                    else:
+                        self.draining.pop(user_id, None)
+
+                elif request == "heartbeat":
+                    # Already renewed above; there is no reply.
+                    pass
+
+                elif request == "stats":
+                    # Always JSON; the snapshot has no binary form.
+                    self.sock.sendto(json.dumps(self.metrics.snapshot()).encode(), addr)
 
                 elif request == "list-users":
-                    user_list = [
-                        {"id": user_id, "name": name}
-                        for user_id, (name, _) in self.users.items()
-                    ]
-                    response = {"success": True, "message": user_list}
-                    self.sock.sendto(json.dumps(response).encode(), addr)
+                    if "cursor" in message or "since" in message:
+                        self.directory.watch(addr)
+                        response = self.directory.reply(message)
+                    else:
+                        # Clients that do not page get everyone at once.
+                        user_list = [
+                            {"id": user_id, "name": name}
+                            for user_id, (name, _) in self.users.items()
+                        ]
+                        response = {"success": True, "message": user_list}
+                    self.send(response, addr)
 
                 elif request == "send-private-message":
                     sender_id = message["id"]
@@ -41,24 +122,87 @@ class Server:
                     if target_user_id in self.users:
                         target_address = self.users[target_user_id][1]
                         response = {"user": sender_name, "message": message_content}
-                        self.sock.sendto(json.dumps(response).encode(), target_address)
+                        self.send(response, target_address)
 
                         # Send the same message back to the sender for their chat window
-                        self.sock.sendto(
-                            json.dumps(response).encode(), self.users[sender_id][1]
-                        )
+                        self.send(response, self.users[sender_id][1])
+
+                    elif self.message_queue.put(target_user_id, sender_name, message_content):
+                        response = {"user": sender_name, "message": message_content}
+                        self.send(response, addr)
+                        response = {"success": True, "message": "User is offline, message queued."}
+                        self.send(response, addr)
 
                     else:
                         response = {"success": False, "message": "User not found."}
-                        self.sock.sendto(json.dumps(response).encode(), addr)
+                        self.send(response, addr)
 
+            except protocol.ProtocolError as e:
+                self.metrics.errors += 1
+                # Always answered in JSON so an incompatible client can fall back.
+                self.sock.sendto(
+                    json.dumps({"success": False, "message": str(e)}).encode(), addr
+                )
             except json.JSONDecodeError:
-                print("Invalid JSON received.")
+                self.metrics.errors += 1
+                self.log("Invalid JSON received.")
             except Exception as e:
-                print(f"An error occurred: {e}")
+                self.metrics.errors += 1
+                self.log("An error occurred: %s", e)
+            self.metrics.handled(request, time.perf_counter() - start)
+            self.expire_sessions()
+
+    def expire_sessions(self):
+        for user_id in self.sessions.expire():
+            _, address = self.users.pop(user_id)
+            self.binary_peers.discard(address)
+            self.draining.pop(user_id, None)
+            if self.directory.remove(user_id):
+                self.notify_watchers(user_id)
+
+    def notify_watchers(self, user_id: str):
+        # Pushes a directory change to the clients keeping a copy, encoded
+        # once per wire format.
+        event = self.directory.event(user_id)
+        frames = {}
+        for address in self.directory.watching():
+            binary = address in self.binary_peers
+            if binary not in frames:
+                frames[binary] = protocol.dumps(event, binary)
+            self.sock.sendto(frames[binary], address)
+
+    def drain(self, user_id: str):
+        # Sends a user's queued messages, packed into as few datagrams as
+        # fit; each acknowledged batch releases the next one. Whatever is
+        # not acknowledged stays queued for the next register.
+        batches = deque()
+        batch, size, through = [], 0, 0
+        for seq, user, message in self.message_queue.pending(user_id):
+            item = {"user": user, "message": message}
+            item_size = len(json.dumps(item))
+            if batch and size + item_size > DRAIN_DATAGRAM:
+                batches.append({"queued": batch, "through": through})
+                batch, size = [], 0
+            batch.append(item)
+            size += item_size
+            through = seq
+        if batch:
+            batches.append({"queued": batch, "through": through})
+
+        address = self.users[user_id][1]
+        for _ in range(min(DRAIN_WINDOW, len(batches))):
+            self.send(batches.popleft(), address)
+        self.draining[user_id] = batches
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Private message server.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
     server = Server(2055)
+    if args.stats_file:
+        server.metrics.dump_every(args.stats_file, args.stats_interval)
     print("Server started. Listening for connections...")
     server.handle_client()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import offline
+from conftest import Clock
+from offline import OfflineQueue
+
+
+class OfflineQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.directory = self.temp.name
+        self.clock = Clock(1_000_000.0)
+        self.queue = OfflineQueue(self.directory, self.clock)
+
+    def tearDown(self):
+        self.queue.close()
+        self.temp.cleanup()
+
+    def reopen(self):
+        self.queue.close()
+        self.queue = OfflineQueue(self.directory, self.clock)
+
+    def test_pending_in_order(self):
+        self.queue.put("bob", "alice", "one")
+        self.queue.put("bob", "carol", "two")
+        self.queue.put("dave", "alice", "three")
+        self.assertEqual(self.queue.pending("bob"), [(1, "alice", "one"), (2, "carol", "two")])
+        self.assertEqual(self.queue.pending("dave"), [(3, "alice", "three")])
+        self.assertEqual(self.queue.pending("nobody"), [])
+
+    def test_ack_removes_through_seq(self):
+        for index in range(3):
+            self.queue.put("bob", "alice", str(index))
+        self.queue.ack("bob", 2)
+        self.assertEqual(self.queue.pending("bob"), [(3, "alice", "2")])
+
+    def test_survives_restart(self):
+        self.queue.put("bob", "alice", "one")
+        self.queue.put("bob", "alice", "two")
+        self.queue.ack("bob", 1)
+        self.reopen()
+        self.assertEqual(self.queue.pending("bob"), [(2, "alice", "two")])
+        # Sequence numbers carry on where they left off.
+        self.queue.put("bob", "alice", "three")
+        self.assertEqual(self.queue.pending("bob")[-1][0], 3)
+
+    def test_torn_line_is_skipped(self):
+        self.queue.put("bob", "alice", "one")
+        with open(self.queue.path(self.queue.segments[-1]), "ab") as f:
+            f.write(b'{"op": "put", "seq"')
+        self.reopen()
+        self.assertEqual(self.queue.pending("bob"), [(1, "alice", "one")])
+
+    def test_old_messages_expire(self):
+        self.queue.put("bob", "alice", "old")
+        self.clock.now += offline.MAX_AGE + 1
+        self.queue.put("bob", "alice", "new")
+        self.assertEqual(self.queue.pending("bob"), [(2, "alice", "new")])
+
+    def test_bounded_per_user(self):
+        limit = offline.MAX_PENDING
+        offline.MAX_PENDING = 3
+        try:
+            for index in range(5):
+                self.queue.put("bob", "alice", str(index))
+        finally:
+            offline.MAX_PENDING = limit
+        self.assertEqual([seq for seq, _, _ in self.queue.pending("bob")], [3, 4, 5])
+
+    def test_delivered_segments_are_deleted(self):
+        size = offline.SEGMENT_SIZE
+        offline.SEGMENT_SIZE = 200
+        try:
+            for index in range(10):
+                self.queue.put("bob", "alice", "x" * 50)
+            self.assertGreater(len(self.queue.segments), 2)
+            self.queue.ack("bob", 10)
+        finally:
+            offline.SEGMENT_SIZE = size
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+
+from common.session import TimingWheel
+from conftest import Clock
+from server import Server
+
+
+class Stop(Exception):
+    pass
+
+
+class ListenLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.server = Server(0, self.temp.name)
+        self.clock = Clock()
+        self.server.sessions = TimingWheel(clock=self.clock)
+
+    def tearDown(self):
+        self.server.sock.close()
+        self.server.message_queue.close()
+        self.temp.cleanup()
+
+    def test_due_tick_with_nothing_to_read(self):
+        # The next tick is already due, so the loop waits on the socket with
+        # a timeout of zero and finds it empty.
+        self.clock.now += 5
+        self.assertEqual(self.server.sessions.timeout(), 0.0)
+
+        def expire_sessions():
+            raise Stop
+
+        self.server.expire_sessions = expire_sessions
+        with self.assertRaises(Stop):
+            self.server.handle_client()
+
+
+if __name__ == "__main__":
+    unittest.main()
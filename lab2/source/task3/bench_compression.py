@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import random
+
+import bench_transfer
+
+LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARN", "ERROR")
+PATHS = ("/api/users", "/api/rooms", "/api/files", "/health", "/login")
+
+
+def log_file(size: int) -> bytes:
+    rng = random.Random(1)
+    lines = []
+    length = 0
+    while length < size:
+        line = "2024-05-%02d 12:%02d:%02d.%03d %-5s request %s served in %dms status=%d\n" % (
+            rng.randint(1, 28),
+            rng.randint(0, 59),
+            rng.randint(0, 59),
+            rng.randint(0, 999),
+            rng.choice(LEVELS),
+            rng.choice(PATHS),
+            rng.randint(1, 500),
+            rng.choice((200, 200, 200, 404, 500)),
+        )
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def csv_file(size: int) -> bytes:
+    rng = random.Random(2)
+    lines = ["id,user,room,score,active\n"]
+    length = len(lines[0])
+    while length < size:
+        line = "%d,user%04d,room%02d,%.2f,%s\n" % (
+            len(lines),
+            rng.randint(0, 9999),
+            rng.randint(0, 99),
+            rng.random() * 100,
+            rng.choice(("true", "false")),
+        )
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()[:size]
+
+
+FILES = {"log": log_file, "csv": csv_file, "random": os.urandom}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transfer time by file type and codec.")
+    parser.add_argument("--size-mb", type=float, default=8.0)
+    parser.add_argument("--port", type=int, default=2255)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument(
+        "--link-mbps", type=float, nargs="*", default=[0.0, 50.0],
+        help="Emulated link speeds in Mbit/s; 0 is plain loopback.",
+    )
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1e6)
+    for link in args.link_mbps:
+        for kind, payload in FILES.items():
+            for codec in ("none", "zlib", "lzma", "auto"):
+                result = bench_transfer.run(
+                    True,
+                    size,
+                    args.port,
+                    args.loss,
+                    codec=codec,
+                    payload=payload,
+                    bandwidth=link * 1e6 / 8,
+                )
+                print(json.dumps({"file": kind, "link_mbps": link, **result}))
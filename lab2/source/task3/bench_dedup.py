@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import transfer
+from bench_transfer import BenchUser, start_server
+from client import User
+
+senders = []
+
+
+class CountingSender(transfer.ReliableSender):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        senders.append(self)
+
+
+def send(sender: User, receiver: BenchUser, filepath: str) -> dict:
+    senders.clear()
+    receiver.done.clear()
+    start = time.perf_counter()
+    sender.send_file(receiver.id, filepath)
+    completed = receiver.done.wait(30)
+    elapsed = time.perf_counter() - start
+
+    with open(filepath, "rb") as a, open(os.path.basename(filepath), "rb") as b:
+        intact = a.read() == b.read()
+    chunks = transfer.chunk_count(os.path.getsize(filepath))
+    return {
+        "completed": completed,
+        "intact": intact,
+        "seconds": round(elapsed, 3),
+        "chunks": chunks,
+        "chunks_sent": sum(s.sent for s in senders),
+    }
+
+
+def session(port: int, filepath: str, cases) -> dict:
+    # One server and three users; cases run in order and see each other's
+    # leftovers, both on disk and in the server's chunk cache.
+    server = start_server(port)
+    User.server_address = ("127.0.0.1", port)
+    stop_event = threading.Event()
+    threads = []
+    try:
+        sender = BenchUser("sender", "aaaa", True)
+        receivers = [BenchUser("b", "bbbb", True), BenchUser("c", "cccc", True)]
+        for receiver in receivers:
+            receiver.con.settimeout(0.2)
+            thread = threading.Thread(target=receiver.log_messages, args=(stop_event,))
+            thread.start()
+            threads.append(thread)
+
+        results = {}
+        for name, prepare, index in cases:
+            for leftover in ("payload.bin", "payload.bin.part"):
+                if os.path.exists(leftover) and prepare is not None:
+                    os.remove(leftover)
+            if prepare is not None:
+                prepare()
+            results[name] = send(sender, receivers[index], filepath)
+        return results
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunks sent with manifests and the relay cache.")
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=2255)
+    args = parser.parse_args()
+
+    transfer.ReliableSender = CountingSender
+    User.bulk_threshold = None
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        filepath = os.path.join(workdir, "source", "payload.bin")
+        os.mkdir(os.path.dirname(filepath))
+        with open(filepath, "wb") as f:
+            f.write(os.urandom(int(args.size_mb * 1e6)))
+
+        def half_part():
+            # What an interrupted attempt that got half way leaves behind.
+            with open(filepath, "rb") as f, open("payload.bin.part", "wb") as part:
+                part.write(f.read(os.path.getsize(filepath) // 2))
+
+        def nothing():
+            pass
+
+        # Receivers share the working directory; a prepare step clears it.
+        os.chdir(workdir)
+        try:
+            results = session(
+                args.port,
+                filepath,
+                [("resume half", half_part, 0), ("resend", None, 0)],
+            )
+            results.update(
+                session(
+                    args.port,
+                    filepath,
+                    [("fresh", nothing, 0), ("fan-out", nothing, 1)],
+                )
+            )
+        finally:
+            os.chdir(cwd)
+
+    for name, result in results.items():
+        print(json.dumps({"case": name, **result}))
@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+
+import protocol
+from server import Server
+
+CHUNK_SIZE = 4096
+
+
+class NullSocket:
+    def sendto(self, data: bytes, address):
+        pass
+
+
+def make_server() -> Server:
+    server = Server(0)
+    server.sock.close()
+    server.sock = NullSocket()
+    # Measures relaying alone; the rate limits would shed most of it.
+    server.limits = None
+    for user_id, binary in (("aaaa", True), ("bbbb", True), ("cccc", False), ("dddd", False)):
+        address = ("127.0.0.1", int(user_id, 16))
+        server.users[user_id] = (user_id, address)
+        if binary:
+            server.binary_peers.add(address)
+    server.add_transfer(7, ("bbbb", "payload.bin", ("127.0.0.1", 1), "aaaa", 7))
+    return server
+
+
+def parse_and_reencode(server: Server, data: bytes, _):
+    # What every relayed request used to cost.
+    message = protocol.loads(data)
+    server.send(message, server.users[message["target_user_id"]][1])
+
+
+def measure(relay, server: Server, data: bytes, payload: int, duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < duration:
+        for _ in range(1000):
+            relay(server, data, ("127.0.0.1", 9))
+        count += 1000
+    return count * payload / 1e6 / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server relay MB/s of file payload.")
+    parser.add_argument("--duration", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = make_server()
+    chunk = os.urandom(CHUNK_SIZE)
+    frame = bytearray(protocol.CHUNK_HEADER.size + CHUNK_SIZE)
+    protocol.pack_chunk_header(frame, 0, 7, 0, 0, CHUNK_SIZE)
+    frame[protocol.CHUNK_HEADER.size :] = chunk
+
+    def file_chunk(target_user_id: str, binary: bool) -> bytes:
+        body = {
+            "request": "file-chunk",
+            "target_user_id": target_user_id,
+            "filename": "payload.bin",
+            "chunk": chunk.hex(),
+        }
+        return protocol.dumps(body, binary)
+
+    cases = [
+        ("json file-chunk", file_chunk("dddd", False)),
+        ("binary file-chunk", file_chunk("bbbb", True)),
+        ("chunk frame", bytes(frame)),
+    ]
+
+    print("%-20s%18s%18s" % ("datagram", "parse+re-encode", "fast path"))
+    for name, data in cases:
+        fast = measure(Server.handle, server, data, CHUNK_SIZE, args.duration)
+        if protocol.is_chunk(data):
+            # Chunk frames were never parsed; only the header lookup changed.
+            print("%-20s%18s%13.1f MB/s" % (name, "-", fast))
+            continue
+        baseline = measure(parse_and_reencode, server, data, CHUNK_SIZE, args.duration)
+        print("%-20s%13.1f MB/s%13.1f MB/s" % (name, baseline, fast))
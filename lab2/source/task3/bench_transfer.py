@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client import User
+from netsim import LossyProxy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class BenchUser(User):
+    def __init__(self, name: str, id: str, binary: bool = False):
+        self.done = threading.Event()
+        super().__init__(name, id, binary)
+
+    def file_received(self, filename: str):
+        self.done.set()
+
+
+def start_server(port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-c", f"from server import Server; Server({port}).handle_client()"],
+        cwd=HERE,
+        stdout=subprocess.DEVNULL,
+    )
+    time.sleep(0.5)
+    return process
+
+
+def run(
+    binary: bool,
+    size: int,
+    port: int,
+    loss: float = 0.0,
+    bulk: bool = False,
+    streams: int = 1,
+    codec: str = "none",
+    payload=os.urandom,
+    bandwidth: float = 0.0,
+) -> dict:
+    User.bulk_threshold = 0 if bulk else None
+    server = start_server(port)
+    # Everything goes through the proxy; loss is switched on once both users
+    # are registered, since registration itself is not retried.
+    proxy = LossyProxy(("127.0.0.1", port), seed=size).start()
+    User.server_address = proxy.address
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source")
+        os.mkdir(source)
+        filepath = os.path.join(source, "payload.bin")
+        with open(filepath, "wb") as f:
+            f.write(payload(size))
+
+        # The receiver writes into its working directory.
+        os.chdir(workdir)
+        stop_event = threading.Event()
+        try:
+            receiver = BenchUser("receiver", "bbbb", binary)
+            sender = BenchUser("sender", "aaaa", binary)
+            receiver.con.settimeout(0.2)
+            log_thread = threading.Thread(
+                target=receiver.log_messages, args=(stop_event,)
+            )
+            log_thread.start()
+            proxy.loss = loss
+            proxy.reorder = loss
+            proxy.bandwidth = bandwidth
+
+            start = time.perf_counter()
+            delivered = sender.send_file("bbbb", filepath, streams, codec)
+            completed = receiver.done.wait(60)
+            elapsed = time.perf_counter() - start
+        finally:
+            stop_event.set()
+            log_thread.join()
+            os.chdir(cwd)
+            proxy.stop()
+            server.terminate()
+            server.wait()
+
+        intact = 0
+        if completed:
+            with open(filepath, "rb") as a, open(os.path.join(workdir, "payload.bin"), "rb") as b:
+                while block := a.read(4096):
+                    intact += len(block) if block == b.read(4096) else 0
+
+    return {
+        "path": "bulk" if bulk else "binary" if binary else "json-hex",
+        "size_mb": size / 1e6,
+        "loss_pct": 100 * loss,
+        "streams": streams,
+        "codec": codec,
+        "completed": completed,
+        "acked": delivered,
+        "seconds": round(elapsed, 3),
+        "mb_per_sec": round(size / 1e6 / elapsed, 2),
+        "intact_pct": round(100 * intact / size, 2),
+        "dropped": proxy.dropped,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Task3 file transfer throughput.")
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=2255)
+    parser.add_argument(
+        "--loss", type=float, nargs="*", default=[0.0, 0.01, 0.05],
+        help="Loss rates for the reliable binary path.",
+    )
+    parser.add_argument(
+        "--streams", type=int, nargs="*", default=[1, 4],
+        help="Stream counts for the reliable binary path.",
+    )
+    parser.add_argument(
+        "--bulk-mb", type=float, default=64.0,
+        help="Size for the UDP versus TCP bulk comparison.",
+    )
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1e6)
+    print(json.dumps(run(False, size, args.port)))
+    for loss in args.loss:
+        for streams in args.streams:
+            print(json.dumps(run(True, size, args.port, loss, streams=streams)))
+
+    if args.bulk_mb:
+        size = int(args.bulk_mb * 1e6)
+        for bulk in (False, True):
+            print(json.dumps(run(True, size, args.port, bulk=bulk)))
@@ -1,148 +1,688 @@
 import socket
 import json
 import os
+import random
+import time
 from uuid import uuid4
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import compression
+import manifest
+import protocol
+import transfer
+from common import session
+from common.directory import DirectoryCache
+
+CHUNK_SIZE = transfer.CHUNK_SIZE
+# Large enough for any datagram the server relays.
+BUFFER_SIZE = 65535
+# Kernel receive buffer; its size is the window advertised to file senders.
+RECV_BUFFER = 4 << 20
+# Finished transfers remembered so that late retransmissions are still acked.
+FINISHED_TRANSFERS = 64
+# Bulk transfers: how long to wait on the server and the other end, and how
+# much is moved per sendfile/recv call.
+BULK_TIMEOUT = 10
+BULK_CHUNK = 1 << 20
+# Manifests kept for files that are sent more than once.
+MANIFEST_CACHE = 16
 
 
 class User:
     server_address = ("0.0.0.0", 2055)
+    # Files at least this large go over a TCP bulk channel; None disables it.
+    bulk_threshold = 8 << 20
 
-    def __init__(self, name: str, id: str):
+    def __init__(self, name: str, id: str, binary: bool = False):
         self.name = name
         self.id = id
+        self.binary = binary
+        self.manifests = {}  # (path, size, mtime) -> manifest, oldest first
+        # Our copy of the user directory, kept current by server pushes.
+        self.users = DirectoryCache("users")
         self.con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.con.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
         self.register()
 
     def register(self):
-        self.con.sendto(
-            json.dumps(
-                {"name": self.name, "id": self.id, "request": "register"}
-            ).encode(),
-            User.server_address,
-        )
-        self.con.recvfrom(1024)
+        body = {"name": self.name, "id": self.id, "request": "register"}
+        if self.binary:
+            body["wire"] = protocol.VERSION
+        self.con.sendto(json.dumps(body).encode(), User.server_address)
+        data, _ = self.con.recvfrom(1024)
+
+        # Servers without binary support acknowledge without a "wire" field.
+        if self.binary:
+            self.binary = protocol.loads(data).get("wire") == protocol.VERSION
+
+    def send(self, body: dict):
+        self.con.sendto(protocol.dumps(body, self.binary), User.server_address)
+
+    def exchange(self, body: dict) -> dict:
+        # Sends a request and returns its reply, applying any directory
+        # pushes that arrive ahead of it.
+        self.send(body)
+        while True:
+            data, _ = self.con.recvfrom(4096)
+            response = protocol.loads(data)
+            if "directory" not in response:
+                return response
+            self.users.apply(response)
+
+    def poll(self):
+        # Applies the pushes that arrived while nobody was reading.
+        self.con.setblocking(False)
+        try:
+            while True:
+                try:
+                    data, _ = self.con.recvfrom(4096)
+                    response = protocol.loads(data)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except ValueError:
+                    continue
+                if "directory" in response:
+                    self.users.apply(response)
+        finally:
+            self.con.setblocking(True)
+
+    def heartbeat(self):
+        # Keeps us registered while we are quiet.
+        self.send({"request": "heartbeat", "id": self.id})
+
+    def sync_users(self) -> bool:
+        # Only a stale copy costs a round trip.
+        self.poll()
+        body = {"name": self.name, "id": self.id, "request": "list-users"}
+        return self.users.refresh(self.exchange, body)
 
     def request_for_user_list(self):
-        self.con.sendto(
-            json.dumps(
-                {"name": self.name, "id": self.id, "request": "list-users"}
-            ).encode(),
-            User.server_address,
-        )
-        data, _ = self.con.recvfrom(4096)
-        response = json.loads(data.decode())
-        if response.get("success"):
+        if self.sync_users():
             print("%-6s\t%s" % ("ID", "User Name"))
-            for user in response.get("message", []):
-                print(f"{user['id']}\t{user['name']}")
+            for user_id, name in sorted(self.users.entries.items()):
+                print(f"{user_id}\t{name}")
 
-    def send_file(self, target_user_id: str, filepath: str):
+    def send_file(
+        self,
+        target_user_id: str,
+        filepath: str,
+        streams: int = 1,
+        codec: str = "none",
+    ) -> bool:
+        # Returns True once the receiver has acknowledged every chunk. With
+        # several streams the file is split into that many byte ranges, each
+        # sent on its own socket and thread. codec is one of
+        # compression.CODECS and applies to binary chunks.
         if not os.path.exists(filepath):
             print("File not found.")
-            return
+            return False
 
         filename = os.path.basename(filepath)
         filesize = os.path.getsize(filepath)
+        if (
+            self.bulk_threshold is not None
+            and filesize >= self.bulk_threshold
+            and self.send_bulk(target_user_id, filepath, filesize)
+        ):
+            print(f"File '{filename}' sent to {target_user_id}")
+            return True
 
-        self.con.sendto(
-            json.dumps(
-                {
-                    "user_name": self.name,
-                    "id": self.id,
-                    "request": "send-file",
-                    "target_user_id": target_user_id,
-                    "filename": filename,
-                    "filesize": filesize,
-                }
-            ).encode(),
-            User.server_address,
-        )
+        transfer_id = random.getrandbits(32)
+        header = {
+            "user_name": self.name,
+            "id": self.id,
+            "request": "send-file",
+            "target_user_id": target_user_id,
+            "filename": filename,
+            "filesize": filesize,
+            "transfer_id": transfer_id,
+            "chunks": transfer.chunk_count(filesize),
+        }
 
+        delivered = False
         with open(filepath, "rb") as f:
-            while chunk := f.read(4096):
-                self.con.sendto(
-                    json.dumps(
+            if self.binary and 1 < streams <= header["chunks"]:
+                delivered = self.send_parallel(f, header, streams, codec)
+            elif self.binary:
+                # The receiver is told the chunk digests first and only gets
+                # the chunks it does not already hold.
+                delivered = None
+                if header["chunks"] <= manifest.MAX_CHUNKS:
+                    delivered = self.send_reliably(f, self.with_manifest(f, header), codec)
+                if delivered is None:
+                    delivered = self.send_reliably(f, header, codec)
+            else:
+                self.send(header)
+                while chunk := f.read(CHUNK_SIZE):
+                    self.send(
                         {
                             "request": "file-chunk",
                             "target_user_id": target_user_id,
                             "filename": filename,
                             "chunk": chunk.hex(),
                         }
-                    ).encode(),
-                    User.server_address,
-                )
+                    )
 
+        self.send(
+            {
+                "request": "file-transfer-complete",
+                "target_user_id": target_user_id,
+                "filename": filename,
+                "transfer_id": transfer_id,
+            }
+        )
         print(f"File '{filename}' sent to {target_user_id}")
+        return delivered
 
-    def request_file(self, target_user_id: str, filename: str):
-        self.con.sendto(
-            json.dumps(
+    def send_bulk(self, target_user_id: str, filepath: str, filesize: int) -> bool:
+        # The server hands out a one-time token over UDP and pairs our TCP
+        # connection with the receiver's. Returns False if anything fails
+        # before the file goes out, so the caller can fall back to UDP.
+        offer = {
+            "user_name": self.name,
+            "id": self.id,
+            "request": "bulk-offer",
+            "target_user_id": target_user_id,
+            "filename": os.path.basename(filepath),
+            "filesize": filesize,
+        }
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as control:
+                control.settimeout(1)
+                control.sendto(protocol.dumps(offer, self.binary), User.server_address)
+                reply = protocol.loads(control.recv(1024))
+            if not reply.get("success"):
+                return False
+
+            address = (User.server_address[0], reply["port"])
+            with socket.create_connection(address, timeout=BULK_TIMEOUT) as sock:
+                sock.sendall(protocol.BULK_HELLO.pack(reply["token"], protocol.BULK_SENDER))
+                if sock.recv(1) != protocol.BULK_READY:
+                    return False
+
+                # The kernel copies from the page cache straight to the socket.
+                sock.settimeout(None)
+                with open(filepath, "rb") as f:
+                    offset = 0
+                    while offset < filesize:
+                        sent = os.sendfile(sock.fileno(), f.fileno(), offset, BULK_CHUNK)
+                        if not sent:
+                            break
+                        offset += sent
+                sock.shutdown(socket.SHUT_WR)
+                # The server closes once the receiver has everything.
+                sock.recv(1)
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def receive_bulk(self, offer: dict):
+        filename = offer["filename"]
+        filesize = offer["filesize"]
+        fd = self.open_incoming(filename, filesize)
+        received = 0
+        try:
+            address = (User.server_address[0], offer["port"])
+            with socket.create_connection(address, timeout=BULK_TIMEOUT) as sock:
+                sock.sendall(protocol.BULK_HELLO.pack(offer["token"], protocol.BULK_RECEIVER))
+                buffer = bytearray(BULK_CHUNK)
+                view = memoryview(buffer)
+                while received < filesize and (length := sock.recv_into(buffer)):
+                    os.pwrite(fd, view[:length], received)
+                    received += length
+        except OSError as e:
+            print(f"Error: {e}")
+
+        if received != filesize:
+            os.close(fd)
+            os.remove(filename + ".part")
+            print(f"\nTransfer of '{filename}' failed.")
+            return
+        self.finish_incoming(filename, fd)
+
+    def send_parallel(self, f, header: dict, streams: int, codec: str) -> bool:
+        # Every stream is a reliable transfer of its own over a chunk-aligned
+        # range; the receiver writes chunks at their offsets and finishes the
+        # file once all of its streams have.
+        total = header["chunks"]
+        per_stream = -(-total // streams)
+        ranges = []
+        for first in range(0, total, per_stream):
+            ranges.append(
                 {
-                    "user_name": self.name,
-                    "id": self.id,
-                    "request": "request-file",
-                    "target_user_id": target_user_id,
-                    "filename": filename,
+                    **header,
+                    "request": "send-range",
+                    "transfer_id": random.getrandbits(32),
+                    "chunks": min(per_stream, total - first),
+                    "file_id": header["transfer_id"],
+                    "offset": first * CHUNK_SIZE,
+                    "streams": -(-total // per_stream),
                 }
-            ).encode(),
-            User.server_address,
+            )
+
+        with ThreadPoolExecutor(len(ranges)) as pool:
+            results = list(
+                pool.map(lambda stream: self.send_reliably(f, stream, codec), ranges)
+            )
+        if None in results:
+            # A range header went unacknowledged, e.g. the receiver has no
+            # binary format; start over as a single stream.
+            return self.send_reliably(f, header, codec)
+        return all(results)
+
+    def with_manifest(self, f, header: dict) -> dict:
+        stat = os.fstat(f.fileno())
+        key = (os.path.abspath(f.name), stat.st_size, stat.st_mtime_ns)
+        digests = self.manifests.pop(key, None)
+        if digests is None:
+            digests = manifest.build(f.fileno(), stat.st_size)
+        self.manifests[key] = digests
+        if len(self.manifests) > MANIFEST_CACHE:
+            del self.manifests[next(iter(self.manifests))]
+        return {**header, "request": "send-manifest", "manifest": digests.hex()}
+
+    def exchange_manifest(self, sock: socket.socket, request: dict) -> bytes | None:
+        # The manifest is resent until the receiver answers with a bitmap of
+        # the chunks it holds.
+        data = protocol.dumps(request, True)
+        if len(data) > manifest.MAX_DATAGRAM:
+            # Long names leave no room for the digests; send it plainly.
+            return None
+        buffer = bytearray(BUFFER_SIZE)
+        timeout = transfer.INITIAL_RTO
+        for _ in range(5):
+            sock.sendto(data, User.server_address)
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                sock.settimeout(remaining)
+                try:
+                    nbytes = sock.recv_into(buffer)
+                    reply = protocol.loads(bytes(buffer[:nbytes]))
+                except socket.timeout:
+                    break
+                except ValueError:
+                    continue
+                if (
+                    reply.get("request") == "have-chunks"
+                    and reply.get("transfer_id") == request["transfer_id"]
+                ):
+                    return bytes.fromhex(reply["have"])
+            timeout = min(timeout * 2, transfer.MAX_RTO)
+        return None
+
+    def send_reliably(self, f, header: dict, codec: str = "none") -> bool | None:
+        # Each transfer gets its own socket, so the server can route acks
+        # back to it without them ending up in log_messages. Returns None
+        # when a manifest or a range of a parallel transfer is never
+        # acknowledged.
+        fd = f.fileno()
+        base = header.get("offset", 0)
+
+        # Positional reads, so streams can share the file.
+        def read(seq: int, payload: memoryview):
+            offset = base + seq * CHUNK_SIZE
+            if hasattr(os, "preadv"):
+                return offset, os.preadv(fd, [payload], offset), 0
+            data = os.pread(fd, len(payload), offset)
+            payload[: len(data)] = data
+            return offset, len(data), 0
+
+        compressor = None
+        fill = read
+        if codec != "none":
+            compressor = compression.ChunkCompressor(
+                lambda seq: os.pread(fd, CHUNK_SIZE, base + seq * CHUNK_SIZE),
+                header["chunks"],
+                codec,
+            )
+
+            def compress(seq: int, payload: memoryview):
+                flags, data = compressor.chunk(seq)
+                payload[: len(data)] = data
+                return base + seq * CHUNK_SIZE, len(data), flags
+
+            fill = compress
+
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sender = transfer.ReliableSender(
+                    sock, User.server_address, header["transfer_id"], header["chunks"], fill
+                )
+                if header["request"] == "send-manifest":
+                    have = self.exchange_manifest(sock, header)
+                    if have is None:
+                        return None
+                    held = set(manifest.unpack_bitmap(have, header["chunks"]))
+                    sender.seqs = [seq for seq in range(header["chunks"]) if seq not in held]
+                    return sender.run()
+
+                if sender.handshake(protocol.dumps(header, True)):
+                    return sender.run()
+                if header["request"] == "send-range":
+                    return None
+
+                # Nobody acked the header, e.g. a receiver without the binary
+                # format; send everything once and hope for the best.
+                self.send_chunks(sock, header["transfer_id"], header["chunks"], fill)
+                return False
+        finally:
+            if compressor is not None:
+                compressor.close()
+
+    def send_chunks(self, sock: socket.socket, transfer_id: int, chunks: int, fill):
+        # The file is read straight into the frame behind a reused header.
+        header_size = protocol.CHUNK_HEADER.size
+        frame = bytearray(transfer.FRAME_SIZE)
+        view = memoryview(frame)
+        payload = view[header_size:]
+
+        for seq in range(chunks):
+            offset, length, flags = fill(seq, payload)
+            protocol.pack_chunk_header(frame, flags, transfer_id, seq, offset, length)
+            sock.sendto(view[: header_size + length], User.server_address)
+
+    def request_file(self, target_user_id: str, filename: str):
+        self.send(
+            {
+                "user_name": self.name,
+                "id": self.id,
+                "request": "request-file",
+                "target_user_id": target_user_id,
+                "filename": filename,
+            }
         )
 
     def approve_file_request(self, sender_id: str, filename: str):
-        self.con.sendto(
-            json.dumps(
-                {
-                    "request": "approve-file-request",
-                    "sender_id": sender_id,
-                    "filename": filename,
-                }
-            ).encode(),
-            User.server_address,
+        self.send(
+            {
+                "request": "approve-file-request",
+                "sender_id": sender_id,
+                "filename": filename,
+            }
         )
 
-    def log_messages(self, stop_event: threading.Event):
-        received_files = {}
+    def file_received(self, filename: str):
+        print(f"\nFile '{filename}' received successfully!")
 
-        while not stop_event.is_set():
+    def open_incoming(self, filename: str, filesize: int, keep: bool = False) -> int:
+        # Chunks are written in place at their offsets, so memory use does not
+        # grow with the file. The space is reserved up front where supported.
+        # With keep, what an earlier attempt left in the ".part" file stays.
+        flags = os.O_RDWR | os.O_CREAT | (0 if keep else os.O_TRUNC)
+        fd = os.open(filename + ".part", flags, 0o644)
+        if keep:
+            os.ftruncate(fd, filesize)
+        if filesize:
             try:
-                data, _ = self.con.recvfrom(4096)
-                response = json.loads(data.decode())
-                request_type = response.get("request")
+                os.posix_fallocate(fd, 0, filesize)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, filesize)
+        return fd
 
-                if request_type == "file-chunk":
-                    filename = response.get("filename")
-                    chunk = bytes.fromhex(response.get("chunk"))
+    def resume_incoming(self, filename: str, filesize: int, digests: list[bytes]):
+        # Opens the ".part" file for a manifest transfer and fills in every
+        # chunk found locally, in what an interrupted attempt left behind or
+        # in an earlier copy of the file. Returns (fd, seqs held).
+        part = filename + ".part"
+        found = manifest.local_chunks([part, filename], set(digests))
+        fd = self.open_incoming(filename, filesize, keep=True)
 
-                    if filename not in received_files:
-                        received_files[filename] = b""
+        held = []
+        copies = {}  # seq -> block found at another offset
+        for seq, key in enumerate(digests):
+            source = found.get(key)
+            if source is None:
+                continue
+            held.append(seq)
+            if source != (part, seq * CHUNK_SIZE):
+                path, offset = source
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    copies[seq] = f.read(CHUNK_SIZE)
 
-                    received_files[filename] += chunk
+        # Read before writing anything, as sources may be in the ".part" file.
+        for seq, block in copies.items():
+            os.pwrite(fd, block, seq * CHUNK_SIZE)
+        return fd, held
 
-                elif request_type == "file-request-approved":
-                    print(
-                        f"File request approved. Waiting to receive {response['filename']}..."
-                    )
+    def finish_incoming(self, filename: str, fd: int):
+        os.close(fd)
+        os.replace(filename + ".part", filename)
+        self.file_received(filename)
+
+    def log_messages(self, stop_event: threading.Event):
+        received_files = {}  # filename -> fd of the ".part" file
+        written = {}  # filename -> bytes appended by hex chunks
+        transfers = {}  # transfer_id -> filename
+        windows = {}  # transfer_id -> transfer.ReceiveWindow
+        unacked = {}  # transfer_id -> in-order chunks since the last ack
+        finished = {}  # transfer_id -> chunk count, oldest first
+        streams_left = {}  # filename -> streams still arriving
+        groups = {}  # file_id of a multi-stream transfer -> filename
+        have_replies = {}  # transfer_id -> "have-chunks" answer, oldest first
+
+        header_size = protocol.CHUNK_HEADER.size
+        advertised = transfer.receive_window(self.con)
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+
+        def ack(transfer_id: int):
+            if transfer_id in finished:
+                cumulative, sack = finished[transfer_id], 0
+            else:
+                window = windows[transfer_id]
+                cumulative, sack = window.cumulative, window.sack()
+            unacked[transfer_id] = 0
+            self.con.sendto(
+                protocol.pack_ack(transfer_id, cumulative, sack, advertised),
+                User.server_address,
+            )
+
+        def close_file(filename: str):
+            # Drops whatever is left of the file's streams.
+            for transfer_id in [t for t, name in transfers.items() if name == filename]:
+                del transfers[transfer_id]
+                windows.pop(transfer_id, None)
+                unacked.pop(transfer_id, None)
+            for file_id in [f for f, name in groups.items() if name == filename]:
+                del groups[file_id]
+            streams_left.pop(filename, None)
+            written.pop(filename, None)
+            self.finish_incoming(filename, received_files.pop(filename))
+
+        def finish(transfer_id: int):
+            filename = transfers.pop(transfer_id)
+            finished[transfer_id] = windows.pop(transfer_id).total
+            unacked.pop(transfer_id, None)
+            if len(finished) > FINISHED_TRANSFERS:
+                del finished[next(iter(finished))]
+            streams_left[filename] -= 1
+            if not streams_left[filename]:
+                close_file(filename)
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    nbytes, _ = self.con.recvfrom_into(buffer)
+                    data = view[:nbytes]
+
+                    if protocol.is_chunk(data):
+                        flags, transfer_id, seq, offset, length = (
+                            protocol.unpack_chunk_header(data)
+                        )
+                        if transfer_id in finished:
+                            # Our last ack was lost.
+                            ack(transfer_id)
+                            continue
+
+                        filename = transfers.get(transfer_id)
+                        if filename not in received_files:
+                            continue
+                        window = windows.get(transfer_id)
+                        if window is not None and not window.add(seq):
+                            ack(transfer_id)
+                            continue
+
+                        payload = data[header_size : header_size + length]
+                        if flags & protocol.COMPRESSED:
+                            payload = compression.decompress_chunk(flags, payload)
+                        os.pwrite(received_files[filename], payload, offset)
+                        if window is None:
+                            continue
+
+                        unacked[transfer_id] += 1
+                        if window.complete:
+                            ack(transfer_id)
+                            finish(transfer_id)
+                        elif (
+                            flags & protocol.ACK_REQUEST
+                            or window.pending
+                            or unacked[transfer_id] >= transfer.ACK_EVERY
+                        ):
+                            ack(transfer_id)
+                        continue
+
+                    response = protocol.loads(bytes(data))
+                    if "directory" in response:
+                        self.users.apply(response)
+                        continue
+                    request_type = response.get("request")
+
+                    if request_type == "send-file":
+                        filename = response.get("filename")
+                        transfer_id = response.get("transfer_id")
+                        if transfer_id in windows or transfer_id in finished:
+                            # A retransmitted header.
+                            ack(transfer_id)
+                            continue
+
+                        if filename in received_files:
+                            os.close(received_files[filename])
+                        received_files[filename] = self.open_incoming(
+                            filename, response.get("filesize", 0)
+                        )
+                        written[filename] = 0
+                        if transfer_id is not None:
+                            transfers[transfer_id] = filename
+                        # Only binary peers get sequenced chunks to acknowledge.
+                        if self.binary and "chunks" in response:
+                            windows[transfer_id] = transfer.ReceiveWindow(
+                                response["chunks"]
+                            )
+                            streams_left[filename] = 1
+                            ack(transfer_id)
+                            if windows[transfer_id].complete:  # an empty file
+                                finish(transfer_id)
+
+                    elif request_type == "send-manifest" and self.binary:
+                        transfer_id = response["transfer_id"]
+                        if transfer_id not in have_replies:
+                            filename = response["filename"]
+                            if filename in received_files:
+                                os.close(received_files.pop(filename))
+                            digests = manifest.split(bytes.fromhex(response["manifest"]))
+                            fd, held = self.resume_incoming(
+                                filename, response["filesize"], digests
+                            )
+                            received_files[filename] = fd
+                            transfers[transfer_id] = filename
+                            windows[transfer_id] = transfer.ReceiveWindow(
+                                response["chunks"], held
+                            )
+                            streams_left[filename] = 1
+                            have_replies[transfer_id] = protocol.dumps(
+                                {
+                                    "request": "have-chunks",
+                                    "transfer_id": transfer_id,
+                                    "have": manifest.pack_bitmap(
+                                        held, response["chunks"]
+                                    ).hex(),
+                                },
+                                True,
+                            )
+                            if len(have_replies) > FINISHED_TRANSFERS:
+                                del have_replies[next(iter(have_replies))]
+
+                        # Also resent for a retransmitted manifest.
+                        self.con.sendto(have_replies[transfer_id], User.server_address)
+                        if transfer_id in windows or transfer_id in finished:
+                            ack(transfer_id)
+                        if transfer_id in windows and windows[transfer_id].complete:
+                            finish(transfer_id)
+
+                    elif request_type == "send-range" and self.binary:
+                        transfer_id = response["transfer_id"]
+                        if transfer_id in windows or transfer_id in finished:
+                            ack(transfer_id)
+                            continue
+
+                        # The first stream to arrive opens the file.
+                        filename = groups.get(response["file_id"])
+                        if filename is None:
+                            filename = response["filename"]
+                            if filename in received_files:
+                                os.close(received_files[filename])
+                            received_files[filename] = self.open_incoming(
+                                filename, response["filesize"]
+                            )
+                            groups[response["file_id"]] = filename
+                            streams_left[filename] = response["streams"]
+
+                        transfers[transfer_id] = filename
+                        windows[transfer_id] = transfer.ReceiveWindow(response["chunks"])
+                        ack(transfer_id)
+
+                    elif request_type == "bulk-incoming":
+                        threading.Thread(
+                            target=self.receive_bulk, args=(response,), daemon=True
+                        ).start()
+
+                    elif request_type == "file-chunk":
+                        filename = response.get("filename")
+                        chunk = bytes.fromhex(response.get("chunk"))
+
+                        if filename not in received_files:
+                            received_files[filename] = self.open_incoming(filename, 0)
+                            written[filename] = 0
+
+                        os.pwrite(received_files[filename], chunk, written[filename])
+                        written[filename] += len(chunk)
+
+                    elif response.get("success") is False:
+                        # Something we sent was turned away.
+                        print(response.get("message"))
+
+                    elif request_type == "file-request-approved":
+                        print(
+                            f"File request approved. Waiting to receive {response['filename']}..."
+                        )
 
-                elif request_type == "file-transfer-complete":
-                    filename = response.get("filename")
-                    with open(filename, "wb") as f:
-                        f.write(received_files[filename])
-                    print(f"\nFile '{filename}' received successfully!")
-                    del received_files[filename]
+                    elif request_type == "file-transfer-complete":
+                        filename = response.get("filename")
+                        transfer_id = response.get("transfer_id")
+                        if transfer_id in finished or filename not in received_files:
+                            # Already finished once every chunk arrived.
+                            continue
 
-            except OSError:
-                pass
-            except json.JSONDecodeError as e:
-                print(f"JSON error: {e}, Data: {data}")
-            except Exception as e:
-                print(f"Error: {e}")
+                        # Unacknowledged transfers end here, complete or not.
+                        close_file(filename)
 
+                except OSError:
+                    pass
+                except ValueError as e:
+                    print(f"Decode error: {e}, Data: {bytes(data)}")
+                except Exception as e:
+                    print(f"Error: {e}")
+        finally:
+            for fd in received_files.values():
+                os.close(fd)
 
 if __name__ == "__main__":
     name = input("Enter your name: ")
     user_id = str(uuid4()).split("-")[1]
-    user = User(name, user_id)
+    user = User(name, user_id, binary=True)
+    session.keep_alive(user.heartbeat)
 
     stop_event = threading.Event()
     log_thread = threading.Thread(target=user.log_messages, args=(stop_event,))
@@ -0,0 +1,104 @@
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+
+# Per-chunk compression for file transfers. Every chunk is compressed on its
+# own, so chunks can still be lost, resent and written in any order.
+CODECS = ("none", "zlib", "lzma", "auto")
+
+# A quick zlib pass over the first SAMPLE bytes decides whether a chunk is
+# worth compressing at all, and "auto" picks lzma below LZMA_RATIO.
+SAMPLE = 512
+SKIP_RATIO = 0.9
+LZMA_RATIO = 0.1
+
+ZLIB_LEVEL = 6
+# Raw LZMA2 has no container header, which matters at 4 KB a chunk, and a
+# small dictionary keeps per-chunk setup from dominating.
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 2, "dict_size": 1 << 16}]
+
+# Chunks are compressed BATCH at a time, up to LOOKAHEAD ahead of the sender.
+BATCH = 16
+LOOKAHEAD = 128
+WORKERS = 2
+
+
+def sample_ratio(data) -> float:
+    sample = bytes(data[:SAMPLE])
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def compress_chunk(data, codec: str):
+    # Returns (flags, payload); the chunk is left as it is when compressing
+    # would not shrink it.
+    if codec == "none":
+        return 0, data
+
+    ratio = sample_ratio(data)
+    if ratio > SKIP_RATIO:
+        return 0, data
+    if codec == "auto":
+        codec = "lzma" if ratio < LZMA_RATIO else "zlib"
+
+    if codec == "lzma":
+        flags = protocol.LZMA
+        payload = lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    else:
+        flags = protocol.ZLIB
+        payload = zlib.compress(data, ZLIB_LEVEL)
+
+    if len(payload) >= len(data):
+        return 0, data
+    return flags, payload
+
+
+def decompress_chunk(flags: int, payload) -> bytes:
+    try:
+        if flags & protocol.LZMA:
+            return lzma.decompress(payload, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+        if flags & protocol.ZLIB:
+            return zlib.decompress(payload)
+    except (lzma.LZMAError, zlib.error) as e:
+        raise protocol.ProtocolError(f"Corrupt compressed chunk: {e}")
+    return payload
+
+
+class ChunkCompressor:
+    # Wraps a read(seq) -> bytes function and compresses chunks ahead of the
+    # sender on a thread pool, so compression overlaps with sending; zlib and
+    # lzma release the GIL while they work.
+    def __init__(self, read, chunks: int, codec: str):
+        self.read = read
+        self.chunks = chunks
+        self.codec = codec
+        self.pool = ThreadPoolExecutor(WORKERS)
+        self.batches = {}  # first seq -> future of [(flags, payload), ...]
+        self.next_batch = 0
+
+    def compress(self, first: int):
+        end = min(first + BATCH, self.chunks)
+        return [compress_chunk(self.read(seq), self.codec) for seq in range(first, end)]
+
+    def chunk(self, seq: int):
+        # Returns (flags, payload) for chunk seq.
+        # Chunks the receiver already holds are skipped, so start from here.
+        self.next_batch = max(self.next_batch, seq - seq % BATCH)
+        while self.next_batch < min(seq + LOOKAHEAD, self.chunks):
+            self.batches[self.next_batch] = self.pool.submit(self.compress, self.next_batch)
+            self.next_batch += BATCH
+
+        first = seq - seq % BATCH
+        future = self.batches.get(first)
+        if future is None:
+            # A retransmission from a batch already handed out.
+            return compress_chunk(self.read(seq), self.codec)
+        if seq - first == BATCH - 1:
+            del self.batches[first]
+        return future.result()[seq - first]
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,156 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+from client import User
+from common import loadstat
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = "from server import Server; Server({port}).handle_client()"
+# How long a file may take before it counts as lost.
+FILE_TIMEOUT = 30
+
+
+class LoadUser(User):
+    # Records when each file it receives is complete, and drops it.
+    def __init__(self, name: str, id: str, binary: bool, started: dict, latencies: list):
+        self.started = started
+        self.latencies = latencies
+        self.arrived = threading.Condition()
+        super().__init__(name, id, binary)
+
+    def file_received(self, filename: str):
+        latency = time.perf_counter() - self.started.pop(filename)
+        os.remove(filename)
+        with self.arrived:
+            self.latencies.append(latency)
+            self.arrived.notify_all()
+
+
+def run(
+    port: int,
+    pairs: int,
+    idle: int,
+    size: int,
+    duration: float,
+    binary: bool,
+) -> dict:
+    server = loadstat.start_server(SERVER.format(port=port), HERE)
+    User.server_address = ("127.0.0.1", port)
+    User.bulk_threshold = None  # Keep every transfer on the datagram path.
+    cwd = os.getcwd()
+    started, latencies = {}, []
+    users, threads = [], []
+    stop_event = threading.Event()
+    sent = [0] * pairs
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source")
+        os.mkdir(source)
+        # Receivers write into the working directory.
+        os.chdir(workdir)
+        try:
+            # Other registered users make the directory the size it would be
+            # on a busy server.
+            for index in range(idle):
+                users.append(User(f"i{index}", f"{pairs * 2 + index:04x}", binary))
+
+            senders = []
+            for pair in range(pairs):
+                receiver = LoadUser(f"r{pair}", f"{pair * 2:04x}", binary, started, latencies)
+                sender = User(f"s{pair}", f"{pair * 2 + 1:04x}", binary)
+                receiver.con.settimeout(0.2)
+                threads.append(
+                    threading.Thread(target=receiver.log_messages, args=(stop_event,))
+                )
+                users += [receiver, sender]
+                senders.append((sender, receiver))
+                with open(os.path.join(source, f"p{pair}"), "wb") as f:
+                    f.write(os.urandom(size))
+
+            def send_files(pair: int, end: float):
+                # Files go one after another; each has its own name so that
+                # the receiver never finds its chunks locally already.
+                sender, receiver = senders[pair]
+                original = os.path.join(source, f"p{pair}")
+                while time.perf_counter() < end:
+                    filename = f"p{pair}-{sent[pair]}.bin"
+                    path = os.path.join(source, filename)
+                    os.link(original, path)
+                    started[filename] = time.perf_counter()
+                    sent[pair] += 1
+                    sender.send_file(receiver.id, path)
+                    os.remove(path)
+                    with receiver.arrived:
+                        receiver.arrived.wait_for(
+                            lambda: filename not in started, FILE_TIMEOUT
+                        )
+
+            for thread in threads:
+                thread.start()
+            stats = loadstat.ProcessStats(server.pid)
+            stats.start()
+            start = time.perf_counter()
+            workers = [
+                threading.Thread(target=send_files, args=(pair, start + duration))
+                for pair in range(pairs)
+            ]
+            # Clients print progress as they would for a person.
+            with contextlib.redirect_stdout(io.StringIO()):
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            elapsed = time.perf_counter() - start
+            usage = stats.stop()
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            for user in users:
+                user.con.close()
+            os.chdir(cwd)
+            loadstat.stop_server(server)
+
+    record = loadstat.result(
+        "task3",
+        "files",
+        {
+            "wire": "binary" if binary else "json",
+            "pairs": pairs,
+            "idle_users": idle,
+            "file_bytes": size,
+        },
+        elapsed,
+        sum(sent),
+        len(latencies),
+        latencies,
+        usage,
+        units="files",
+    )
+    record["mb_per_sec"] = round(len(latencies) * size / 1e6 / elapsed, 2)
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the file server with simulated transfers.")
+    parser.add_argument("--port", type=int, default=2555)
+    parser.add_argument("--pairs", type=int, default=8, help="Sender and receiver pairs.")
+    parser.add_argument("--idle", type=int, default=1000, help="Registered users that stay quiet.")
+    parser.add_argument("--size-kb", type=float, nargs="*", default=[16.0, 256.0])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--wire", choices=["json", "binary", "both"], default="both")
+    parser.add_argument("--out", help="Also append the results to this file.")
+    args = parser.parse_args()
+
+    wires = [False, True] if args.wire == "both" else [args.wire == "binary"]
+    for size_kb in args.size_kb:
+        for binary in wires:
+            loadstat.emit(
+                run(args.port, args.pairs, args.idle, int(size_kb * 1024), args.duration, binary),
+                args.out,
+            )
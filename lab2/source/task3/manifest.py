@@ -0,0 +1,88 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+from transfer import CHUNK_SIZE
+
+# A manifest is the concatenated digests of a file's chunks. It travels in a
+# single "send-manifest" datagram, which caps the files that get one: the
+# largest UDP payload, less room for the frame's other fields. Names too
+# long for that room are caught when the request is encoded.
+DIGEST_SIZE = 16
+MAX_DATAGRAM = 65507
+HEADER_RESERVE = 1024
+MAX_CHUNKS = (MAX_DATAGRAM - HEADER_RESERVE) // DIGEST_SIZE
+
+
+def digest(chunk) -> bytes:
+    return hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+
+
+def build(fd: int, filesize: int) -> bytes:
+    return b"".join(
+        digest(os.pread(fd, CHUNK_SIZE, offset)) for offset in range(0, filesize, CHUNK_SIZE)
+    )
+
+
+def split(manifest: bytes) -> list[bytes]:
+    return [manifest[i : i + DIGEST_SIZE] for i in range(0, len(manifest), DIGEST_SIZE)]
+
+
+def pack_bitmap(seqs, total: int) -> bytes:
+    bitmap = bytearray((total + 7) // 8)
+    for seq in seqs:
+        bitmap[seq >> 3] |= 0x80 >> (seq & 7)
+    return bytes(bitmap)
+
+
+def unpack_bitmap(bitmap: bytes, total: int) -> list[int]:
+    return [seq for seq in range(total) if bitmap[seq >> 3] & (0x80 >> (seq & 7))]
+
+
+def local_chunks(paths, chunks: set[bytes]) -> dict:
+    # Which of the wanted digests can be found in chunk-aligned blocks of the
+    # given files: digest -> (path, offset).
+    found = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                offset = 0
+                while block := f.read(CHUNK_SIZE):
+                    key = digest(block)
+                    if key in chunks and key not in found:
+                        found[key] = (path, offset)
+                    offset += len(block)
+        except OSError:
+            continue
+    return found
+
+
+class ChunkCache:
+    # Chunk payloads the server has relayed, by digest, evicted least
+    # recently used first once they add up to more than capacity bytes.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.chunks = OrderedDict()  # digest -> (flags, payload)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes):
+        entry = self.chunks.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.chunks.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: bytes, flags: int, payload: bytes):
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return
+        self.chunks[key] = (flags, payload)
+        self.size += len(payload)
+        while self.size > self.capacity:
+            _, (_, evicted) = self.chunks.popitem(last=False)
+            self.size -= len(evicted)
@@ -0,0 +1,123 @@
+import heapq
+import random
+import selectors
+import socket
+import threading
+import time
+
+# A UDP proxy that sits between clients and the server and drops, delays and
+# reorders datagrams in both directions, for testing transfers on a bad link.
+BUFFER_SIZE = 65535
+# With a bandwidth limit, datagrams that would queue longer than this are
+# dropped, like a router with a full buffer.
+MAX_QUEUE_DELAY = 0.05
+
+
+class LossyProxy:
+    def __init__(
+        self,
+        upstream,
+        loss: float = 0.0,
+        reorder: float = 0.0,
+        bandwidth: float = 0.0,
+        seed=None,
+    ):
+        self.upstream = upstream
+        self.loss = loss
+        self.reorder = reorder  # chance a datagram is held back 1-5 ms
+        self.bandwidth = bandwidth  # bytes/sec each way, 0 for unlimited
+        self.link_free = {True: 0.0, False: 0.0}  # towards clients? -> idle time
+        self.random = random.Random(seed)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        # One upstream socket per client, so the server sees distinct peers.
+        self.clients = {}  # client address -> upstream socket
+        self.delayed = []  # heap of (due, order, socket, data, address)
+        self.order = 0
+
+        self.dropped = 0
+        self.forwarded = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        for sock in self.clients.values():
+            sock.close()
+        self.sock.close()
+
+    def forward(self, sock: socket.socket, data: bytes, address):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        now = time.monotonic()
+        due = now
+        if self.bandwidth:
+            downstream = sock is self.sock
+            start = max(now, self.link_free[downstream])
+            if start - now > MAX_QUEUE_DELAY:
+                self.dropped += 1
+                return
+            due = self.link_free[downstream] = start + len(data) / self.bandwidth
+        if self.random.random() < self.reorder:
+            due += self.random.uniform(0.001, 0.005)
+
+        if due <= now:
+            self.send(sock, data, address)
+            return
+        self.order += 1
+        heapq.heappush(self.delayed, (due, self.order, sock, data, address))
+
+    def send(self, sock: socket.socket, data: bytes, address):
+        try:
+            sock.sendto(data, address)
+            self.forwarded += 1
+        except OSError:
+            self.dropped += 1
+
+    def upstream_socket(self, client) -> socket.socket:
+        sock = self.clients.get(client)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(False)
+            self.clients[client] = sock
+            self.selector.register(sock, selectors.EVENT_READ, client)
+        return sock
+
+    def run(self):
+        while not self.stop_event.is_set():
+            timeout = 0.05
+            if self.delayed:
+                timeout = max(0.0, min(timeout, self.delayed[0][0] - time.monotonic()))
+
+            for key, _ in self.selector.select(timeout):
+                while True:
+                    try:
+                        data, address = key.fileobj.recvfrom(BUFFER_SIZE)
+                    except BlockingIOError:
+                        break
+                    if key.data is None:
+                        # Client to server.
+                        self.forward(self.upstream_socket(address), data, self.upstream)
+                    else:
+                        # Server to the client behind this upstream socket.
+                        self.forward(self.sock, data, key.data)
+
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self.delayed)
+                self.send(sock, data, address)
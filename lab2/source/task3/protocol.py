@@ -0,0 +1,247 @@
+import struct
+
+from common import wire
+from common.wire import HEADER, MAGIC, U16, U32, VERSION, ProtocolError
+
+# task3's messages. The codec, and the layout of a frame, are in
+# common/wire.py, shared by every task.
+MESSAGES = [
+    # Requests, matched on their "request" value.
+    (1, "register", (("name", "str"), ("id", "id"))),
+    (2, "list-users", (("name", "str"), ("id", "id"))),
+    (
+        3,
+        "send-file",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("filename", "str"),
+            ("filesize", "u64"),
+            ("transfer_id", "u32"),
+            ("chunks", "u32"),
+        ),
+    ),
+    (
+        4,
+        "file-chunk",
+        (("target_user_id", "id"), ("filename", "str"), ("chunk", "hex")),
+    ),
+    (
+        5,
+        "request-file",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("filename", "str"),
+        ),
+    ),
+    (6, "approve-file-request", (("sender_id", "id"), ("filename", "str"))),
+    (7, "file-request-approved", (("filename", "str"),)),
+    (
+        8,
+        "file-transfer-complete",
+        (("target_user_id", "id"), ("filename", "str"), ("transfer_id", "u32")),
+    ),
+    (
+        9,
+        "bulk-offer",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("filename", "str"),
+            ("filesize", "u64"),
+        ),
+    ),
+    (
+        10,
+        "bulk-incoming",
+        (("filename", "str"), ("filesize", "u64"), ("token", "u64"), ("port", "u32")),
+    ),
+    (
+        11,
+        "send-range",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("filename", "str"),
+            ("filesize", "u64"),
+            ("transfer_id", "u32"),
+            ("chunks", "u32"),
+            ("file_id", "u32"),
+            ("offset", "u64"),
+            ("streams", "u32"),
+        ),
+    ),
+    (
+        12,
+        "send-manifest",
+        (
+            ("user_name", "str"),
+            ("id", "id"),
+            ("target_user_id", "id"),
+            ("filename", "str"),
+            ("filesize", "u64"),
+            ("transfer_id", "u32"),
+            ("chunks", "u32"),
+            ("manifest", "hex"),
+        ),
+    ),
+    (13, "have-chunks", (("transfer_id", "u32"), ("have", "hex"))),
+    # Paging through the directory from "cursor", or asking for the changes
+    # since "version"; see directory.py.
+    (14, "list-users", (("name", "str"), ("id", "id"), ("cursor", "str"))),
+    (15, "list-users", (("name", "str"), ("id", "id"), ("since", "u64"))),
+    # Keeps a session alive; see session.py.
+    (16, "heartbeat", (("id", "id"),)),
+    # Replies, matched on their keys.
+    (64, None, (("success", "bool"), ("message", "users"))),
+    (65, None, (("success", "bool"), ("token", "u64"), ("port", "u32"))),
+    (
+        66,
+        None,
+        (("success", "bool"), ("users", "users"), ("cursor", "str"), ("version", "u64")),
+    ),
+    (
+        67,
+        None,
+        (("success", "bool"), ("added", "users"), ("removed", "ids"), ("version", "u64")),
+    ),
+    # Directory changes pushed to clients that list with a cursor or version.
+    (
+        68,
+        None,
+        (("directory", "str"), ("id", "id"), ("name", "str"), ("version", "u64")),
+    ),
+    (69, None, (("directory", "str"), ("id", "id"), ("version", "u64"))),
+]
+
+is_binary = wire.is_binary
+
+_codec = wire.Codec(MESSAGES)
+encode = _codec.encode
+decode = _codec.decode
+dumps = _codec.dumps
+loads = _codec.loads
+
+
+# Relayed requests whose target the server can read without decoding the
+# frame: opcode -> kinds of the fields in front of "target_user_id".
+_FIXED_WIDTHS = {"id": 2, "bool": 1, "u32": 4, "u64": 8}
+_ROUTES: dict = {}
+for _opcode, _request, _fields in MESSAGES:
+    if _request in ("file-chunk", "request-file"):
+        _names = [name for name, _ in _fields]
+        _ROUTES[_opcode] = tuple(kind for _, kind in _fields[: _names.index("target_user_id")])
+
+
+# File chunks bypass the field codec: a fixed header, then the raw bytes.
+#
+#   magic:u8 version:u8 opcode:u8 flags:u8 transfer_id:u32 seq:u32
+#   offset:u64 length:u16 data
+#
+# The receiver answers with ack frames carrying the next sequence number it
+# is missing, a bitmap of the 64 sequence numbers after it that did arrive,
+# and how many more chunks it can buffer.
+#
+#   magic:u8 version:u8 opcode:u8 transfer_id:u32 cumulative:u32 sack:u64
+#   window:u16
+CHUNK = 32
+ACK = 33
+CHUNK_HEADER = struct.Struct("!BBBBIIQH")
+ACK_FRAME = struct.Struct("!BBBIIQH")
+SACK_BITS = 64
+
+# Chunk flags.
+ACK_REQUEST = 0x01  # acknowledge this chunk right away
+ZLIB = 0x02  # payload is a zlib stream
+LZMA = 0x04  # payload is raw LZMA2
+COMPRESSED = ZLIB | LZMA
+
+_CHUNK_PREFIX = bytes((MAGIC, VERSION, CHUNK))
+_ACK_PREFIX = bytes((MAGIC, VERSION, ACK))
+
+
+def is_chunk(data) -> bool:
+    return data[:3] == _CHUNK_PREFIX
+
+
+def is_ack(data) -> bool:
+    return data[:3] == _ACK_PREFIX
+
+
+def pack_chunk_header(
+    buffer, flags: int, transfer_id: int, seq: int, offset: int, length: int
+):
+    CHUNK_HEADER.pack_into(
+        buffer, 0, MAGIC, VERSION, CHUNK, flags, transfer_id, seq, offset, length
+    )
+
+
+def unpack_chunk_header(data):
+    # Returns (flags, transfer_id, seq, offset, length); the payload follows.
+    try:
+        _, _, _, flags, transfer_id, seq, offset, length = CHUNK_HEADER.unpack_from(
+            data
+        )
+    except struct.error:
+        raise ProtocolError("Truncated chunk header")
+    if CHUNK_HEADER.size + length > len(data):
+        raise ProtocolError("Truncated chunk")
+    return flags, transfer_id, seq, offset, length
+
+
+def pack_ack(transfer_id: int, cumulative: int, sack: int, window: int) -> bytes:
+    return ACK_FRAME.pack(MAGIC, VERSION, ACK, transfer_id, cumulative, sack, window)
+
+
+def unpack_ack(data):
+    # Returns (transfer_id, cumulative, sack, window).
+    try:
+        return ACK_FRAME.unpack_from(data)[3:]
+    except struct.error:
+        raise ProtocolError("Truncated ack")
+
+
+def ack_transfer_id(data) -> int:
+    return U32.unpack_from(data, 3)[0]
+
+
+def peek_target(data) -> str | None:
+    # The "target_user_id" of a relayed binary request, skipping the fields in
+    # front of it instead of decoding them; None for anything else.
+    if len(data) < HEADER.size or data[0] != MAGIC or data[1] != VERSION:
+        return None
+    prefix = _ROUTES.get(data[2])
+    if prefix is None:
+        return None
+
+    offset = HEADER.size
+    try:
+        for kind in prefix:
+            width = _FIXED_WIDTHS.get(kind)
+            if width is None:  # u16 length-prefixed
+                width = 2 + U16.unpack_from(data, offset)[0]
+            offset += width
+        return f"{U16.unpack_from(data, offset)[0]:04x}"
+    except struct.error:
+        return None
+
+
+def chunk_transfer_id(data) -> int:
+    return U32.unpack_from(data, 4)[0]
+
+
+# Bulk transfers run over TCP. Both ends open with the token the server
+# handed out over UDP and their role; the server answers the sender with a
+# single byte once the receiver is connected too.
+#
+#   token:u64 role:u8
+BULK_HELLO = struct.Struct("!QB")
+BULK_SENDER = 0
+BULK_RECEIVER = 1
+BULK_READY = b"\x01"
+
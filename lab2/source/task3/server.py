@@ -1,80 +1,561 @@
+import argparse
 import socket
 import json
 import os
+import secrets
+import struct
 import threading
+import time
+
+import compression
+import manifest
+import protocol
+from common.directory import Directory
+from common.metrics import Metrics, MeteredSocket, RateLimitedLog
+from common.ratelimit import RateLimits
+from common.session import TimingWheel
+from transfer import CHUNK_SIZE
+
+# Large enough for any datagram, including chunk frames and legacy hex chunks.
+BUFFER_SIZE = 65535
+# Kernel receive buffer; file transfers arrive in bursts.
+RECV_BUFFER = 4 << 20
+# Bulk transfers: how long a token waits for both ends to connect, and how
+# much is moved per splice/recv call.
+BULK_TIMEOUT = 10
+BULK_CHUNK = 1 << 20
+# A transfer is forgotten once no ack has come back for it in TRANSFER_TTL
+# seconds, as its file-transfer-complete travels over UDP and may be lost;
+# every receiver acks, and chunks are too many to time one by one. One
+# address has at most MAX_TRANSFERS registered at a time.
+TRANSFER_TTL = 60
+MAX_TRANSFERS = 256
+# Relayed chunks kept for transfers that announce a manifest, and how many of
+# them are replayed to one receiver at once.
+CHUNK_CACHE = 64 << 20
+CACHE_BURST = 384
+# (rate, burst) of each limit. File data, chunks and relayed requests, is
+# limited in bytes per second from one address and to one receiving user, so
+# no sender or receiver can take the whole server; other requests are
+# limited in requests per second per address. Acks are never limited: they
+# are what lets a sender slow down.
+LIMITS = {
+    "address": (64 << 20, 16 << 20),
+    "user": (128 << 20, 32 << 20),
+    "control": (100, 200),
+}
+# JSON requests that carry file data.
+DATA_REQUESTS = {"file-chunk"}
 
 
 class Server:
     def __init__(self, port):
         self.server_address = ("0.0.0.0", port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.metrics = Metrics()
+        self.log = RateLimitedLog()
+        self.sock = MeteredSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), self.metrics)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
         self.sock.bind(self.server_address)
         self.users = {}
         self.file_requests = {}
+        # transfer_id -> (target_user_id, filename, address acks go back to,
+        # sender's user id, transfer_id of the file the range belongs to)
+        self.transfers = {}
+        self.transfer_ages = TimingWheel(TRANSFER_TTL)
+        self.transfer_counts = {}  # address -> transfers registered from it
+        self.binary_peers = set()  # Addresses that negotiated the binary format.
+        self.directory = Directory("users")  # For paged and pushed listings.
+        self.manifests = {}  # transfer_id -> chunk digests
+        self.chunk_cache = manifest.ChunkCache(CHUNK_CACHE)
+        # Users that go quiet for longer than the session TTL are dropped.
+        self.sessions = TimingWheel()
+        # None turns rate limiting off.
+        self.limits = RateLimits(LIMITS, self.metrics)
+
+        # Bulk transfers are paired up on a TCP socket on the same port.
+        self.bulk_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bulk_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.bulk_sock.bind(("0.0.0.0", self.sock.getsockname()[1]))
+        self.bulk_sock.listen()
+        self.bulk_port = self.bulk_sock.getsockname()[1]
+        self.bulk_tokens = {}  # token -> [sender conn, receiver conn]
+        # Tokens, and the connection waiting on one, go after BULK_TIMEOUT
+        # seconds if the other end never shows up.
+        self.bulk_ages = TimingWheel(BULK_TIMEOUT)
+        self.bulk_lock = threading.Lock()
+
+        self.metrics.gauge("users", lambda: len(self.users))
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.metrics.gauge("watchers", lambda: len(self.directory.watchers))
+        self.metrics.gauge("transfers", lambda: len(self.transfers))
+        self.metrics.gauge("manifests", lambda: len(self.manifests))
+        self.metrics.gauge("chunk_cache_bytes", lambda: self.chunk_cache.size)
+        self.metrics.gauge("bulk_waiting", lambda: len(self.bulk_tokens))
+        self.metrics.gauge(
+            "rate_buckets", lambda: 0 if self.limits is None else len(self.limits)
+        )
+
+    def send(self, body: dict, addr):
+        self.sock.sendto(protocol.dumps(body, addr in self.binary_peers), addr)
+
+    def forward(self, data: bytes, message: dict, addr):
+        # Pass the datagram through untouched when the target reads its encoding.
+        if protocol.is_binary(data) == (addr in self.binary_peers):
+            self.sock.sendto(data, addr)
+        else:
+            self.send(message, addr)
 
     def handle_client(self):
+        threading.Thread(target=self.accept_bulk, daemon=True).start()
         while True:
-            data, addr = self.sock.recvfrom(4096)
+            self.sock.settimeout(self.sessions.timeout())
             try:
-                message = json.loads(data.decode())
-                request = message.get("request")
-
-                if request == "register":
-                    user_id = message["id"]
-                    name = message["name"]
-                    self.users[user_id] = (name, addr)
-                    self.sock.sendto(json.dumps({"status": "success"}).encode(), addr)
-
-                elif request == "list-users":
-                    user_list = [
-                        {"id": user_id, "name": name}
-                        for user_id, (name, _) in self.users.items()
-                    ]
-                    self.sock.sendto(
-                        json.dumps({"success": True, "message": user_list}).encode(),
-                        addr,
-                    )
+                data, addr = self.sock.recvfrom(BUFFER_SIZE)
+            except (socket.timeout, BlockingIOError):
+                # A timeout of zero, with a tick already due, makes the
+                # socket non-blocking for this call.
+                self.housekeeping()
+                continue
+            self.metrics.received(len(data))
+            start = time.perf_counter()
+            kind = self.handle(data, addr)
+            self.metrics.handled(kind, time.perf_counter() - start)
+            self.housekeeping()
 
-                elif request == "send-file":
-                    target_user_id = message["target_user_id"]
-                    if target_user_id in self.users:
-                        self.sock.sendto(
-                            json.dumps(message).encode(), self.users[target_user_id][1]
-                        )
+    def housekeeping(self):
+        # The wheels tick together, so the sessions' timeout covers them all.
+        self.expire_sessions()
+        expired = set(self.transfer_ages.expire())
+        if expired:
+            self.forget_transfers(lambda transfer_id, _: transfer_id in expired)
+        self.expire_bulk_tokens()
 
-                elif request == "file-chunk":
-                    target_user_id = message["target_user_id"]
-                    if target_user_id in self.users:
-                        self.sock.sendto(
-                            json.dumps(message).encode(), self.users[target_user_id][1]
-                        )
+    def expire_sessions(self):
+        for user_id in self.sessions.expire():
+            _, address = self.users.pop(user_id)
+            self.binary_peers.discard(address)
+            self.forget_transfers(lambda _, transfer: user_id in (transfer[0], transfer[3]))
+            if self.directory.remove(user_id):
+                self.notify_watchers(user_id)
 
-                elif request == "request-file":
-                    target_user_id = message["target_user_id"]
-                    if target_user_id in self.users:
-                        self.sock.sendto(
-                            json.dumps(message).encode(), self.users[target_user_id][1]
-                        )
+    def handle(self, data: bytes, addr):
+        # Relayed traffic is routed from its header; only control messages
+        # are parsed in full. Returns the kind of datagram, for the metrics.
+        if protocol.is_chunk(data):
+            self.relay_chunk(data, addr)
+            return "chunk"
+        if protocol.is_ack(data):
+            self.relay_ack(data)
+            return "ack"
+        target_user_id = protocol.peek_target(data)
+        if target_user_id is not None:
+            if self.admit(data, addr, target_user_id):
+                self.relay(data, target_user_id)
+            return "relay"
+
+        request = None
+        try:
+            message = protocol.loads(data)
+            request = message.get("request")
+            target = message.get("target_user_id")
+            if not self.admit(data, addr, target if request in DATA_REQUESTS else False):
+                return request
+
+            # Any request from a user keeps their session alive.
+            user_id = message.get("id")
+            if isinstance(user_id, str) and user_id in self.users:
+                self.sessions.touch(user_id)
+
+            if request == "register":
+                user_id = message["id"]
+                name = message["name"]
+                self.users[user_id] = (name, addr)
+                self.sessions.touch(user_id)
+                if self.directory.put(user_id, name):
+                    self.notify_watchers(user_id)
+
+                wire = message.get("wire")
+                wire = min(wire, protocol.VERSION) if isinstance(wire, int) else 0
+                if wire:
+                    self.binary_peers.add(addr)
+                else:
+                    self.binary_peers.discard(addr)
+                self.sock.sendto(
+                    json.dumps({"status": "success", "wire": wire}).encode(), addr
+                )
 
-                elif request == "approve-file-request":
-                    sender_id = message["sender_id"]
-                    filename = message["filename"]
-                    if sender_id in self.users:
-                        response = {
-                            "request": "file-request-approved",
-                            "filename": filename,
-                        }
-                        self.sock.sendto(
-                            json.dumps(response).encode(), self.users[sender_id][1]
+            elif request == "heartbeat":
+                # Already renewed above; there is no reply.
+                pass
+
+            elif request == "stats":
+                # Always JSON; the snapshot has no binary form.
+                self.sock.sendto(json.dumps(self.metrics.snapshot()).encode(), addr)
+
+            elif request == "list-users":
+                if "cursor" in message or "since" in message:
+                    self.directory.watch(addr)
+                    self.send(self.directory.reply(message), addr)
+                    return request
+
+                # Clients that do not page get everyone at once.
+                user_list = [
+                    {"id": user_id, "name": name}
+                    for user_id, (name, _) in self.users.items()
+                ]
+                self.send({"success": True, "message": user_list}, addr)
+
+            elif request in ("send-file", "send-range", "send-manifest"):
+                target_user_id = message["target_user_id"]
+                if "transfer_id" in message:
+                    transfer_id = message["transfer_id"]
+                    if (
+                        transfer_id not in self.transfers
+                        and self.transfer_counts.get(addr, 0) >= MAX_TRANSFERS
+                    ):
+                        self.send(
+                            {"success": False, "message": "Too many transfers in progress."},
+                            addr,
                         )
+                        return request
+                    self.add_transfer(
+                        transfer_id,
+                        (
+                            target_user_id,
+                            message["filename"],
+                            addr,
+                            message.get("id"),
+                            message.get("file_id", transfer_id),
+                        ),
+                    )
+                if "manifest" in message:
+                    self.manifests[message["transfer_id"]] = manifest.split(
+                        bytes.fromhex(message["manifest"])
+                    )
+                if target_user_id in self.users:
+                    self.forward(data, message, self.users[target_user_id][1])
+
+            elif request == "bulk-offer":
+                target_user_id = message["target_user_id"]
+                if target_user_id not in self.users:
+                    self.send({"success": False, "message": "User not found."}, addr)
+                    return request
+
+                token = self.new_bulk_token()
+                self.send(
+                    {
+                        "request": "bulk-incoming",
+                        "filename": message["filename"],
+                        "filesize": message["filesize"],
+                        "token": token,
+                        "port": self.bulk_port,
+                    },
+                    self.users[target_user_id][1],
+                )
+                self.send({"success": True, "token": token, "port": self.bulk_port}, addr)
+
+            elif request == "file-chunk":
+                target_user_id = message["target_user_id"]
+                if target_user_id in self.users:
+                    self.forward(data, message, self.users[target_user_id][1])
+
+            elif request == "file-transfer-complete":
+                target_user_id = message["target_user_id"]
+                # The ranges of a parallel transfer end with their file.
+                transfer_id = message.get("transfer_id")
+                self.forget_transfers(lambda key, transfer: transfer_id in (key, transfer[4]))
+                if target_user_id in self.users:
+                    self.forward(data, message, self.users[target_user_id][1])
+
+            elif request == "have-chunks":
+                # The receiver's answer to a manifest, on its way back to the
+                # sender; chunks we have cached are sent from here instead.
+                transfer_id = message["transfer_id"]
+                transfer = self.transfers.get(transfer_id)
+                if transfer is None:
+                    return request
+                have = self.replay_cached(transfer_id, bytes.fromhex(message["have"]), addr)
+                reply = {"request": "have-chunks", "transfer_id": transfer_id, "have": have.hex()}
+                self.sock.sendto(protocol.dumps(reply, protocol.is_binary(data)), transfer[2])
+
+            elif request == "request-file":
+                target_user_id = message["target_user_id"]
+                if target_user_id in self.users:
+                    self.forward(data, message, self.users[target_user_id][1])
+
+            elif request == "approve-file-request":
+                sender_id = message["sender_id"]
+                filename = message["filename"]
+                if sender_id in self.users:
+                    response = {
+                        "request": "file-request-approved",
+                        "filename": filename,
+                    }
+                    self.send(response, self.users[sender_id][1])
 
-            except json.JSONDecodeError:
-                print("Invalid JSON received.")
-            except Exception as e:
-                print(f"Error: {e}")
+        except protocol.ProtocolError as e:
+            self.metrics.errors += 1
+            # Always answered in JSON so an incompatible client can fall back.
+            self.sock.sendto(
+                json.dumps({"success": False, "message": str(e)}).encode(), addr
+            )
+        except json.JSONDecodeError:
+            self.metrics.errors += 1
+            self.log("Invalid JSON received.")
+        except Exception as e:
+            self.metrics.errors += 1
+            self.log("Error: %s", e)
+        return request
+
+    def admit(self, data: bytes, addr, target_user_id, reply: bool = True) -> bool:
+        # Whether a request is within the limits; target_user_id is False
+        # for control requests. Shed requests are answered now and then,
+        # unless reply is off: a dropped chunk already reads as loss to the
+        # sender, which backs off by itself.
+        if target_user_id not in (False, None) and not isinstance(target_user_id, str):
+            # It keys the rate limits and the users table.
+            self.metrics.errors += 1
+            self.send({"success": False, "message": "Invalid target_user_id"}, addr)
+            return False
+        if self.limits is None:
+            return True
+        if target_user_id is False:
+            over = self.limits.check(("control", addr))
+        else:
+            over = self.limits.check(
+                ("address", addr), ("user", target_user_id), cost=len(data)
+            )
+        if over is None:
+            return True
+        if reply and self.limits.should_reply(addr):
+            self.send(
+                {"success": False, "message": f"Dropped: over the {over} rate limit, slow down."},
+                addr,
+            )
+        return False
+
+    def add_transfer(self, transfer_id: int, transfer: tuple):
+        old = self.transfers.get(transfer_id)
+        if old is not None:
+            self.uncount_transfer(old)
+        self.transfers[transfer_id] = transfer
+        self.transfer_counts[transfer[2]] = self.transfer_counts.get(transfer[2], 0) + 1
+        self.transfer_ages.touch(transfer_id)
+
+    def uncount_transfer(self, transfer: tuple):
+        count = self.transfer_counts.pop(transfer[2]) - 1
+        if count:
+            self.transfer_counts[transfer[2]] = count
+
+    def forget_transfers(self, match):
+        for transfer_id in [key for key, transfer in self.transfers.items() if match(key, transfer)]:
+            self.uncount_transfer(self.transfers.pop(transfer_id))
+            self.transfer_ages.discard(transfer_id)
+            self.manifests.pop(transfer_id, None)
+
+    def notify_watchers(self, user_id: str):
+        # Pushes a directory change to the clients keeping a copy, encoded
+        # once per wire format.
+        event = self.directory.event(user_id)
+        frames = {}
+        for address in self.directory.watching():
+            binary = address in self.binary_peers
+            if binary not in frames:
+                frames[binary] = protocol.dumps(event, binary)
+            self.sock.sendto(frames[binary], address)
+
+    def relay(self, data: bytes, target_user_id: str):
+        user = self.users.get(target_user_id)
+        if user is None:
+            return
+        target_address = user[1]
+        if target_address in self.binary_peers:
+            self.sock.sendto(data, target_address)
+            return
+
+        try:
+            self.send(protocol.decode(data), target_address)
+        except protocol.ProtocolError as e:
+            self.metrics.errors += 1
+            self.log("Error: %s", e)
+
+    def relay_chunk(self, data: bytes, addr):
+        if len(data) < protocol.CHUNK_HEADER.size:
+            return
+        transfer = self.transfers.get(protocol.chunk_transfer_id(data))
+        if transfer is None or transfer[0] not in self.users:
+            return
+        if not self.admit(data, addr, transfer[0], reply=False):
+            return
+
+        target_user_id, filename = transfer[:2]
+        target_address = self.users[target_user_id][1]
+        if target_address in self.binary_peers:
+            self.sock.sendto(data, target_address)
+            if self.manifests:
+                self.cache_chunk(data)
+            return
+
+        # JSON-only receivers still get the old hex chunks.
+        try:
+            flags, _, _, _, length = protocol.unpack_chunk_header(data)
+        except protocol.ProtocolError:
+            return
+        start = protocol.CHUNK_HEADER.size
+        try:
+            chunk = compression.decompress_chunk(flags, data[start : start + length])
+        except protocol.ProtocolError:
+            return
+        self.send(
+            {
+                "request": "file-chunk",
+                "target_user_id": target_user_id,
+                "filename": filename,
+                "chunk": chunk.hex(),
+            },
+            target_address,
+        )
+
+    def cache_chunk(self, data: bytes):
+        try:
+            flags, transfer_id, seq, _, length = protocol.unpack_chunk_header(data)
+        except protocol.ProtocolError:
+            return
+        digests = self.manifests.get(transfer_id)
+        if digests is None or seq >= len(digests):
+            return
+        start = protocol.CHUNK_HEADER.size
+        self.chunk_cache.put(
+            digests[seq], flags & protocol.COMPRESSED, data[start : start + length]
+        )
+
+    def replay_cached(self, transfer_id: int, have: bytes, target_address) -> bytes:
+        # Sends the receiver what it lacks from the cache and returns the
+        # bitmap with those chunks marked as held.
+        digests = self.manifests.get(transfer_id)
+        if digests is None or target_address not in self.binary_peers:
+            return have
+
+        have = bytearray(have)
+        frame = bytearray(protocol.CHUNK_HEADER.size + CHUNK_SIZE)
+        view = memoryview(frame)
+        replayed = 0
+        for seq, key in enumerate(digests):
+            if replayed == CACHE_BURST:
+                break
+            if have[seq >> 3] & (0x80 >> (seq & 7)):
+                continue
+            entry = self.chunk_cache.get(key)
+            if entry is None:
+                continue
+
+            flags, payload = entry
+            protocol.pack_chunk_header(
+                frame, flags, transfer_id, seq, seq * CHUNK_SIZE, len(payload)
+            )
+            end = protocol.CHUNK_HEADER.size + len(payload)
+            frame[protocol.CHUNK_HEADER.size : end] = payload
+            self.sock.sendto(view[:end], target_address)
+            have[seq >> 3] |= 0x80 >> (seq & 7)
+            replayed += 1
+        return bytes(have)
+
+    def relay_ack(self, data: bytes):
+        if len(data) != protocol.ACK_FRAME.size:
+            return
+        transfer_id = protocol.ack_transfer_id(data)
+        transfer = self.transfers.get(transfer_id)
+        if transfer is not None:
+            self.transfer_ages.touch(transfer_id)
+            self.sock.sendto(data, transfer[2])
+
+    def new_bulk_token(self) -> int:
+        with self.bulk_lock:
+            token = secrets.randbits(64)
+            self.bulk_tokens[token] = [None, None]
+            self.bulk_ages.touch(token)
+        return token
+
+    def expire_bulk_tokens(self):
+        with self.bulk_lock:
+            for token in self.bulk_ages.expire():
+                for conn in self.bulk_tokens.pop(token):
+                    if conn is not None:
+                        conn.close()
+
+    def accept_bulk(self):
+        while True:
+            conn, _ = self.bulk_sock.accept()
+            threading.Thread(target=self.join_bulk, args=(conn,), daemon=True).start()
+
+    def join_bulk(self, conn: socket.socket):
+        # Each token is good for one sender and one receiver; whoever connects
+        # second starts the copy.
+        conn.settimeout(BULK_TIMEOUT)
+        kept = False
+        try:
+            hello = conn.recv(protocol.BULK_HELLO.size, socket.MSG_WAITALL)
+            token, role = protocol.BULK_HELLO.unpack(hello)
+
+            with self.bulk_lock:
+                pending = self.bulk_tokens.get(token)
+                if pending is None or role not in (protocol.BULK_SENDER, protocol.BULK_RECEIVER):
+                    return
+                if pending[role] is not None:
+                    pending[role].close()
+                pending[role] = conn
+                kept = True
+                if None in pending:
+                    return
+                del self.bulk_tokens[token]
+                self.bulk_ages.discard(token)
+        except (OSError, ValueError, struct.error):
+            return
+        finally:
+            # Closed unless a token holds it now.
+            if not kept:
+                conn.close()
+
+        sender, receiver = pending
+        try:
+            sender.settimeout(None)
+            receiver.settimeout(None)
+            sender.sendall(protocol.BULK_READY)
+            self.copy_bulk(sender, receiver)
+        except OSError:
+            pass
+        finally:
+            sender.close()
+            receiver.close()
+
+    def copy_bulk(self, source: socket.socket, target: socket.socket):
+        # Bytes move socket -> pipe -> socket inside the kernel where splice
+        # is available.
+        if hasattr(os, "splice"):
+            read_end, write_end = os.pipe()
+            try:
+                while length := os.splice(source.fileno(), write_end, BULK_CHUNK):
+                    while length:
+                        length -= os.splice(read_end, target.fileno(), length)
+            finally:
+                os.close(read_end)
+                os.close(write_end)
+            return
+
+        buffer = bytearray(BULK_CHUNK)
+        view = memoryview(buffer)
+        while length := source.recv_into(buffer):
+            target.sendall(view[:length])
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File transfer server.")
+    parser.add_argument("--stats-file", help="Append a metrics snapshot here periodically.")
+    parser.add_argument("--stats-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
     server = Server(2055)
+    if args.stats_file:
+        server.metrics.dump_every(args.stats_file, args.stats_interval)
     print("Server started. Listening for connections...")
     server.handle_client()
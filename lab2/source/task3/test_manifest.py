@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+import manifest
+import protocol
+from transfer import CHUNK_SIZE
+
+
+class ManifestTest(unittest.TestCase):
+    def test_largest_manifest_fits_a_datagram(self):
+        request = {
+            "request": "send-manifest",
+            "user_name": "n" * 100,
+            "id": "000a",
+            "target_user_id": "000b",
+            "filename": "f" * 255,
+            "filesize": manifest.MAX_CHUNKS * CHUNK_SIZE,
+            "transfer_id": 1,
+            "chunks": manifest.MAX_CHUNKS,
+            "manifest": (b"\xab" * manifest.DIGEST_SIZE * manifest.MAX_CHUNKS).hex(),
+        }
+        self.assertLessEqual(len(protocol.dumps(request, True)), manifest.MAX_DATAGRAM)
+
+    def test_build_and_split(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(os.urandom(CHUNK_SIZE) * 2 + b"tail")
+            f.flush()
+            digests = manifest.split(manifest.build(f.fileno(), 2 * CHUNK_SIZE + 4))
+        self.assertEqual(len(digests), 3)
+        self.assertEqual(digests[0], digests[1])
+        self.assertEqual(digests[2], manifest.digest(b"tail"))
+
+    def test_bitmap_round_trip(self):
+        seqs = [0, 7, 8, 19]
+        bitmap = manifest.pack_bitmap(seqs, 20)
+        self.assertEqual(len(bitmap), 3)
+        self.assertEqual(manifest.unpack_bitmap(bitmap, 20), seqs)
+
+    def test_local_chunks(self):
+        block = os.urandom(CHUNK_SIZE)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "old")
+            with open(path, "wb") as f:
+                f.write(os.urandom(CHUNK_SIZE) + block)
+            missing = os.path.join(directory, "missing")
+            found = manifest.local_chunks([path, missing], {manifest.digest(block)})
+        self.assertEqual(found, {manifest.digest(block): (path, CHUNK_SIZE)})
+
+
+class ChunkCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = manifest.ChunkCache(10)
+        cache.put(b"a", 0, b"1234")
+        cache.put(b"b", 0, b"1234")
+        self.assertIsNotNone(cache.get(b"a"))
+        cache.put(b"c", 0, b"1234")
+        self.assertIsNone(cache.get(b"b"))
+        self.assertEqual(cache.get(b"a"), (0, b"1234"))
+        self.assertLessEqual(cache.size, 10)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import json
+import socket
+import unittest
+
+import protocol
+from common.session import TimingWheel
+from conftest import Clock
+from server import BULK_TIMEOUT, MAX_TRANSFERS, TRANSFER_TTL, Server
+
+
+class Stop(Exception):
+    pass
+
+
+class ListenLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(0)
+        self.clock = Clock()
+        self.server.sessions = TimingWheel(clock=self.clock)
+
+    def tearDown(self):
+        self.server.sock.close()
+        self.server.bulk_sock.close()
+
+    def test_due_tick_with_nothing_to_read(self):
+        # The next tick is already due, so the loop waits on the socket with
+        # a timeout of zero and finds it empty.
+        self.clock.now += 5
+        self.assertEqual(self.server.sessions.timeout(), 0.0)
+
+        def expire_sessions():
+            raise Stop
+
+        self.server.expire_sessions = expire_sessions
+        self.server.accept_bulk = lambda: None
+        with self.assertRaises(Stop):
+            self.server.handle_client()
+
+
+
+class TransfersTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(0)
+        self.server.limits = None
+        self.clock = Clock()
+        self.server.sessions = TimingWheel(clock=self.clock)
+        self.server.transfer_ages = TimingWheel(TRANSFER_TTL, clock=self.clock)
+        for user_id, port in (("000a", 9), ("000b", 10)):
+            self.request({"request": "register", "name": user_id, "id": user_id}, port)
+
+    def tearDown(self):
+        self.server.sock.close()
+        self.server.bulk_sock.close()
+
+    def request(self, message: dict, port: int = 9):
+        self.server.handle(json.dumps(message).encode(), ("127.0.0.1", port))
+
+    def send_ranges(self, file_id: int, streams: int):
+        for index in range(streams):
+            self.request(
+                {
+                    "request": "send-range",
+                    "user_name": "000a",
+                    "id": "000a",
+                    "target_user_id": "000b",
+                    "filename": "f.bin",
+                    "filesize": 8192 * streams,
+                    "transfer_id": file_id + 1 + index,
+                    "chunks": 2,
+                    "file_id": file_id,
+                    "offset": 8192 * index,
+                    "streams": streams,
+                }
+            )
+
+    def send_file(self, transfer_id: int, port: int = 9):
+        self.request(
+            {
+                "request": "send-file",
+                "user_name": "000a",
+                "id": "000a",
+                "target_user_id": "000b",
+                "filename": "f.bin",
+                "filesize": 8192,
+                "transfer_id": transfer_id,
+                "chunks": 2,
+            },
+            port,
+        )
+
+    def test_ranges_end_with_their_file(self):
+        self.send_ranges(100, 4)
+        self.send_ranges(200, 2)
+        self.assertEqual(len(self.server.transfers), 6)
+        self.request(
+            {
+                "request": "file-transfer-complete",
+                "target_user_id": "000b",
+                "filename": "f.bin",
+                "transfer_id": 100,
+            }
+        )
+        self.assertEqual(sorted(self.server.transfers), [201, 202])
+
+    def test_expired_users_transfers_are_forgotten(self):
+        self.send_ranges(100, 2)
+        # The receiver stays; the sender goes quiet.
+        self.clock.now += 30
+        self.request({"request": "heartbeat", "id": "000b"}, 10)
+        self.clock.now += 40
+        self.server.expire_sessions()
+        self.assertNotIn("000a", self.server.users)
+        self.assertEqual(self.server.transfers, {})
+        self.assertEqual(self.server.manifests, {})
+
+
+    def test_transfers_without_acks_age_out(self):
+        self.send_ranges(100, 2)
+        self.clock.now += 30
+        self.server.handle(protocol.pack_ack(101, 0, 0, 8), ("127.0.0.1", 10))
+        self.server.housekeeping()
+        self.clock.now += 40
+        for user_id, port in (("000a", 9), ("000b", 10)):
+            self.request({"request": "heartbeat", "id": user_id}, port)
+        self.server.housekeeping()
+        self.assertEqual(sorted(self.server.transfers), [101])
+        self.assertEqual(self.server.transfer_counts, {("127.0.0.1", 9): 1})
+
+    def test_transfers_per_address_are_capped(self):
+        for transfer_id in range(MAX_TRANSFERS + 10):
+            self.send_file(transfer_id)
+        self.assertEqual(len(self.server.transfers), MAX_TRANSFERS)
+        # Registering one again is not a new entry.
+        self.send_file(0)
+        self.assertEqual(len(self.server.transfers), MAX_TRANSFERS)
+        self.request(
+            {
+                "request": "file-transfer-complete",
+                "target_user_id": "000b",
+                "filename": "f.bin",
+                "transfer_id": 0,
+            }
+        )
+        self.send_file(1000)
+        self.assertIn(1000, self.server.transfers)
+        # Other addresses have room of their own.
+        self.send_file(2000, port=10)
+        self.assertIn(2000, self.server.transfers)
+
+class BulkTokensTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(0)
+        self.clock = Clock()
+        self.server.bulk_ages = TimingWheel(BULK_TIMEOUT, clock=self.clock)
+
+    def tearDown(self):
+        self.server.sock.close()
+        self.server.bulk_sock.close()
+
+    def connect(self, token: int, role: int) -> socket.socket:
+        sock = socket.create_connection(("127.0.0.1", self.server.bulk_port))
+        sock.sendall(protocol.BULK_HELLO.pack(token, role))
+        conn, _ = self.server.bulk_sock.accept()
+        self.server.join_bulk(conn)
+        return sock
+
+    def test_unpaired_token_expires_and_closes_its_connection(self):
+        token = self.server.new_bulk_token()
+        with self.connect(token, protocol.BULK_SENDER) as sender:
+            self.assertIsNotNone(self.server.bulk_tokens[token][protocol.BULK_SENDER])
+            self.clock.now += BULK_TIMEOUT - 1
+            self.server.housekeeping()
+            self.assertIn(token, self.server.bulk_tokens)
+
+            self.clock.now += 3
+            self.server.housekeeping()
+            self.assertEqual(self.server.bulk_tokens, {})
+            self.assertEqual(len(self.server.bulk_ages), 0)
+            sender.settimeout(1)
+            self.assertEqual(sender.recv(1), b"")
+
+    def test_unused_tokens_expire(self):
+        for _ in range(3):
+            self.server.new_bulk_token()
+        self.clock.now += BULK_TIMEOUT + 2
+        self.server.housekeeping()
+        self.assertEqual(self.server.bulk_tokens, {})
+
+if __name__ == "__main__":
+    unittest.main()
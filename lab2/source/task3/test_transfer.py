@@ -0,0 +1,141 @@
+import socket
+import threading
+import unittest
+
+import protocol
+import transfer
+from transfer import CHUNK_SIZE, ReceiveWindow, ReliableSender
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []  # seqs in the order they went out
+
+    def sendto(self, data, address):
+        self.sent.append(protocol.unpack_chunk_header(bytes(data))[2])
+
+
+def fill(seq: int, payload: memoryview):
+    payload[:4] = seq.to_bytes(4, "big")
+    return seq * CHUNK_SIZE, 4, 0
+
+
+def ack(window: ReceiveWindow) -> bytes:
+    return protocol.pack_ack(7, window.cumulative, window.sack(), transfer.MAX_WINDOW)
+
+
+class ReceiveWindowTest(unittest.TestCase):
+    def test_in_order(self):
+        window = ReceiveWindow(3)
+        self.assertTrue(window.add(0))
+        self.assertTrue(window.add(1))
+        self.assertFalse(window.complete)
+        self.assertTrue(window.add(2))
+        self.assertTrue(window.complete)
+
+    def test_out_of_order_and_duplicates(self):
+        window = ReceiveWindow(10)
+        for seq in (2, 4, 1):
+            self.assertTrue(window.add(seq))
+        self.assertFalse(window.add(2))
+        self.assertFalse(window.add(10))
+        self.assertEqual(window.cumulative, 0)
+        # Bit n stands for seq cumulative + 1 + n.
+        self.assertEqual(window.sack(), 0b1011)
+        self.assertTrue(window.add(0))
+        self.assertEqual(window.cumulative, 3)
+        self.assertEqual(window.pending, {4})
+
+    def test_held_chunks_count_as_arrived(self):
+        window = ReceiveWindow(4, have=[0, 1, 3])
+        self.assertEqual(window.cumulative, 2)
+        self.assertTrue(window.add(2))
+        self.assertTrue(window.complete)
+
+
+class ReliableSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.sock = FakeSocket()
+        self.sender = ReliableSender(self.sock, None, 7, 100, fill)
+
+    def test_slow_start(self):
+        self.sender.fill_window()
+        self.assertEqual(self.sock.sent, list(range(transfer.INITIAL_WINDOW)))
+        window = ReceiveWindow(100)
+        for seq in self.sock.sent:
+            window.add(seq)
+        self.assertTrue(self.sender.on_ack(ack(window)))
+        self.assertEqual(self.sender.cwnd, 2 * transfer.INITIAL_WINDOW)
+        self.assertFalse(self.sender.outstanding)
+
+    def test_other_transfers_acks_are_ignored(self):
+        self.sender.fill_window()
+        self.assertFalse(self.sender.on_ack(protocol.pack_ack(8, 4, 0, 64)))
+        self.assertFalse(self.sender.on_ack(b"junk"))
+        self.assertEqual(self.sender.cumulative, 0)
+
+    def test_selective_acks_trigger_resend(self):
+        self.sender.cwnd = 8
+        self.sender.fill_window()
+        window = ReceiveWindow(100)
+        # Chunk 1 is lost; the rest arrive.
+        for seq in self.sock.sent:
+            if seq != 1:
+                window.add(seq)
+        self.sender.on_ack(ack(window))
+        # Seven chunks acked in slow start, then halved for the loss.
+        self.assertEqual(self.sender.cwnd, (8 + 7) / 2)
+        self.sock.sent.clear()
+        self.sender.fill_window()
+        self.assertEqual(self.sock.sent[0], 1)
+        self.assertEqual(self.sender.retransmissions, 1)
+
+    def test_timeout_resends_from_one_chunk(self):
+        self.sender.fill_window()
+        self.assertTrue(self.sender.on_timeout())
+        self.assertEqual(self.sender.cwnd, 1.0)
+        self.assertEqual(self.sender.rto, 2 * transfer.INITIAL_RTO)
+        self.sock.sent.clear()
+        self.sender.fill_window()
+        self.assertEqual(self.sock.sent, [0])
+
+    def test_gives_up_after_max_timeouts(self):
+        self.sender.fill_window()
+        results = [self.sender.on_timeout() for _ in range(transfer.MAX_TIMEOUTS + 1)]
+        self.assertEqual(results, [True] * transfer.MAX_TIMEOUTS + [False])
+
+    def test_only_wanted_chunks_are_sent(self):
+        sender = ReliableSender(self.sock, None, 7, 10, fill, seqs=[3, 7])
+        sender.fill_window()
+        self.assertEqual(self.sock.sent, [3, 7])
+
+
+class LoopbackTest(unittest.TestCase):
+    def test_transfer_completes(self):
+        total = 300
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        received = {}
+
+        def receive():
+            window = ReceiveWindow(total)
+            while not window.complete:
+                data, address = receiver.recvfrom(65535)
+                _, _, seq, _, length = protocol.unpack_chunk_header(data)
+                header = protocol.CHUNK_HEADER.size
+                received[seq] = data[header : header + length]
+                window.add(seq)
+                receiver.sendto(ack(window), address)
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        with receiver, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sender = ReliableSender(sock, receiver.getsockname(), 7, total, fill)
+            self.assertTrue(sender.run())
+            thread.join()
+        self.assertEqual(received, {seq: seq.to_bytes(4, "big") for seq in range(total)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,327 @@
+import heapq
+import socket
+import time
+
+import protocol
+
+CHUNK_SIZE = 4096
+FRAME_SIZE = protocol.CHUNK_HEADER.size + CHUNK_SIZE
+
+# Retransmission timer bounds (seconds), after RFC 6298.
+INITIAL_RTO = 0.2
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+# Consecutive timeouts without progress before a transfer is abandoned.
+MAX_TIMEOUTS = 12
+
+INITIAL_WINDOW = 4
+MAX_WINDOW = 2048
+# A chunk is presumed lost once this many later chunks have been acknowledged.
+DUP_THRESHOLD = 3
+# Receivers acknowledge at least every ACK_EVERY in-order chunks.
+ACK_EVERY = 4
+
+
+def chunk_count(filesize: int) -> int:
+    return (filesize + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def receive_window(sock: socket.socket) -> int:
+    # How many chunk datagrams the socket can queue; the kernel charges
+    # roughly twice the payload for each one.
+    buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    return max(1, min(MAX_WINDOW, buffer // (2 * FRAME_SIZE)))
+
+
+class ReceiveWindow:
+    def __init__(self, total: int, have=()):
+        self.total = total
+        self.cumulative = 0  # every seq below this has arrived
+        self.pending: set[int] = set()  # arrived out of order, above cumulative
+        # Chunks the receiver already holds count as arrived.
+        for seq in have:
+            self.add(seq)
+
+    def add(self, seq: int) -> bool:
+        # Returns False for duplicates.
+        if seq < self.cumulative or seq in self.pending or seq >= self.total:
+            return False
+
+        if seq == self.cumulative:
+            self.cumulative += 1
+            while self.cumulative in self.pending:
+                self.pending.remove(self.cumulative)
+                self.cumulative += 1
+        else:
+            self.pending.add(seq)
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return self.cumulative >= self.total
+
+    def sack(self) -> int:
+        bitmap = 0
+        base = self.cumulative + 1
+        for seq in self.pending:
+            if seq - base < protocol.SACK_BITS:
+                bitmap |= 1 << (seq - base)
+        return bitmap
+
+
+class ReliableSender:
+    # Sends chunks 0..total-1 (or just those in seqs, when the receiver
+    # already holds the rest) over a dedicated socket with a sliding window.
+    # The receiver acks with a cumulative sequence number plus a selective
+    # bitmap; chunks are retransmitted after DUP_THRESHOLD later chunks are
+    # acknowledged or when the retransmission timer fires. The window follows
+    # AIMD (slow start, halve on loss, back to one chunk on timeout) and never
+    # exceeds what the receiver says it can buffer.
+    def __init__(
+        self,
+        sock: socket.socket,
+        address,
+        transfer_id: int,
+        total: int,
+        fill,
+        seqs=None,
+    ):
+        self.sock = sock
+        self.address = address
+        self.transfer_id = transfer_id
+        self.total = total
+        self.seqs = range(total) if seqs is None else seqs
+        # fill(seq, payload) copies chunk seq into payload and returns
+        # (offset, length, flags).
+        self.fill = fill
+
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.rwnd = MAX_WINDOW
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+
+        self.next_index = 0  # into seqs
+        self.cumulative = 0
+        self.sacked: set[int] = set()  # acknowledged above cumulative
+        self.frames: dict[int, bytearray] = {}  # unacknowledged frames by seq
+        self.outstanding: dict[int, float] = {}  # seq -> send time, 0 if resent
+        self.lost: list[int] = []  # heap of seqs waiting to be resent
+        self.recovery = 0  # no further window cut until cumulative passes this
+        self.timer = 0.0
+        self.free: list[bytearray] = []
+
+        self.sent = 0
+        self.retransmissions = 0
+        self.timeouts = 0
+
+    def handshake(self, header: bytes, attempts: int = 5) -> bool:
+        # The "send-file" header is resent until the receiver's first ack.
+        timeout = INITIAL_RTO
+        ack = bytearray(protocol.ACK_FRAME.size)
+        for _ in range(attempts):
+            self.sock.sendto(header, self.address)
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                self.sock.settimeout(remaining)
+                try:
+                    nbytes = self.sock.recv_into(ack)
+                except socket.timeout:
+                    break
+                if self.on_ack(ack[:nbytes]):
+                    return True
+            timeout = min(timeout * 2, MAX_RTO)
+        return False
+
+    def run(self) -> bool:
+        ack = bytearray(protocol.ACK_FRAME.size)
+        self.timer = time.monotonic()
+
+        while self.cumulative < self.total:
+            self.fill_window()
+
+            remaining = self.timer + self.rto - time.monotonic()
+            self.sock.settimeout(max(remaining, 0.0005))
+            try:
+                nbytes = self.sock.recv_into(ack)
+            except socket.timeout:
+                if not self.on_timeout():
+                    return False
+                continue
+
+            self.on_ack(ack[:nbytes])
+
+        return True
+
+    def frame(self, seq: int) -> bytearray:
+        frame = self.frames.get(seq)
+        if frame is None:
+            frame = self.free.pop() if self.free else bytearray(FRAME_SIZE)
+            offset, length, flags = self.fill(
+                seq, memoryview(frame)[protocol.CHUNK_HEADER.size :]
+            )
+            protocol.pack_chunk_header(frame, flags, self.transfer_id, seq, offset, length)
+            self.frames[seq] = frame
+        return frame
+
+    @property
+    def next_seq(self) -> int:
+        # The first seq not sent yet.
+        if self.next_index < len(self.seqs):
+            return self.seqs[self.next_index]
+        return self.total
+
+    def next_to_send(self):
+        while self.lost:
+            seq = heapq.heappop(self.lost)
+            if (
+                seq >= self.cumulative
+                and seq not in self.sacked
+                and seq not in self.outstanding
+            ):
+                return seq, True
+        if self.next_index < len(self.seqs):
+            self.next_index += 1
+            return self.seqs[self.next_index - 1], False
+        return None, False
+
+    def fill_window(self):
+        window = min(int(self.cwnd), self.rwnd)
+        if not self.outstanding:
+            self.timer = time.monotonic()
+
+        while len(self.outstanding) < window:
+            seq, resend = self.next_to_send()
+            if seq is None:
+                break
+
+            frame = self.frame(seq)
+            last = (
+                len(self.outstanding) + 1 >= window
+                or resend
+                or self.next_index == len(self.seqs)
+            )
+            if last:
+                frame[3] |= protocol.ACK_REQUEST
+            else:
+                frame[3] &= ~protocol.ACK_REQUEST
+            length = protocol.CHUNK_HEADER.unpack_from(frame)[-1]
+            self.sock.sendto(
+                memoryview(frame)[: protocol.CHUNK_HEADER.size + length], self.address
+            )
+            self.sent += 1
+            # Karn's rule: no RTT samples from retransmitted chunks.
+            self.outstanding[seq] = 0.0 if resend else time.monotonic()
+            if resend:
+                self.retransmissions += 1
+
+    def acknowledge(self, seq: int) -> float:
+        # Returns the send time of a first transmission, else 0.
+        frame = self.frames.pop(seq, None)
+        if frame is None:
+            return 0.0
+        self.free.append(frame)
+        return self.outstanding.pop(seq, 0.0)
+
+    def on_ack(self, data) -> bool:
+        try:
+            transfer_id, cumulative, sack, window = protocol.unpack_ack(data)
+        except protocol.ProtocolError:
+            return False
+        if transfer_id != self.transfer_id:
+            return False
+
+        self.rwnd = max(1, window)
+        progress = cumulative > self.cumulative
+        # Only chunks we sent count towards the window; the receiver may
+        # have had the others all along.
+        newly_acked = 0
+        sent_at = 0.0
+        while self.cumulative < cumulative:
+            if self.cumulative in self.frames:
+                sent_at = self.acknowledge(self.cumulative) or sent_at
+                newly_acked += 1
+            self.sacked.discard(self.cumulative)
+            self.cumulative += 1
+
+        highest = cumulative
+        base = cumulative + 1
+        while sack:
+            bit = (sack & -sack).bit_length() - 1
+            sack &= sack - 1
+            seq = base + bit
+            highest = seq
+            if seq not in self.sacked:
+                self.sacked.add(seq)
+                if seq in self.frames:
+                    sent_at = self.acknowledge(seq) or sent_at
+                    newly_acked += 1
+
+        if newly_acked or progress:
+            self.timeouts = 0
+            self.timer = time.monotonic()
+        if newly_acked:
+            if sent_at:
+                self.sample_rtt(time.monotonic() - sent_at)
+            if self.cwnd < self.ssthresh:
+                self.cwnd += newly_acked
+            else:
+                self.cwnd += newly_acked / self.cwnd
+            self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+        self.detect_loss(highest)
+        return True
+
+    def detect_loss(self, highest: int):
+        limit = highest - DUP_THRESHOLD
+        lost = []
+        # outstanding is in send order, which is seq order for first sends.
+        for seq in self.outstanding:
+            if seq >= limit:
+                break
+            lost.append(seq)
+
+        if not lost:
+            return
+        for seq in lost:
+            del self.outstanding[seq]
+            heapq.heappush(self.lost, seq)
+
+        if self.cumulative >= self.recovery:
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.recovery = self.next_seq
+
+    def on_timeout(self) -> bool:
+        self.timeouts += 1
+        if self.timeouts > MAX_TIMEOUTS:
+            return False
+        if not self.outstanding:
+            # Nothing in flight, yet the receiver still misses chunks it was
+            # to get from elsewhere (the server's cache); send them ourselves.
+            end = min(self.cumulative + protocol.SACK_BITS + 1, self.total)
+            for seq in range(self.cumulative, end):
+                if seq not in self.sacked:
+                    heapq.heappush(self.lost, seq)
+            self.timer = time.monotonic()
+            return True
+
+        self.ssthresh = max(len(self.outstanding) / 2, 2.0)
+        self.cwnd = 1.0
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.recovery = self.next_seq
+        for seq in self.outstanding:
+            heapq.heappush(self.lost, seq)
+        self.outstanding.clear()
+        self.timer = time.monotonic()
+        return True
+
+    def sample_rtt(self, rtt: float):
+        if not self.srtt:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)